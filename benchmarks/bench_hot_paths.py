@@ -0,0 +1,281 @@
+"""Microbenchmarks for the CPU hot paths of the bundle generation pipeline.
+
+Fixed inputs come from `data/electronic/` and `temp/electronic/`; synthetic
+inputs are scaled up to `--scale` sessions. Results can be saved as a
+baseline and later checked against it:
+
+    python benchmarks/bench_hot_paths.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_hot_paths.py --check benchmarks/baseline.json --threshold 0.25
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.functions import output_parser, process_results
+from utils.bundle_index import BundleIndex
+from utils.dataset import load_dataset
+from utils.metrics import compute, findErrors
+from prompt.prompts import PromptGenerator
+
+ARTIFACTS = ['self_correction_res', 'feedback_res', 'intent_context']
+INTENT_QUESTION = re.compile(r'generate (?:the )?intents', re.IGNORECASE)
+LOG_ENTRY = re.compile(r'^(?:\d{4}-\d\d-\d\d [\d:.]+: )?Raw intent feedback(?: for test_id \d+)?: (.*)$')
+LOG_LINE_START = re.compile(r'^(?:\d{4}-\d\d-\d\d [\d:.]+: |Raw intent feedback|\s*\d+%\|)')
+DATA_FILES = ['training_set', 'test_set', 'TopK_related_sessions', 'session_items',
+              'session_bundles_deduplication', 'item_titles']
+
+
+def load_npy_dicts(data_path):
+    """Load the six startup dicts the same way `run.py` does."""
+    return {name: np.load(f'{data_path}{name}.npy', allow_pickle=True).item() for name in DATA_FILES}
+
+
+def load_response_corpus(dataset='electronic'):
+    """Collect real model responses as (response, 'bundle' or 'intent') pairs.
+
+    Assistant messages come from the conversations saved in `temp/`, typed
+    by the question they answer, and the raw intent ratings from
+    `log/process.log` (cut to 100 characters by the logger).
+    """
+    corpus = []
+    temp_path = os.path.join(ROOT, 'temp', dataset) + '/'
+    for name in ARTIFACTS:
+        for _, context in np.load(f'{temp_path}{name}.npy', allow_pickle=True).item().values():
+            for question, answer in zip(context, context[1:]):
+                if question['role'] == 'user' and answer['role'] == 'assistant':
+                    response_type = 'intent' if INTENT_QUESTION.search(question['content']) else 'bundle'
+                    corpus.append((answer['content'], response_type))
+
+    entry = None
+    with open(os.path.join(ROOT, 'log', 'process.log'), encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            match = LOG_ENTRY.match(line)
+            if match or LOG_LINE_START.match(line):
+                if entry is not None:
+                    corpus.append(('\n'.join(entry), 'intent'))
+                entry = [match.group(1)] if match else None
+            elif entry is not None:
+                entry.append(line)
+    if entry is not None:
+        corpus.append(('\n'.join(entry), 'intent'))
+    # repeated responses would only weigh the benchmark towards them
+    return list(dict.fromkeys(corpus))
+
+
+def parse_success_rate(corpus):
+    """Share of the corpus `output_parser` parses into a non-empty dict, per response type."""
+    rates = {}
+    for response_type in ('bundle', 'intent'):
+        responses = [response for response, t in corpus if t == response_type]
+        parsed = 0
+        for response in responses:
+            res = output_parser(response, type=response_type)
+            parsed += res['state_code'] == 200 and len(res['output']) > 0
+        rates[response_type] = (parsed, len(responses))
+    return rates
+
+
+def load_fixed_inputs(dataset='electronic'):
+    """Collect the real inputs of every hot path from `data/` and `temp/`."""
+    data_path = os.path.join(ROOT, 'data', dataset) + '/'
+    temp_path = os.path.join(ROOT, 'temp', dataset) + '/'
+    data = load_npy_dicts(data_path)
+    self_correction_res = np.load(f'{temp_path}self_correction_res.npy', allow_pickle=True).item()
+    parsered_res = np.load(f'{temp_path}parsered_res.npy', allow_pickle=True).item()
+    bundle_res = np.load(f'{temp_path}bundle_res.npy', allow_pickle=True).item()
+
+    related = {}
+    for test_id, (topk_session_idx, bundle_dict) in parsered_res.items():
+        items = data['session_items'][topk_session_idx].split(',')
+        related[test_id] = (topk_session_idx, [(','.join(items[:2]), 'intent', bundle[-1], bundle[0])
+                                               for bundle in data['session_bundles_deduplication'][topk_session_idx]])
+    return {
+        'data_path': data_path,
+        'session_items': data['session_items'],
+        'session_bundles': data['session_bundles_deduplication'],
+        'bundle_index': BundleIndex(data['session_items'], data['session_bundles_deduplication']),
+        'item_titles': data['item_titles'],
+        'responses': load_response_corpus(dataset),
+        'parsered_res': parsered_res,
+        'bundle_res': bundle_res,
+        'related': related,
+    }
+
+
+def make_synthetic_inputs(n_sessions, seed=0):
+    """Build inputs shaped like the real ones for `n_sessions` sessions."""
+    rng = random.Random(seed)
+    session_items, session_bundles, predictions, generated = {}, {}, {}, {}
+    item_titles, related, responses = {}, {}, []
+    for sid in range(n_sessions):
+        items = [f'I{sid}_{i}' for i in range(rng.randint(4, 15))]
+        for item in items:
+            item_titles[item] = f'Synthetic product {item}'
+        session_items[sid] = ','.join(items)
+        shuffled = items[:]
+        rng.shuffle(shuffled)
+        cut = rng.randint(2, len(items) - 2)
+        session_bundles[sid] = [('intent a', ','.join(shuffled[:cut])), ('intent b', ','.join(shuffled[cut:]))]
+
+        bundles = {}
+        for b in range(rng.randint(1, 3)):
+            picked = rng.sample(range(1, len(items) + 1), rng.randint(1, 3))
+            bundles[f'bundle{b + 1}'] = [f'product{i}' for i in picked]
+        predictions[sid] = bundles
+        generated[sid] = (sid, bundles)
+        related[sid] = (sid, [(','.join(items[:2]), 'intent', bundle[-1], bundle[0]) for bundle in session_bundles[sid]])
+        responses.append(('Here are the bundles:\n' + json.dumps(bundles, indent=2), 'bundle'))
+    return {
+        'session_items': session_items,
+        'session_bundles': session_bundles,
+        'bundle_index': BundleIndex(session_items, session_bundles),
+        'item_titles': item_titles,
+        'responses': responses,
+        'parsered_res': generated,
+        'bundle_res': predictions,
+        'related': related,
+    }
+
+
+def bench_output_parser(inputs):
+    for response, response_type in inputs['responses']:
+        output_parser(response, type=response_type)
+
+
+def bench_process_results(inputs):
+    process_results(inputs['bundle_res'], _QuietLogger())
+
+
+def bench_compute(inputs):
+    predictions = {test_id: bundles for test_id, bundles in inputs['bundle_res'].items()
+                   if test_id in inputs['session_items']}
+    compute(inputs['session_items'], inputs['session_bundles'], predictions, _QuietLogger(),
+            index=inputs['bundle_index'])
+
+
+def bench_find_errors(inputs):
+    for topk_session_idx, bundle_dict in inputs['parsered_res'].values():
+        findErrors(topk_session_idx, bundle_dict, inputs['session_bundles'], inputs['session_items'],
+                   inputs['bundle_index'])
+
+
+def bench_bundle_index(inputs):
+    BundleIndex(inputs['session_items'], inputs['session_bundles'])
+
+
+def bench_intent_rater(inputs):
+    PromptGenerator(inputs['session_items'], inputs['session_bundles']).get_Intent_rater(inputs['related'],
+                                                                                         inputs['item_titles'])
+
+
+def bench_load_npy(inputs):
+    load_npy_dicts(inputs['data_path'])
+
+
+def bench_load_compact(inputs):
+    # opening is lazy, so also decode what the prompt stage reads
+    dataset = load_dataset(inputs['data_path'])
+    for test_id in dataset['test_set']:
+        topk_session_idx = dataset['TopK_related_sessions'][test_id][0]
+        dataset['training_set'][topk_session_idx]
+        dataset['session_items'][topk_session_idx]
+
+
+class _QuietLogger(object):
+    def info(self, message):
+        pass
+
+    def debug(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+    def log_metrics(self, **kwargs):
+        pass
+
+
+HOT_PATHS = [
+    ('output_parser', bench_output_parser),
+    ('process_results', bench_process_results),
+    ('compute', bench_compute),
+    ('findErrors', bench_find_errors),
+    ('BundleIndex', bench_bundle_index),
+    ('get_Intent_rater', bench_intent_rater),
+]
+
+
+def time_call(fn, inputs, repeats):
+    """Best wall time of `repeats` runs, the least noisy estimate on a shared machine."""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(inputs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_benchmarks(scale=100000, repeats=3, seed=0):
+    """Time every hot path on the fixed and the synthetic inputs, in seconds."""
+    results = {}
+    fixed = load_fixed_inputs()
+    results['load_npy/fixed'] = time_call(bench_load_npy, fixed, repeats)
+    results['load_compact/fixed'] = time_call(bench_load_compact, fixed, repeats)
+    for name, fn in HOT_PATHS:
+        results[f'{name}/fixed'] = time_call(fn, fixed, repeats)
+
+    synthetic = make_synthetic_inputs(scale, seed)
+    for name, fn in HOT_PATHS:
+        results[f'{name}/synthetic_{scale}'] = time_call(fn, synthetic, repeats)
+    return results
+
+
+def check_regressions(results, baseline, threshold):
+    """Return the benchmarks that got slower than `threshold` (e.g. 0.25 = 25%)."""
+    regressions = []
+    for name, seconds in results.items():
+        if name in baseline and seconds > baseline[name] * (1 + threshold):
+            regressions.append((name, baseline[name], seconds))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the CPU hot paths')
+    parser.add_argument('--scale', type=int, default=100000, help='number of synthetic sessions')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline', type=str, default=None, help='write the results to this JSON file')
+    parser.add_argument('--check', type=str, default=None, help='baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown before failing')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scale, args.repeats, args.seed)
+    for name, seconds in results.items():
+        print(f'{name:40s} {seconds * 1000:10.2f} ms')
+    for response_type, (parsed, total) in parse_success_rate(load_response_corpus()).items():
+        print(f'output_parser success rate ({response_type}): {parsed}/{total} = {parsed / max(total, 1):.1%}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'Baseline saved to {args.save_baseline}')
+
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+        regressions = check_regressions(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            print(f'REGRESSION {name}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms')
+        if regressions:
+            sys.exit(1)
+        print(f'No regression above {args.threshold:.0%}')
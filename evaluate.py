@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import time
+
+import yaml
+
+from run_all import dataset_log_path
+from utils.bundle_index import BundleIndex
+from utils.dataset import load_dataset
+from utils.evaluation import METRICS, bootstrap, load_bundle_res, session_table
+from utils.logger import Logger, logger_options
+
+
+def parse_run(run):
+    """`label=path` -> (label, path), a bare path is its own label"""
+    label, sep, path = run.partition('=')
+    return (label, path) if sep and not os.path.exists(run) else (run, run)
+
+
+parser = argparse.ArgumentParser(description='Re-evaluate the bundles of finished runs, with bootstrap confidence '
+                                             'intervals and paired comparisons, without any API call')
+parser.add_argument('runs', nargs='+', help='runs to evaluate, as [label=]path to a bundle_res.npy, run store, '
+                                            'shard predictions or run directory; the first is the baseline')
+parser.add_argument('--dataset', type=str, default='electronic')
+parser.add_argument('--resamples', type=int, default=10000, help='number of bootstrap resamples')
+parser.add_argument('--confidence', type=float, default=0.95, help='level of the confidence intervals')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--out', type=str, default=None, help='report file, temp/<dataset>/evaluation.json by default')
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+    with open('config.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+
+    logger = Logger(dataset_log_path(config['log_path'], f'{opt.dataset}_evaluate'), **logger_options(config))
+    start_time = time.time()
+    data_path = f"{config['data_path']}{opt.dataset}/"
+    temp_path = f"{config['temp_path']}{opt.dataset}/"
+    dataset = load_dataset(data_path, compact=config.get('compact_dataset', True), logger=logger)
+    test_set = dataset['test_set']
+    bundle_index = BundleIndex.from_dataset(dataset, data_path, cache_dir=temp_path, logger=logger)
+
+    runs = [parse_run(run) for run in opt.runs]
+    table = session_table(bundle_index, [load_bundle_res(path, test_set) for _, path in runs])
+    stats = bootstrap(table, n_resamples=opt.resamples, confidence=opt.confidence, seed=opt.seed)
+    logger.info(f"Evaluated {len(runs)} runs on {table['valid'].shape[0]} test sessions with {opt.resamples} "
+                f"resamples in {time.time() - start_time:.2f}s")
+
+    baseline = runs[0][0]
+    report = {'dataset': opt.dataset, 'resamples': opt.resamples, 'confidence': opt.confidence,
+              'baseline': baseline, 'runs': {}}
+    for r, (label, path) in enumerate(runs):
+        entry = {'path': path, 'valid_bundles': int(table['valid'][:, r].sum())}
+        for m, metric in enumerate(METRICS):
+            entry[metric] = float(stats['value'][m, r])
+            entry[f'{metric}_ci'] = [float(bound) for bound in stats['ci'][m, r]]
+        line = ", ".join(f"{metric}={entry[metric]:.6f} [{entry[f'{metric}_ci'][0]:.4f}, "
+                         f"{entry[f'{metric}_ci'][1]:.4f}]" for metric in METRICS)
+        logger.info(f"{label}: valid_bundles={entry['valid_bundles']}, {line}")
+        if r > 0:
+            entry[f'vs_{baseline}'] = {metric: {'diff': float(stats['diff'][m, r]),
+                                                'ci': [float(bound) for bound in stats['diff_ci'][m, r]],
+                                                'p_value': float(stats['p_value'][m, r])}
+                                       for m, metric in enumerate(METRICS)}
+            line = ", ".join(f"{metric} {res['diff']:+.6f} [{res['ci'][0]:+.4f}, {res['ci'][1]:+.4f}] "
+                             f"p={res['p_value']:.4f}" for metric, res in entry[f'vs_{baseline}'].items())
+            logger.info(f"  vs {baseline}: {line}")
+        report['runs'][label] = entry
+
+    report_path = opt.out or f'{temp_path}evaluation.json'
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, default=str)
+    logger.info(f"Report written to {report_path}")
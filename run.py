@@ -1,312 +1,181 @@
 import numpy as np
 import yaml
 from utils.ChatAPI import OpenAI, Claude
-from utils.logger import Logger
+from utils.logger import Logger, logger_options
 from utils.functions import output_parser, process_results
-from utils.metrics import findErrors, compute
+from utils.metrics import compute
+from utils.bundle_index import BundleIndex
+from utils.dataset import load_dataset
 from utils.tqdm_logger import tqdm_with_logger
+from utils.async_runner import run_sessions, stream_sessions
+from utils.cache import ResponseCache, CachedChat
+from utils.run_store import RunStore
+from utils.pipeline import SessionPipeline
+from utils.usage import current_dataset, usage_tracker
+from utils.scheduler import scheduler_registry
+from utils.transport import http_transport
+from utils.replay import ReplayChat
+from utils.context import ContextCompactor, CompactingChat
+from utils.convergence import convergence_tracker
+from utils.demo_bank import REFINEMENT_STAGES, DemoBank, demo_fingerprint, demo_savings
+from utils.batch import BatchChat, BatchRunner, LocalBatchExecutor
+from utils.stages import (self_correction, parse_bundle_result, bundle_feedback, intent_regeneration,
+                          match_related_bundles, rate_intents, generate_test_bundles)
 from prompt.prompts import PromptGenerator
-from tqdm import tqdm
 import argparse
 import os
-import re
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--dataset', type=str, default='electronic')
-opt = parser.parse_args()
-
-with open('config.yaml', 'r') as f:
-    config = yaml.safe_load(f)
-
-if __name__ == '__main__':
-
-    logger = Logger(config['log_path'])
+import time
+
+
+def configure_clients(config, logger=None, runs=1):
+    """Configure the rate-limit schedulers and the connection pool shared by every client
+
+    Args:
+        runs (int): number of experiments running at the same time in this process
+    """
+    # Calls to one model share its RPM/TPM budget, retries and adaptive concurrency limit
+    scheduler_registry.configure(rate_limits=config.get('rate_limits'),
+                                 max_concurrency=config.get('concurrency', 8) * runs,
+                                 max_retries=config.get('max_retries', 5), logger=logger)
+    # and all clients of every provider share one pool of keep-alive connections
+    http_transport.configure(pool_size=config.get('concurrency', 8) * runs,
+                             connect_timeout=config.get('connect_timeout', 10),
+                             read_timeout=config.get('read_timeout', 120))
+
+
+def open_response_cache(config):
+    """Open the response cache shared by all clients, None if caching is off"""
+    if not config.get('use_cache', True) or config.get('llm_backend', 'live') == 'replay':
+        return None
+    cache_path = config.get('cache_path', config['temp_path'] + 'llm_cache.sqlite')
+    return ResponseCache(cache_path, config.get('cache_max_size_mb', 512))
+
+
+def create_client(config, provider, model, api_key, temperature, replay_path, response_cache=None,
+                  context_compactor=None, logger=None):
+    """Create an API client, wrapped for caching, record/replay and compaction as configured"""
+    llm_backend = config.get('llm_backend', 'live')
+    if llm_backend == 'replay':
+        client = ReplayChat(provider, model, temperature, replay_path, mode='replay',
+                            latency_mean=config.get('replay_latency_mean', 0.0),
+                            latency_std=config.get('replay_latency_std', 0.0), logger=logger)
+    else:
+        # stream_completions: stop reading a completion once its JSON object is complete
+        client_class = OpenAI if provider == 'openai' else Claude
+        client = client_class(model, api_key, temperature, stream=config.get('stream_completions', False),
+                              logger=logger)
+        if provider == 'openai' and config.get('base_url'):
+            # any OpenAI-compatible endpoint, e.g. a local model server
+            client.base_url = config['base_url'].rstrip('/')
+        if response_cache:
+            client = CachedChat(client, response_cache)
+        if llm_backend == 'record':
+            client = ReplayChat(provider, model, temperature, replay_path, mode='record', client=client,
+                                logger=logger)
+    if context_compactor:
+        # outermost, so cache and replay keys are taken on the compacted request
+        client = CompactingChat(client, context_compactor)
+    return client
+
+
+def run_experiment(dataset_name, opt, config, logger=None, response_cache=None, test_ids=None, run_path=None):
+    """Run the whole pipeline on one dataset
+
+    Args:
+        dataset_name (str): dataset directory under `data_path`, e.g. 'electronic'
+        opt: parsed command line options (`stream`, `resume`, `batch`)
+        logger: Logger of this run, created from `log_path` when not given
+        response_cache: ResponseCache to share with other runs, opened from the config when not given
+        test_ids (list): run only these test sessions, e.g. one shard, instead of the whole test set
+        run_path (str): directory of the run store, usage and stage outputs, the dataset temp dir when not given
+
+    Returns:
+        dict with the dataset, its precision, recall and coverage, the number of
+        valid bundles, the run time, an error message if the run failed and the
+        filtered bundles per test session
+    """
+    start_time = time.time()
+    # usage records and convergence counts of this run are tagged with the dataset
+    current_dataset.set(dataset_name)
+    if logger is None:
+        logger = Logger(config['log_path'], **logger_options(config))
     
     # Log experiment configuration
     logger.log_experiment_config(config)
-    logger.info(f"Starting bundle generation experiment for dataset: {opt.dataset}")
+    logger.info(f"Starting bundle generation experiment for dataset: {dataset_name}")
     
-    data_path = config['data_path']+opt.dataset+'/'
-    temp_path = config['temp_path']+opt.dataset+'/'
+    data_path = config['data_path']+dataset_name+'/'
+    temp_path = config['temp_path']+dataset_name+'/'
+    run_path = run_path or temp_path
+    if not os.path.exists(run_path):
+        os.makedirs(run_path)
     
     logger.info(f"Loading data from: {data_path}")
-    train_set = np.load(f'{data_path}training_set.npy', allow_pickle=True).item()
-    test_set = np.load(f'{data_path}test_set.npy', allow_pickle=True).item()
-    k_neareast_sessions = np.load(f'{data_path}TopK_related_sessions.npy', allow_pickle=True).item()
-    session_items = np.load(f'{data_path}session_items.npy', allow_pickle=True).item()
-    session_bundles = np.load(f'{data_path}session_bundles_deduplication.npy', allow_pickle=True).item()
-    all_item_titles = np.load(f'{data_path}item_titles.npy', allow_pickle=True).item()
+    # memory-mapped tables decoded on access, set compact_dataset: false to unpickle the .npy dicts instead
+    dataset = load_dataset(data_path, compact=config.get('compact_dataset', True), logger=logger)
+    train_set = dataset['training_set']
+    test_set = dataset['test_set']
+    if test_ids is not None:
+        test_set = {test_id: test_set[test_id] for test_id in test_ids}
+    k_neareast_sessions = dataset['TopK_related_sessions']
+    session_items = dataset['session_items']
+    session_bundles = dataset['session_bundles_deduplication']
+    all_item_titles = dataset['item_titles']
+    bundle_index = BundleIndex.from_dataset(dataset, data_path, cache_dir=temp_path, logger=logger)
     
     logger.info(f"Data loaded successfully - Train: {len(train_set)}, Test: {len(test_set)}")
 
+    # Record every session result as soon as it is produced, so a crash only costs unfinished work
+    run_store = RunStore(f'{run_path}run_store.sqlite', resume=opt.resume)
+    logger.info(f"Run store: {run_path}run_store.sqlite (resume={opt.resume})")
+
+    # Cache completions on disk so re-runs do not pay for identical requests again
+    llm_backend = config.get('llm_backend', 'live')  # 'live', 'record' or 'replay'
+    replay_path = config.get('replay_path', f'{temp_path}replay.jsonl')
+    if response_cache is None:
+        response_cache = open_response_cache(config)
+    if response_cache:
+        logger.info(f"Response cache enabled: {config.get('cache_path', config['temp_path'] + 'llm_cache.sqlite')}")
+    if llm_backend != 'live':
+        logger.info(f"LLM backend: {llm_backend} ({replay_path})")
+
+    # Fit every request into max_context_length tokens by dropping superseded turns, off when not set
+    context_compactor = None
+    if config.get('max_context_length'):
+        context_compactor = ContextCompactor(config['max_context_length'], config.get('context_keep_recent', 1))
+        logger.info(f"Context compaction enabled: {config['max_context_length']} tokens per request")
+
+    def build_client(provider, model, api_key, temperature):
+        return create_client(config, provider, model, api_key, temperature, replay_path, response_cache,
+                             context_compactor, logger)
+
+    def save_usage():
+        """Write the API usage (and context sizes when compaction is on) to the temp dir, log the calls saved"""
+        usage_tracker.save(f'{run_path}usage.json', dataset=dataset_name)
+        if context_compactor:
+            context_compactor.save(f'{run_path}context_sizes.json')
+            logger.log_metrics(**context_compactor.stats())
+        for stage, stats in convergence_tracker.summary(dataset=dataset_name).items():
+            logger.info(f"{stage}: {stats['stopped_early']}/{stats['sessions']} sessions converged early, "
+                        f"{stats['saved_calls']} LLM calls saved")
+
+    def experiment_result(precision, recall, coverage, predictions, error=None):
+        return {'dataset': dataset_name, 'precision': precision, 'recall': recall, 'coverage': coverage,
+                'total_test_sessions': len(test_set), 'valid_bundles': len(predictions),
+                'elapsed': round(time.time() - start_time, 3), 'error': error, 'demonstrations': demo_stats,
+                'predictions': predictions}
+
     # Create a new OpenAI instance
-    chat = OpenAI(config['model'], config['api_key'], config['temperature'])
+    chat = build_client('openai', config['model'], config['api_key'], config['temperature'])
     logger.info(f"Initialized chat model: {config['model']}")
     
     # Create a new prompt generator
     prompt_generator = PromptGenerator(session_items, session_bundles)
     logger.info("Prompt generator initialized")
 
-    # Construct meta info for training sessions
-    prompt_generated_bundles = {} 
-
-    for test_id in test_set.keys():
-        topk_session_idx = k_neareast_sessions[test_id][0]  # consider top-1 related session
-        item_titles = train_set[topk_session_idx]
-        idx_item_titles = {}
-        for idx, item_title in enumerate(item_titles.split('|')):
-            idx_item = "product" + str(idx+1)
-            idx_item_titles[idx_item] = item_title
-
-        prompt = prompt_generator.get_Intents_generated_bundles(str(idx_item_titles))
-        prompt_generated_bundles[test_id] = (topk_session_idx, prompt)
-
-    logger.info('Start generating bundles with self-correction...')
-    self_correction_res = {}
-    max_iter = config.get('self_correction_max_iter', 2)  # Default to 2 if not specified
-    
-    for test_id, (topk_session_idx, prompt) in tqdm_with_logger(prompt_generated_bundles.items(), 
-                                                                logger=logger, 
-                                                                desc="Self-correction"):
-        message = [{"role": "user", "content": prompt}]
-        init_res = chat.create_chat_completion(message)
-        message.append({"role": "assistant", "content": init_res})
-        
-        for i in range(max_iter):
-            message.append({"role": "user", "content": prompt_generator.get_Self_correction(i)})
-            intent_res = chat.create_chat_completion(message)
-            message.append({"role": "assistant", "content": intent_res})
-            
-            # Early stop if the bundle is not changed and we've done at least 1 iteration
-            if i >= 1 and init_res == intent_res:
-                logger.debug(f"Early stop for test_id {test_id} at iteration {i}")
-                break
-                
-        self_correction_res[test_id] = (topk_session_idx, message)
-
-    np.save(f'{temp_path}self_correction_res.npy', self_correction_res, allow_pickle=True)
-    logger.info(f"Self-correction completed. Results saved for {len(self_correction_res)} test sessions.")
-
-    parsered_res = dict()
-    for test_id, (topk_session_idx, message) in tqdm_with_logger(self_correction_res.items(), 
-                                                                 logger=logger, 
-                                                                 desc="Parsing results"):
-        bundle_str = None
-        
-        # More flexible parsing based on actual message structure
-        # The last assistant message should contain the final bundle result
-        for i in range(len(message) - 1, -1, -1):
-            if message[i]['role'] == 'assistant':
-                # Check if this looks like a bundle result (contains 'bundle' and brackets)
-                content = message[i]['content'].replace('\n', '')
-                if 'bundle' in content.lower() and ('{' in content or '[' in content):
-                    bundle_str = content
-                    break
-        
-        if not bundle_str:
-            logger.warning(f'No valid bundle result found for test_id: {test_id}')
-            continue
-            
-        if bundle_str:
-            output_parser_res = output_parser(bundle_str)
-            if output_parser_res['state_code'] == 404:
-                logger.warning(f'Error when parsing test_id: {test_id}')
-                continue
-            elif output_parser_res['state_code'] == 200:
-                bundle_dict = output_parser_res['output']
-                parsered_res[test_id] = (topk_session_idx, bundle_dict)
-
-    np.save(f'{temp_path}parsered_res.npy', parsered_res, allow_pickle=True)
-    logger.info(f"Parsing completed. {len(parsered_res)} results parsed successfully.")
-    
-    logger.info('Start generating bundle feedback...')
-    feedback_res = {}
-    N_iter = config['feedback_iteration']
-    
-    for test_id, value in tqdm_with_logger(parsered_res.items(), 
-                                          logger=logger, 
-                                          desc="Bundle feedback"):
-        topk_session_idx, bundle_dict = value
-        Is_hallucination = False
-        context = self_correction_res[test_id][1].copy()
-        # iterately generate feedback for N times
-        for iteration in range(N_iter):
-            error_dict = findErrors(topk_session_idx, bundle_dict, session_bundles, session_items)
-            if 0 in error_dict and len(error_dict)==1:
-                feedback_res[test_id] = self_correction_res[test_id]
-                logger.debug(f"No errors found for test_id {test_id}")
-                break
-            elif 5 in error_dict:
-                # hallucination
-                Is_hallucination = True
-                logger.warning(f"Hallucination detected for test_id {test_id}")
-                break      
-            else:
-                # Get the prompt
-                feedback_prompt = prompt_generator.get_Feedback('bundle', error_dict)
-                context.append({"role": "user", "content": feedback_prompt})
-                # Create a new chat completion
-                reply_str = chat.create_chat_completion(context)
-                context.append({"role": "assistant", "content": reply_str})
-                output_parser_res = output_parser(reply_str)
-                if output_parser_res['state_code'] == 200:
-                    bundle_dict = output_parser_res['output']
-                    logger.debug(f"Applied feedback for test_id {test_id}, iteration {iteration}")
-        if not Is_hallucination:
-            feedback_res[test_id] = (topk_session_idx, context)
-
-    np.save(f'{temp_path}feedback_res.npy', feedback_res, allow_pickle=True)
-    logger.info(f"Bundle feedback completed. {len(feedback_res)} sessions processed.")
-
-    logger.info('Start generating intent feedback...')
-
-    # Generate intent for matched bundles
-    intent_context = {}
-
-    for test_id, (topk_session_idx, context) in tqdm_with_logger(feedback_res.items(), 
-                                                                 logger=logger, 
-                                                                 desc="Intent feedback"):
-        # Check if feedback was applied by looking for feedback prompts in the context
-        has_feedback = any("error" in msg.get("content", "").lower() or 
-                          "feedback" in msg.get("content", "").lower() 
-                          for msg in context if msg.get("role") == "user")
-        
-        if not has_feedback:  # no feedback was applied
-            intent_context[test_id] = (topk_session_idx, context)
-            continue
-            
-        append_intent_context = context.copy()
-        append_intent_context.append({"role": "user", "content": prompt_generator.get_Self_correction(2)})  # Use the intent regeneration prompt
-        intent_str = chat.create_chat_completion(append_intent_context)
-        append_intent_context.append({"role": "assistant", "content": intent_str})
-        intent_context[test_id] = (topk_session_idx, append_intent_context)
-    
-    np.save(f'{temp_path}intent_context.npy', intent_context, allow_pickle=True)
-    logger.info(f"Intent context generation completed. {len(intent_context)} sessions processed.")
-
-    intent_related_bundles = {}
-    for test_id, (topk_session_idx, context) in intent_context.items():
-        # Find the most recent bundle result by looking backwards through messages
-        bundle_content = None
-        intent_content = None
-        
-        # Look for the last assistant messages that contain bundle and intent data
-        for i in range(len(context) - 1, -1, -1):
-            if context[i]['role'] == 'assistant':
-                content = context[i]['content']
-                # Check if this looks like an intent result (after bundle feedback)
-                if intent_content is None and ('intent' in content.lower() or 
-                                             ('{' in content and any(key in content.lower() for key in ['bundle', '1', '2', '3']))):
-                    # Try to parse as intent first
-                    intent_test = output_parser(content, type='intent')
-                    if intent_test['state_code'] == 200:
-                        intent_content = content
-                        continue
-                
-                # Check if this looks like a bundle result  
-                if bundle_content is None and ('bundle' in content.lower() and ('{' in content or '[' in content)):
-                    bundle_test = output_parser(content)
-                    if bundle_test['state_code'] == 200:
-                        bundle_content = content
-                        
-                # Stop if we found both
-                if bundle_content and intent_content:
-                    break
-        
-        # Fallback: use the last two assistant messages if we can't find specific content
-        if not bundle_content or not intent_content:
-            assistant_messages = [msg['content'] for msg in context if msg['role'] == 'assistant']
-            if len(assistant_messages) >= 2:
-                if not bundle_content:
-                    bundle_content = assistant_messages[-2]  # Second to last
-                if not intent_content:
-                    intent_content = assistant_messages[-1]   # Last
-            elif len(assistant_messages) == 1:
-                # Only one message, try to use it for both
-                bundle_content = intent_content = assistant_messages[0]
-        
-        if not bundle_content:
-            logger.warning(f'No bundle content found for test_id: {test_id}')
-            continue
-            
-        bundle_res = output_parser(bundle_content)
-        intent_res = output_parser(intent_content or bundle_content, type='intent')
-        items_session = session_items[topk_session_idx].split(',')
-        ground_truth_bundles = session_bundles[topk_session_idx]
-
-        if bundle_res['state_code'] == 404:
-            logger.warning(f'Error when parsing bundle for test_id: {test_id}')
-            continue
-        elif bundle_res['state_code'] == 200:
-            bundle_dict = bundle_res['output']
-            intent_dict = intent_res['output'] if intent_res['state_code'] == 200 else {}
-            related_bundles = []
-            for bundle_id, items in bundle_dict.items():
-                if len(items) < 2:
-                    # logger.warning(f'Empty result in test_id: {test_id}')
-                    continue
-                
-                # Improved item extraction logic
-                reidx_items = set()
-                for item in items:
-                    # Extract the product number using regex
-                    import re
-                    match = re.search(r'product(\d+)', item)
-                    if match:
-                        product_num = int(match.group(1))
-                        if 0 < product_num <= len(items_session):
-                            reidx_items.add(items_session[product_num-1])
-                    else:
-                        # Log warning for unexpected item format
-                        logger.warning(f"Unexpected item format: {item} in test_id: {test_id}")
-                
-                if not reidx_items:
-                    continue
-                    
-                for gdbundle in ground_truth_bundles:
-                    bundle_list = set(gdbundle[-1].split(','))
-                    if reidx_items <= bundle_list:
-                        # Check if bundle_id exists in intent_dict, use a default value if not
-                        intent_text = "No intent provided"
-                        
-                        # Try different formats to find the intent
-                        if bundle_id in intent_dict:
-                            intent_text = intent_dict[bundle_id]
-                        elif bundle_id.lower() in intent_dict:
-                            intent_text = intent_dict[bundle_id.lower()]
-                        elif f"bundle{bundle_id}" in intent_dict:  # Try 'bundle1', 'bundle2', etc.
-                            intent_text = intent_dict[f"bundle{bundle_id}"]
-                        elif f"Bundle {bundle_id}" in intent_dict:  # Try 'Bundle 1', 'Bundle 2', etc.
-                            intent_text = intent_dict[f"Bundle {bundle_id}"]
-                        # Try numerical matches if the ID might be a number
-                        elif bundle_id.isdigit() and f"bundle{bundle_id}" in intent_dict:
-                            intent_text = intent_dict[f"bundle{bundle_id}"]
-                        elif bundle_id.isdigit() and f"Bundle {bundle_id}" in intent_dict:
-                            intent_text = intent_dict[f"Bundle {bundle_id}"]
-                        # Try fallbacks with just the bundle part
-                        elif "bundle" + bundle_id.lstrip("bundle") in intent_dict:  
-                            intent_text = intent_dict["bundle" + bundle_id.lstrip("bundle")]
-                        else:
-                            # If we can't find a match, log a warning and use a default intent
-                            logger.warning(f"Missing intent for bundle_id: {bundle_id} in test_id: {test_id}")
-                            
-                        if 'bundle' in bundle_id and len(bundle_id) < 10:
-                            related_bundles.append((','.join(list(reidx_items)), intent_text, gdbundle[-1], gdbundle[0]))
-                        else: # intent:bundle
-                            related_bundles.append((','.join(list(reidx_items)), bundle_id, gdbundle[-1], gdbundle[0]))
-                        break
-            if len(related_bundles) != 0:
-                intent_related_bundles[test_id] = (topk_session_idx, related_bundles)
-
-    # Generate intent feedback
-    intent_feedback_generation = prompt_generator.get_Intent_rater(intent_related_bundles, all_item_titles)
-    np.save(f'{temp_path}intent_feedback_generation.npy', intent_feedback_generation, allow_pickle=True)
-
-    logger.info('Rating for generated intent...')
-
-    intent_feedback_res = {}
-    intent_rater_models = config.get('intent_raters', [])
+    # the raters are only called by the intent rating stage, which is off unless `intent_rating` is set
+    intent_rating = config.get('intent_rating', False)
+    intent_rater_models = config.get('intent_raters', []) if intent_rating else []
     
     def validate_model_config(model_config):
         """Validate model configuration and provide fallbacks if needed"""
@@ -344,7 +213,8 @@ if __name__ == '__main__':
         validated_config = validate_model_config(rate_model)
         try:
             if 'openai' in validated_config:
-                rater = OpenAI(
+                rater = build_client(
+                    'openai',
                     validated_config['openai']['model'], 
                     validated_config['openai']['api_key'], 
                     validated_config['openai'].get('temperature', 0)
@@ -353,7 +223,8 @@ if __name__ == '__main__':
                 has_valid_rater = True
                 logger.info(f"Initialized OpenAI rater: {validated_config['openai']['model']}")
             elif 'claude' in validated_config:
-                rater = Claude(
+                rater = build_client(
+                    'claude',
                     validated_config['claude']['model'], 
                     validated_config['claude']['api_key'], 
                     validated_config['claude'].get('temperature', 0)
@@ -367,146 +238,244 @@ if __name__ == '__main__':
             logger.error(f"Failed to initialize rater: {str(e)}")
     
     # If no valid raters, use the main model as a fallback
-    if not has_valid_rater:
+    if intent_rating and not has_valid_rater:
         logger.warning("No valid intent raters configured, using main model as fallback")
         intent_raters = [chat]  # Use the main chat model as fallback
+
+    # Construct meta info for training sessions
+    # consider top-1 related session
+    related_session = {test_id: k_neareast_sessions[test_id][0] for test_id in test_set.keys()}
+
+    def related_session_prompt(topk_session_idx):
+        item_titles = train_set[topk_session_idx]
+        idx_item_titles = {}
+        for idx, item_title in enumerate(item_titles.split('|')):
+            idx_item = "product" + str(idx+1)
+            idx_item_titles[idx_item] = item_title
+        return prompt_generator.get_Intents_generated_bundles(str(idx_item_titles))
+
+    def session_prompts():
+        for test_id in test_set.keys():
+            topk_session_idx = related_session[test_id]
+            yield test_id, (topk_session_idx, related_session_prompt(topk_session_idx))
+
+    # Demonstrations only depend on the related session: refine each one once and keep it for later runs
+    demo_bank = None
+    banked = {}
+    if config.get('demo_bank', True):
+        demo_bank = DemoBank(f'{temp_path}demo_bank.sqlite', demo_fingerprint(config))
+        banked = demo_bank.load()
+    demo_stats = {}
+
+    concurrency = config.get('concurrency', 8)  # number of sessions sent to the API at the same time
+
+    batch_runner = None
+    if opt.batch:
+        # every stage turn becomes one JSONL batch file, processed by a local worker pool over the same clients
+        batch_executor = LocalBatchExecutor([chat] + intent_raters, concurrency=concurrency)
+        batch_runner = BatchRunner(batch_executor, f'{run_path}batches/', logger=logger)
+        chat = BatchChat(chat, batch_runner)
+        intent_raters = [BatchChat(rater, batch_runner) for rater in intent_raters]
+        logger.info(f"Batch mode: batch files are written to {run_path}batches/")
+
+    if opt.stream:
+        # every session flows through the whole chain and is scored as soon as it completes
+        logger.info('Start streaming test sessions through the pipeline...')
+        session_pipeline = SessionPipeline(chat, intent_raters, prompt_generator, test_set, session_items,
+                                           session_bundles, all_item_titles, config, logger, bundle_index,
+                                           demo_bank=demo_bank, banked=banked)
+        format_res = {}
+        for test_id, bundles in stream_sessions(session_prompts(), session_pipeline, concurrency=concurrency,
+                                                logger=logger, desc="Streaming sessions", total=len(test_set),
+                                                store=run_store):
+            # remove the bundles containing only 1 product
+            format_bundles = {bid: items for bid, items in bundles.items() if len(items) > 1}
+            if not format_bundles:
+                logger.debug(f"Only single-product bundles for test_id: {test_id}")
+                continue
+            format_res[test_id] = format_bundles
+            precision, recall, _ = compute(session_items, session_bundles, {test_id: format_bundles},
+                                           index=bundle_index)
+            logger.debug(f"Scored test_id {test_id}: precision={precision:.4f}, recall={recall:.4f}")
+
+        session_pipeline.record_demos(dataset=dataset_name)
+        demo_stats.update(demo_savings(session_pipeline.related_session, session_pipeline.demo_calls,
+                                       refined=session_pipeline.refined, reused=session_pipeline.reused))
+        logger.log_metrics(**demo_stats)
+        if response_cache:
+            logger.log_metrics(**response_cache.stats())
+        if len(format_res) == 0:
+            logger.error("No valid bundles after filtering! All bundles contain only 1 product.")
+            save_usage()
+            logger.log_final_results(0.0, 0.0, 0.0, usage_summary=usage_tracker.summary(dataset=dataset_name), error="No valid bundles")
+            return experiment_result(0.0, 0.0, 0.0, format_res, error="No valid bundles")
+
+        session_precision, session_recall, coverage = compute(session_items, session_bundles, format_res,
+                                                              index=bundle_index)
+        save_usage()
+        logger.log_final_results(session_precision, session_recall, coverage,
+                               usage_summary=usage_tracker.summary(dataset=dataset_name),
+                               total_test_sessions=len(test_set),
+                               valid_bundles=len(format_res),
+                               model=config['model'],
+                               dataset=dataset_name)
+        return experiment_result(session_precision, session_recall, coverage, format_res)
+
+    related_sessions = list(dict.fromkeys(related_session.values()))
+    # from here on every stage is keyed by the related session instead of the test session
+    prompt_generated_bundles = {session_idx: (session_idx, related_session_prompt(session_idx))
+                                for session_idx in related_sessions if session_idx not in banked}
+    logger.info(f"{len(test_set)} test sessions share {len(related_sessions)} related sessions, "
+                f"{len(related_sessions) - len(prompt_generated_bundles)} demonstrations reused from the demo bank")
+
+    logger.info('Start generating bundles with self-correction...')
+    max_iter = config.get('self_correction_max_iter', 2)  # Default to 2 if not specified
+
+    async def self_correction_worker(session_idx, value):
+        topk_session_idx, prompt = value
+        message = await self_correction(chat, prompt_generator, prompt, max_iter, logger, session_idx, topk_session_idx,
+                                        session_bundles, session_items, bundle_index)
+        return (topk_session_idx, message)
+
+    self_correction_res = run_sessions(prompt_generated_bundles.items(), self_correction_worker,
+                                       concurrency=concurrency, logger=logger, desc="Self-correction", store=run_store,
+                                       batcher=batch_runner)
+
+    np.save(f'{run_path}self_correction_res.npy', self_correction_res, allow_pickle=True)
+    logger.info(f"Self-correction completed. Results saved for {len(self_correction_res)} test sessions.")
+
+    parsered_res = dict()
+    for session_idx, (topk_session_idx, message) in tqdm_with_logger(self_correction_res.items(), 
+                                                                 logger=logger, 
+                                                                 desc="Parsing results"):
+        bundle_dict = parse_bundle_result(message, logger, session_idx)
+        if bundle_dict is not None:
+            parsered_res[session_idx] = (topk_session_idx, bundle_dict)
+
+    np.save(f'{run_path}parsered_res.npy', parsered_res, allow_pickle=True)
+    logger.info(f"Parsing completed. {len(parsered_res)} results parsed successfully.")
     
-    for test_id, (topk_session_idx, related_bundles) in tqdm_with_logger(intent_related_bundles.items(),
-                                                                         logger=logger,
-                                                                         desc="Rating intents"):
-        # Skip if no related bundles
-        if not related_bundles:
-            logger.warning(f"No related bundles for test_id: {test_id}")
-            continue
-            
-        try:
-            metric_scores = []
-            
-            for rater in intent_raters:
-                message = [{"role": "user", "content": intent_feedback_generation[test_id]}]
-                # Rate based on config parameter
-                rating_repeats = config.get('intent_rating_repeats', 1)  # Default to 1 if not specified
-                scores_res = {}
-                
-                for attempt in range(rating_repeats):
-                    try:
-                        intent_feedback_str = rater.create_chat_completion(message)
-                        # Add debugging output
-                        logger.debug(f"Raw intent feedback for test_id {test_id}: {intent_feedback_str[:100]}...")
-                        
-                        intent_res = output_parser(intent_feedback_str, type='intent')['output']
-                        
-                        # Skip if the result is empty or malformed
-                        if not intent_res:
-                            logger.warning(f"Empty intent result for test_id: {test_id}")
-                            continue
-                            
-                        for idx, (bid, intent) in enumerate(intent_res.items()):
-                            if idx not in scores_res:
-                                scores_res[idx] = [np.array([0,0,0]), np.array([0,0,0])]
-                            
-                            # Check if intent is a dictionary before accessing keys
-                            if not isinstance(intent, dict):
-                                logger.warning(f"Intent for bundle {bid} is not a dictionary: {intent}")
-                                # Try to convert list to dict if it's a list of scores
-                                if isinstance(intent, list) and all(isinstance(x, (int, float)) for x in intent):
-                                    # Convert direct score list to proper format
-                                    logger.warning(f"Converting score list to dict: {intent}")
-                                    scores_res[idx][0] += np.array(intent)
-                                    continue
-                                elif isinstance(intent, str):
-                                    # Skip string intents (they're not scores)
-                                    continue
-                            
-                            try:    
-                                key_list = list(intent.keys())
-                                
-                                # Process different return formats
-                                if len(key_list) >= 2:
-                                    # Standard case: two intent keys
-                                    try:
-                                        scores_res[idx][0] += np.array([int(i) for i in intent[key_list[0]]])
-                                        scores_res[idx][1] += np.array([int(i) for i in intent[key_list[1]]])
-                                    except (ValueError, TypeError) as e:
-                                        logger.warning(f"Error converting scores: {e}, values: {intent[key_list[0]]}, {intent[key_list[1]]}")
-                                        
-                                elif len(key_list) == 1:
-                                    # Only one intent key, assume it's the first intent
-                                    try:
-                                        scores_res[idx][0] += np.array([int(i) for i in intent[key_list[0]]])
-                                        # Second intent remains 0
-                                    except (ValueError, TypeError) as e:
-                                        logger.warning(f"Error converting scores: {e}, value: {intent[key_list[0]]}")
-                                else:
-                                    # No intent keys, skip
-                                    logger.warning(f"No intent keys found for bundle {bid}")
-                            except AttributeError:
-                                logger.warning(f"Invalid intent object for bundle {bid}: {intent}")
-                                
-                    except Exception as e:
-                        logger.error(f"Error during intent rating attempt {attempt}: {str(e)}")
-                
-                if scores_res:  # Only append if we have valid scores
-                    metric_scores.append(scores_res)
-            
-            # Only proceed if we have valid metrics
-            if len(metric_scores) > 0:
-                # Average across all raters and attempts
-                final_scores = {}
-                num_raters = len(metric_scores)
-                rating_repeats = config.get('intent_rating_repeats', 1)
-                
-                for scores_dict in metric_scores:
-                    for idx, (score1, score2) in scores_dict.items():
-                        if idx not in final_scores:
-                            final_scores[idx] = [np.array([0.0, 0.0, 0.0]), np.array([0.0, 0.0, 0.0])]
-                        final_scores[idx][0] += score1 / (num_raters * rating_repeats)
-                        final_scores[idx][1] += score2 / (num_raters * rating_repeats)
-                
-                intent_feedback_res[test_id] = (topk_session_idx, related_bundles, final_scores)
-                logger.debug(f"Processed intent feedback for test_id {test_id} with {len(final_scores)} bundles")
-            else:
-                logger.warning(f"No valid metrics for test_id: {test_id}, using original context")
-                # Fallback to original context without feedback
-                intent_feedback_res[test_id] = intent_context[test_id]
-            
-        except Exception as e:
-            logger.error(f"Error processing test_id {test_id}: {str(e)}")
+    logger.info('Start generating bundle feedback...')
+    N_iter = config['feedback_iteration']
+
+    async def bundle_feedback_worker(session_idx, value):
+        topk_session_idx, bundle_dict = value
+        context = await bundle_feedback(chat, prompt_generator, topk_session_idx, bundle_dict,
+                                        self_correction_res[session_idx][1], N_iter,
+                                        session_bundles, session_items, logger, session_idx, bundle_index)
+        if context is None:
+            return None
+        return (topk_session_idx, context)
+
+    feedback_res = run_sessions(parsered_res.items(), bundle_feedback_worker,
+                                concurrency=concurrency, logger=logger, desc="Bundle feedback", store=run_store,
+                                batcher=batch_runner)
+
+    np.save(f'{run_path}feedback_res.npy', feedback_res, allow_pickle=True)
+    logger.info(f"Bundle feedback completed. {len(feedback_res)} sessions processed.")
+
+    logger.info('Start generating intent feedback...')
+
+    # Generate intent for matched bundles
+    async def intent_feedback_worker(session_idx, value):
+        topk_session_idx, context = value
+        return (topk_session_idx, await intent_regeneration(chat, prompt_generator, context))
+
+    intent_context = run_sessions(feedback_res.items(), intent_feedback_worker,
+                                  concurrency=concurrency, logger=logger, desc="Intent feedback", store=run_store,
+                                  batcher=batch_runner)
     
-    np.save(f'{temp_path}intent_feedback_res.npy', intent_feedback_res, allow_pickle=True)
-    logger.info(f"Intent feedback completed. {len(intent_feedback_res)} sessions processed.")
+    np.save(f'{run_path}intent_context.npy', intent_context, allow_pickle=True)
+    logger.info(f"Intent context generation completed. {len(intent_context)} sessions processed.")
+
+    # the rating scores are saved for inspection only, they change neither the demonstrations nor the test
+    # prompts, so the stage only runs when it is asked for
+    if intent_rating:
+        intent_related_bundles = {}
+        for session_idx, (topk_session_idx, context) in intent_context.items():
+            related_bundles = match_related_bundles(topk_session_idx, context, session_items,
+                                                    session_bundles, logger, session_idx, bundle_index)
+            if related_bundles is not None:
+                intent_related_bundles[session_idx] = (topk_session_idx, related_bundles)
+
+        # Generate intent feedback
+        intent_feedback_generation = prompt_generator.get_Intent_rater(intent_related_bundles, all_item_titles)
+        np.save(f'{run_path}intent_feedback_generation.npy', intent_feedback_generation, allow_pickle=True)
+
+        logger.info('Rating for generated intent...')
+
+        rating_repeats = config.get('intent_rating_repeats', 1)  # Default to 1 if not specified
+        # stop rating once this many responses agree within rating_tolerance, None waits for every call
+        rating_quorum = config.get('rating_quorum')
+        rating_tolerance = config.get('rating_tolerance', 0)
+
+        async def rating_worker(session_idx, value):
+            topk_session_idx, related_bundles = value
+            # Skip if no related bundles
+            if not related_bundles:
+                logger.warning(f"No related bundles for session_idx: {session_idx}")
+                return None
+
+            try:
+                final_scores = await rate_intents(intent_raters, intent_feedback_generation[session_idx],
+                                                  rating_repeats, logger, session_idx, rating_quorum,
+                                                  rating_tolerance)
+                if final_scores is None:
+                    logger.warning(f"No valid metrics for session_idx: {session_idx}, using original context")
+                    # Fallback to original context without feedback
+                    return intent_context[session_idx]
+                logger.debug(f"Processed intent feedback for session_idx {session_idx} "
+                             f"with {len(final_scores)} bundles")
+                return (topk_session_idx, related_bundles, final_scores)
+            except Exception as e:
+                logger.error(f"Error processing session_idx {session_idx}: {str(e)}")
+                return None
+
+        intent_feedback_res = run_sessions(intent_related_bundles.items(), rating_worker,
+                                           concurrency=concurrency, logger=logger, desc="Rating intents",
+                                           store=run_store, batcher=batch_runner)
+    
+        np.save(f'{run_path}intent_feedback_res.npy', intent_feedback_res, allow_pickle=True)
+        logger.info(f"Intent feedback completed. {len(intent_feedback_res)} sessions processed.")
+    else:
+        logger.info('Intent rating is off, skipping the rating stage')
+
+    # the refined demonstration of every related session, fanned out to the test sessions sharing it
+    refinement_calls = usage_tracker.calls_per_test_id(REFINEMENT_STAGES, dataset=dataset_name)
+    failed_calls = usage_tracker.calls_per_test_id(REFINEMENT_STAGES, dataset=dataset_name, failed=True)
+    # dropped sessions are banked as None
+    demos = {session_idx: demo for session_idx, (demo, _) in banked.items() if demo is not None}
+    demo_calls = {session_idx: calls for session_idx, (_, calls) in banked.items()}
+    for session_idx in prompt_generated_bundles:
+        demo_calls[session_idx] = refinement_calls[str(session_idx)]
+    # rated sessions are prompted with their intent context as well, as in --stream; their
+    # (session, related bundles, scores) results cannot be unpacked as a context
+    demos.update(intent_context)
+    if demo_bank:
+        # a session refinement dropped is not refined again, unless a failed call may have dropped it
+        demo_bank.record({session_idx: (intent_context.get(session_idx), demo_calls[session_idx])
+                          for session_idx in prompt_generated_bundles
+                          if session_idx in intent_context or not failed_calls[str(session_idx)]})
+    demo_stats.update(demo_savings(related_session, demo_calls, refined=prompt_generated_bundles,
+                                   reused=[session_idx for session_idx in related_sessions if session_idx in banked]))
+    logger.log_metrics(**demo_stats)
 
     logger.info('Start generating bundles for test sessions...')
-    # merge all sessions
-    merged_context = {}
-    for test_id, (topk_session_idx, context) in tqdm_with_logger(intent_context.items(), 
-                                                                 logger=logger, 
-                                                                 desc="Merging contexts"):
-        if test_id in intent_feedback_res:
-            merged_context[test_id] = intent_feedback_res[test_id]
-        else:
-            merged_context[test_id] = intent_context[test_id]
-
-    All_context = {}
-    for test_id, (topk_session_idx, context) in tqdm_with_logger(merged_context.items(), 
-                                                                 logger=logger, 
-                                                                 desc="Generating test bundles"):
-        test_context = context.copy()
-        test_context.append({"role": "user", "content": "Based on conversations above, which rules do you find when detecting bundles?"})
-        rule_str = chat.create_chat_completion(test_context)
-        test_context.append({"role": "assistant", "content": rule_str})
-
-        test_prompt = prompt_generator.get_test_prompts(test_set[test_id])
-        test_context.append({"role": "user", "content": test_prompt})
-        test_str = chat.create_chat_completion(test_context)
-        test_context.append({"role": "assistant", "content": test_str})
-        test_context.append({"role": "user", "content": "Please use 3 to 5 words to generate intents behind the detected bundles, the output format is: {'bundle number':'intent'}"})
-        intent_str = chat.create_chat_completion(test_context)
-        test_context.append({"role": "assistant", "content": intent_str})
-        
-        All_context[test_id] = (topk_session_idx, test_context)
+    merged_context = {test_id: demos[related_session[test_id]] for test_id in test_set.keys()
+                      if related_session[test_id] in demos}
+
+    async def test_bundle_worker(test_id, value):
+        topk_session_idx, context = value
+        test_context = await generate_test_bundles(chat, prompt_generator, context, test_set[test_id])
+        return (topk_session_idx, test_context)
+
+    All_context = run_sessions(merged_context.items(), test_bundle_worker,
+                               concurrency=concurrency, logger=logger, desc="Generating test bundles", store=run_store,
+                               batcher=batch_runner)
 
     logger.info(f"Test bundle generation completed. {len(All_context)} sessions processed.")
+    if response_cache:
+        logger.log_metrics(**response_cache.stats())
 
     logger.info('Evaluating the generated bundles...')
     bundle_res = {}
@@ -521,7 +490,7 @@ if __name__ == '__main__':
             continue 
         bundle_res[test_id] = parsered_res['output']
 
-    np.save(f'{temp_path}bundle_res.npy', bundle_res, allow_pickle=True)
+    np.save(f'{run_path}bundle_res.npy', bundle_res, allow_pickle=True)
     logger.info(f"Bundle evaluation completed. {len(bundle_res)} bundles generated.")
 
     # remove the bundles containing only 1 product
@@ -531,22 +500,39 @@ if __name__ == '__main__':
     
     if len(format_res) == 0:
         logger.error("No valid bundles after filtering! All bundles contain only 1 product.")
-        logger.log_final_results(0.0, 0.0, 0.0, error="No valid bundles")
-        exit(1)
+        save_usage()
+        logger.log_final_results(0.0, 0.0, 0.0, usage_summary=usage_tracker.summary(dataset=dataset_name), error="No valid bundles")
+        return experiment_result(0.0, 0.0, 0.0, format_res, error="No valid bundles")
     
     logger.info("Computing final metrics...")
-    session_precision, session_recall, coverage = compute(session_items, session_bundles, format_res)
+    session_precision, session_recall, coverage = compute(session_items, session_bundles, format_res,
+                                                          index=bundle_index)
     
     # Log final results with enhanced formatting
+    save_usage()
     logger.log_final_results(session_precision, session_recall, coverage, 
+                           usage_summary=usage_tracker.summary(dataset=dataset_name),
                            total_test_sessions=len(test_set),
                            valid_bundles=len(format_res),
                            model=config['model'],
-                           dataset=opt.dataset)
-
-
-
-
-
+                           dataset=dataset_name)
+    return experiment_result(session_precision, session_recall, coverage, format_res)
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='electronic')
+    parser.add_argument('--stream', action='store_true',
+                        help='run each test session through the whole pipeline as it goes')
+    parser.add_argument('--resume', action='store_true', help='skip sessions already completed by an interrupted run')
+    parser.add_argument('--batch', action='store_true', help='send the calls of each stage turn as one batch file')
+    opt = parser.parse_args()
+    if opt.batch and opt.stream:
+        parser.error('--batch runs stage by stage and cannot be combined with --stream')
+
+    with open('config.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+
+    configure_clients(config)
+    result = run_experiment(opt.dataset, opt, config)
+    exit(1 if result['error'] else 0)
@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from run import configure_clients, open_response_cache, run_experiment
+from utils.logger import Logger, logger_options
+from utils.usage import usage_tracker
+
+
+def dataset_log_path(log_path, dataset):
+    """`log/run.log` -> `log/run_electronic.log`"""
+    base, ext = os.path.splitext(log_path)
+    return f'{base}_{dataset}{ext or ".log"}'
+
+
+parser = argparse.ArgumentParser(description='Run the pipeline on several datasets at the same time')
+parser.add_argument('--datasets', nargs='+', default=['electronic', 'clothing', 'food'])
+parser.add_argument('--stream', action='store_true', help='run each test session through the whole pipeline as it goes')
+parser.add_argument('--resume', action='store_true', help='skip sessions already completed by an interrupted run')
+parser.add_argument('--batch', action='store_true', help='send the calls of each stage turn as one batch file')
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+    if opt.batch and opt.stream:
+        parser.error('--batch runs stage by stage and cannot be combined with --stream')
+
+    with open('config.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+
+    logger = Logger(config['log_path'], **logger_options(config))
+    logger.info(f"Running datasets concurrently: {', '.join(opt.datasets)}")
+    start_time = time.time()
+
+    # One process for all datasets: the response cache, rate-limit budgets and connections are shared
+    configure_clients(config, logger, runs=len(opt.datasets))
+    response_cache = open_response_cache(config)
+
+    def run_one(dataset):
+        dataset_logger = Logger(dataset_log_path(config['log_path'], dataset), **logger_options(config))
+        try:
+            return run_experiment(dataset, opt, config, logger=dataset_logger, response_cache=response_cache)
+        except Exception as e:
+            dataset_logger.error(f"Run failed: {str(e)}")
+            return {'dataset': dataset, 'error': f"{type(e).__name__}: {e}"}
+
+    with ThreadPoolExecutor(max_workers=len(opt.datasets)) as pool:
+        results = list(pool.map(run_one, opt.datasets))
+
+    wall_time = time.time() - start_time
+    report = {
+        'wall_time': round(wall_time, 3),
+        'sum_of_run_times': round(sum(res.get('elapsed', 0) for res in results), 3),
+        # the bundles themselves are in each dataset's bundle_res.npy
+        'datasets': {res['dataset']: dict({key: value for key, value in res.items() if key != 'predictions'},
+                                          usage=usage_tracker.summary(dataset=res['dataset']).get('total'))
+                     for res in results},
+        'usage': usage_tracker.summary().get('total'),
+    }
+    if response_cache:
+        report['cache'] = response_cache.stats()
+    report_path = f"{config['temp_path']}report.json"
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, default=str)
+
+    logger.info("=" * 60)
+    logger.info("RESULTS PER DATASET")
+    logger.info("=" * 60)
+    for res in results:
+        if res.get('precision') is None:
+            logger.info(f"{res['dataset']}: failed ({res['error']})")
+            continue
+        logger.info(f"{res['dataset']}: precision={res['precision']:.6f}, recall={res['recall']:.6f}, "
+                    f"coverage={res['coverage']:.6f}, valid_bundles={res['valid_bundles']}, "
+                    f"time={res['elapsed']:.2f}s" + (f", error={res['error']}" if res['error'] else ""))
+    logger.info(f"Wall time: {wall_time:.2f}s (sum of run times: {report['sum_of_run_times']:.2f}s)")
+    logger.info(f"Report written to {report_path}")
+    exit(1 if any(res['error'] for res in results) else 0)
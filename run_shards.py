@@ -0,0 +1,168 @@
+import argparse
+import copy
+import json
+import os
+import subprocess
+import sys
+import time
+
+import yaml
+
+from run import configure_clients, open_response_cache, run_experiment
+from run_all import dataset_log_path
+from utils.bundle_index import BundleIndex
+from utils.dataset import load_dataset
+from utils.logger import Logger, logger_options
+from utils.metrics import compute
+from utils.shards import ShardQueue, load_shard_predictions, save_shard_predictions, shard_keys, worker_name
+
+
+def shard_path(shards_dir, shard):
+    return f'{shards_dir}{shard:03d}/'
+
+
+def run_worker(opt, config, queue, shards_dir, logger):
+    """Claim shards until none is left, run the pipeline on each and write its predictions"""
+    configure_clients(config, logger)
+    response_cache = open_response_cache(config)
+    test_keys = list(load_dataset(f"{config['data_path']}{opt.dataset}/",
+                                  compact=config.get('compact_dataset', True))['test_set'].keys())
+    worker = worker_name()
+    # resume: a shard taken over from another worker skips the sessions that worker already stored
+    shard_opt = copy.copy(opt)
+    shard_opt.resume = True
+    failed = 0
+    while True:
+        shard = queue.claim(worker, opt.lease)
+        if shard is None:
+            break
+        test_ids = shard_keys(test_keys, opt.shards, shard)
+        logger.info(f"Worker {worker} claimed shard {shard} ({len(test_ids)} test sessions)")
+        try:
+            done = run_shard(shard_opt, config, queue, shards_dir, logger, shard, worker, test_ids, response_cache)
+        except Exception as e:
+            logger.error(f"Shard {shard} failed: {type(e).__name__}: {e}")
+            done = False
+        if not done:
+            failed += 1
+            # handed out again at once rather than when its lease runs out
+            state = queue.fail(shard, worker, opt.max_claims)
+            if state == 'failed':
+                logger.error(f"Shard {shard} failed {opt.max_claims} times, giving up on it")
+    return failed
+
+
+def run_shard(opt, config, queue, shards_dir, logger, shard, worker, test_ids, response_cache):
+    """Run the pipeline on one claimed shard under its lease, False if the run failed"""
+    shard_logger = Logger(dataset_log_path(config['log_path'], f'{opt.dataset}_shard{shard:03d}'),
+                          **logger_options(config))
+    with queue.lease(shard, worker, opt.lease) as heartbeat:
+        try:
+            result = run_experiment(opt.dataset, opt, config, logger=shard_logger, response_cache=response_cache,
+                                    test_ids=test_ids, run_path=shard_path(shards_dir, shard))
+        except Exception as e:
+            shard_logger.error(f"Run failed: {str(e)}")
+            result = {'error': f"{type(e).__name__}: {e}", 'predictions': None}
+        finally:
+            shard_logger.close()
+    # a shard without any multi-product bundle is still finished
+    if result['predictions'] is None or (result['error'] and result['error'] != "No valid bundles"):
+        logger.error(f"Shard {shard} failed: {result['error']}")
+        return False
+    if heartbeat.lost:
+        logger.warning(f"Lease on shard {shard} expired while it ran, leaving it to its new owner")
+        return True
+    save_shard_predictions(f'{shard_path(shards_dir, shard)}predictions.pkl', result['predictions'])
+    if queue.complete(shard, worker):
+        logger.info(f"Shard {shard} done: {len(result['predictions'])} sessions with valid bundles "
+                    f"in {result['elapsed']:.2f}s")
+    else:
+        logger.warning(f"Shard {shard} was taken over before it completed")
+    return True
+
+
+def merge(opt, config, queue, shards_dir, logger):
+    """Combine the predictions of every shard and compute the metrics once over all of them"""
+    status = queue.status()
+    if status.get('done', 0) != opt.shards:
+        logger.error(f"Cannot merge, not every shard is done: {status}")
+        return None
+
+    data_path = f"{config['data_path']}{opt.dataset}/"
+    dataset = load_dataset(data_path, compact=config.get('compact_dataset', True), logger=logger)
+    test_set = dataset['test_set']
+    bundle_index = BundleIndex.from_dataset(dataset, data_path, cache_dir=f"{config['temp_path']}{opt.dataset}/",
+                                            logger=logger)
+
+    shard_predictions = {}
+    for shard in range(opt.shards):
+        shard_predictions.update(load_shard_predictions(f'{shard_path(shards_dir, shard)}predictions.pkl'))
+    # in test set order, as a single-process run produces them
+    format_res = {test_id: shard_predictions[test_id] for test_id in test_set if test_id in shard_predictions}
+    if len(format_res) == 0:
+        logger.error("No valid bundles after filtering! All bundles contain only 1 product.")
+        logger.log_final_results(0.0, 0.0, 0.0, error="No valid bundles")
+        return {'dataset': opt.dataset, 'shards': opt.shards, 'precision': 0.0, 'recall': 0.0, 'coverage': 0.0,
+                'total_test_sessions': len(test_set), 'valid_bundles': 0, 'error': "No valid bundles"}
+
+    precision, recall, coverage = compute(dataset['session_items'], dataset['session_bundles_deduplication'],
+                                          format_res, index=bundle_index)
+    logger.log_final_results(precision, recall, coverage, total_test_sessions=len(test_set),
+                             valid_bundles=len(format_res), model=config['model'], dataset=opt.dataset,
+                             shards=opt.shards)
+    return {'dataset': opt.dataset, 'shards': opt.shards, 'precision': precision, 'recall': recall,
+            'coverage': coverage, 'total_test_sessions': len(test_set), 'valid_bundles': len(format_res),
+            'error': None}
+
+
+parser = argparse.ArgumentParser(description='Run the pipeline on one dataset split into shards, across processes '
+                                             'or hosts that share the temp directory')
+parser.add_argument('--dataset', type=str, default='electronic')
+parser.add_argument('--shards', type=int, default=4, help='number of shards the test sessions are split into')
+parser.add_argument('--workers', type=int, default=0,
+                    help='start this many local worker processes, wait for them and merge')
+parser.add_argument('--worker', action='store_true', help='join as a worker: claim shards until none is left')
+parser.add_argument('--merge', action='store_true', help='combine the finished shards and compute the metrics')
+parser.add_argument('--lease', type=float, default=600,
+                    help='seconds a claimed shard stays with a worker that stopped renewing it')
+parser.add_argument('--max-claims', type=int, default=3,
+                    help='times a shard is handed out before a failing shard is given up on')
+parser.add_argument('--stream', action='store_true', help='run each test session through the whole pipeline as it goes')
+parser.add_argument('--batch', action='store_true', help='send the calls of each stage turn as one batch file')
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+    if opt.batch and opt.stream:
+        parser.error('--batch runs stage by stage and cannot be combined with --stream')
+    if not (opt.workers or opt.worker or opt.merge):
+        parser.error('one of --workers, --worker or --merge is required')
+
+    with open('config.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+
+    logger = Logger(dataset_log_path(config['log_path'], f'{opt.dataset}_shards'), **logger_options(config))
+    shards_dir = f"{config['temp_path']}{opt.dataset}/shards/"
+    queue = ShardQueue(f'{shards_dir}queue.sqlite', opt.shards)
+
+    if opt.worker:
+        exit(1 if run_worker(opt, config, queue, shards_dir, logger) else 0)
+
+    if opt.workers:
+        start_time = time.time()
+        logger.info(f"Starting {opt.workers} workers on {opt.shards} shards of {opt.dataset}")
+        worker_args = [sys.executable, os.path.abspath(__file__), '--worker', '--dataset', opt.dataset,
+                       '--shards', str(opt.shards), '--lease', str(opt.lease), '--max-claims', str(opt.max_claims)]
+        worker_args += ['--stream'] if opt.stream else []
+        worker_args += ['--batch'] if opt.batch else []
+        workers = [subprocess.Popen(worker_args) for _ in range(opt.workers)]
+        codes = [worker.wait() for worker in workers]
+        logger.info(f"Workers finished in {time.time() - start_time:.2f}s with exit codes {codes}")
+
+    result = merge(opt, config, queue, shards_dir, logger)
+    if result is None:
+        exit(1)
+    report_path = f'{shards_dir}report.json'
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2, default=str)
+    logger.info(f"Report written to {report_path}")
+    exit(1 if result['error'] else 0)
@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+
+import yaml
+
+from prompt.prompts import PromptGenerator
+from run import configure_clients, create_client, open_response_cache
+from run_all import dataset_log_path
+from utils.context import ContextCompactor
+from utils.dataset import load_dataset
+from utils.demo_bank import demo_fingerprint
+from utils.logger import Logger, logger_options
+from utils.serving import BundleServer, BundleService, load_demonstrations
+from utils.usage import usage_tracker
+
+# LLM calls kept for /metrics, the server runs for days
+USAGE_WINDOW = 10000
+
+
+def load_service(dataset_name, config, response_cache, logger):
+    """Load a dataset and the demonstrations of its last run into a `BundleService`"""
+    data_path = config['data_path'] + dataset_name + '/'
+    temp_path = config['temp_path'] + dataset_name + '/'
+    dataset = load_dataset(data_path, compact=config.get('compact_dataset', True), logger=logger)
+    # the demo bank holds the demonstrations of every run with these settings
+    fingerprint = demo_fingerprint(config) if config.get('demo_bank', True) else None
+    demonstrations = load_demonstrations(temp_path, fingerprint)
+    context_compactor = None
+    if config.get('max_context_length'):
+        context_compactor = ContextCompactor(config['max_context_length'], config.get('context_keep_recent', 1))
+    chat = create_client(config, 'openai', config['model'], config['api_key'], config['temperature'],
+                         config.get('replay_path', f'{temp_path}replay.jsonl'), response_cache, context_compactor,
+                         logger)
+    service = BundleService(dataset_name, chat, PromptGenerator(dataset['session_items'],
+                                                                dataset['session_bundles_deduplication']),
+                            dataset['training_set'], demonstrations)
+    logger.info(f"Loaded {dataset_name}: {len(demonstrations)} demonstration sessions")
+    return service
+
+
+parser = argparse.ArgumentParser(description='Serve bundle generation for live baskets over HTTP')
+parser.add_argument('--datasets', nargs='+', default=['electronic'], help='datasets to serve, the first is the default')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8080)
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+    with open('config.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+
+    logger = Logger(dataset_log_path(config['log_path'], 'serve'), **logger_options(config))
+    concurrency = config.get('serve_concurrency', config.get('concurrency', 8))
+    configure_clients(config, logger)
+    usage_tracker.limit(USAGE_WINDOW)
+    response_cache = open_response_cache(config)
+    services = {name: load_service(name, config, response_cache, logger) for name in opt.datasets}
+    server = BundleServer(services, max_concurrency=concurrency, deadline=config.get('serve_deadline', 60),
+                          max_queue=config.get('serve_max_queue', 4 * concurrency), logger=logger)
+    try:
+        asyncio.run(server.serve(opt.host, opt.port))
+    except KeyboardInterrupt:
+        logger.info(f"Stopped: {server.metrics()}")
@@ -0,0 +1,72 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubServer(object):
+    """HTTP server on an ephemeral port that answers every POST with `respond(handler, body)`.
+
+    The decoded request bodies and the client ports they came from are kept
+    in `requests` and `client_ports`, to check retries and connection reuse.
+    """
+
+    def __init__(self, respond):
+        stub = self
+        self.requests = []
+        self.client_ports = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or b'{}')
+                stub.requests.append(body)
+                stub.client_ports.append(self.client_address[1])
+                respond(self, body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def send_json(handler, payload, status=200, headers=None):
+    data = json.dumps(payload).encode('utf-8')
+    handler.send_response(status)
+    handler.send_header('Content-Type', 'application/json')
+    handler.send_header('Content-Length', str(len(data)))
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.end_headers()
+    handler.wfile.write(data)
+
+
+def completion(content):
+    return {'choices': [{'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 5}}
+
+
+@pytest.fixture
+def stub_server():
+    servers = []
+
+    def start(respond):
+        servers.append(StubServer(respond))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
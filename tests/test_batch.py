@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+from utils.batch import BatchRunner
+from utils.usage import current_test_id
+
+
+class RecordingExecutor(object):
+    """Answers every request of a batch file with its custom_id and keeps the batch sizes."""
+
+    def __init__(self):
+        self.batches = []
+
+    def run(self, input_path, output_path, stage=None):
+        with open(input_path, 'r', encoding='utf-8') as f:
+            requests = [json.loads(line) for line in f]
+        self.batches.append(sorted(request['custom_id'] for request in requests))
+        with open(output_path, 'w', encoding='utf-8') as f:
+            for request in requests:
+                f.write(json.dumps({'custom_id': request['custom_id'], 'error': None, 'response': {
+                    'status_code': 200, 'body': {'choices': [{'message': {'content': request['custom_id']}}]}}}) + '\n')
+
+
+class Client(object):
+    model = 'stub'
+    temperature = 0
+
+
+def test_fan_out_session_waits_for_the_other_sessions(tmp_path):
+    executor = RecordingExecutor()
+    runner = BatchRunner(executor, str(tmp_path))
+    messages = [{'role': 'user', 'content': 'Rate the intents'}]
+
+    async def session(test_id, calls, delay):
+        current_test_id.set(test_id)
+        runner.session_started()
+        try:
+            # the single-call sessions reach their turn after the fan-out session has parked all its calls
+            await asyncio.sleep(delay)
+            return await asyncio.gather(*[runner.submit(Client(), messages) for _ in range(calls)])
+        finally:
+            runner.session_finished()
+
+    async def stage():
+        runner.start_stage('Rating intents')
+        return await asyncio.gather(session('a', 3, 0), session('b', 1, 0.05), session('c', 1, 0.05))
+
+    replies = asyncio.run(stage())
+    assert executor.batches == [['a-0', 'a-1', 'a-2', 'b-0', 'c-0']]
+    assert replies == [['a-0', 'a-1', 'a-2'], ['b-0'], ['c-0']]
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import threading
+import time
+
+from utils.ChatAPI import API_ERROR_RESPONSE
+from utils.cache import CachedChat, ResponseCache
+from utils.replay import ReplayChat
+from utils.stages import rate_intents
+
+MESSAGES = [{'role': 'user', 'content': 'Hello'}]
+
+
+class CountingClient(object):
+    model = 'stub-model'
+    temperature = 0
+
+    def __init__(self):
+        self.calls = 0
+
+    def create_chat_completion(self, messages, stop_at_object=False):
+        self.calls += 1
+        return f'reply {self.calls}'
+
+
+class SlowMissCache(ResponseCache):
+    """Stalls the first miss, so another request can complete in between."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.stalled = threading.Event()
+
+    def get(self, key):
+        cached = super().get(key)
+        if cached is None and not self.stalled.is_set():
+            self.stalled.set()
+            time.sleep(0.3)
+        return cached
+
+
+def test_identical_requests_are_sent_once(tmp_path):
+    client = CountingClient()
+    chat = CachedChat(client, SlowMissCache(str(tmp_path / 'cache.sqlite')))
+    first = threading.Thread(target=chat.create_chat_completion, args=(MESSAGES,))
+    first.start()
+    chat.cache.stalled.wait()
+    # the second request is sent while the first stalls in its cache lookup; it must wait for the first
+    # to register and answer instead of becoming a second owner once the first has left `_inflight`
+    second = chat.create_chat_completion(MESSAGES)
+    first.join()
+
+    assert client.calls == 1
+    assert second == 'reply 1'
+    assert chat.create_chat_completion(MESSAGES) == 'reply 1'
+
+
+def test_sampled_repeats_are_cached_per_sample(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    client = CountingClient()
+    client.temperature = 0.7
+    chat = CachedChat(client, cache)
+    assert [chat.create_chat_completion(MESSAGES) for _ in range(3)] == ['reply 1', 'reply 2', 'reply 3']
+
+    # a rerun gets the same samples in the same order, and only the extra repeat is sent
+    rerun = CachedChat(client, cache)
+    assert [rerun.create_chat_completion(MESSAGES) for _ in range(4)] == ['reply 1', 'reply 2', 'reply 3', 'reply 4']
+    assert client.calls == 4
+
+
+def test_greedy_repeats_share_one_entry(tmp_path):
+    client = CountingClient()
+    chat = CachedChat(client, ResponseCache(str(tmp_path / 'cache.sqlite')))
+    assert [chat.create_chat_completion(MESSAGES) for _ in range(3)] == ['reply 1'] * 3
+    assert client.calls == 1
+
+
+def test_rating_repeats_are_sent_independently(tmp_path):
+    client = CountingClient()
+    chat = CachedChat(client, ResponseCache(str(tmp_path / 'cache.sqlite')))
+    logger = logging.getLogger('test_cache')
+    asyncio.run(rate_intents([chat], 'Rate the intents', 3, logger, 'test-1'))
+    assert client.calls == 3
+
+    # a rerun is served every repeat from the cache
+    asyncio.run(rate_intents([CachedChat(client, chat.cache)], 'Rate the intents', 3, logger, 'test-1'))
+    assert client.calls == 3
+
+
+def test_replay_miss_is_logged(tmp_path, caplog, capsys):
+    chat = ReplayChat('openai', 'stub', 0, str(tmp_path / 'replay.jsonl'), mode='replay')
+    with caplog.at_level(logging.WARNING, logger='utils.replay'):
+        assert chat.create_chat_completion([{'role': 'user', 'content': 'bundles?'}]) == API_ERROR_RESPONSE
+    assert [record.getMessage() for record in caplog.records] == ['Replay miss for openai/stub: no recorded response']
+    assert chat.misses == 1
+    assert capsys.readouterr().out == ''
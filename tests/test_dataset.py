@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+import utils.dataset
+from utils.bundle_index import BundleIndex
+from utils.dataset import CompactTable, StringTable, load_dataset
+
+DATASET = {
+    'training_set': {1: 'Laptop|Charger', 2: 'Hose|Nozzle'},
+    'test_set': {3: 'Laptop|Mouse'},
+    'TopK_related_sessions': {3: [1, 2]},
+    'session_items': {1: 'i1,i2', 2: 'i3,i4', 3: 'i1,i5'},
+    'session_bundles_deduplication': {1: [('charging', 'i1,i2')], 2: [('watering', 'i3,i4')],
+                                      3: [('computing', 'i1,i5')]},
+    'item_titles': {'i1': 'Laptop', 'i2': 'Charger', 'i3': 'Hose', 'i4': 'Nozzle', 'i5': 'Mouse'},
+}
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    for name, data in DATASET.items():
+        np.save(tmp_path / f'{name}.npy', data, allow_pickle=True)
+    return f'{tmp_path}/'
+
+
+def test_compact_table_requires_decode():
+    with pytest.raises(TypeError):
+        CompactTable('compact', 'test_set')
+    assert isinstance(StringTable('compact', 'test_set'), CompactTable)
+
+
+@pytest.mark.parametrize('has_fcntl', [True, False])
+def test_compact_dataset_matches_the_pickled_dicts(data_path, monkeypatch, has_fcntl):
+    if not has_fcntl:
+        monkeypatch.setattr(utils.dataset, 'fcntl', None)
+    dataset = load_dataset(data_path)
+    assert all(isinstance(table, CompactTable) for table in dataset.values())
+    assert {name: dict(table) for name, table in dataset.items()} == DATASET
+
+
+def test_bundle_index_is_built_from_the_compact_tables(data_path, tmp_path, monkeypatch):
+    dataset = load_dataset(data_path)
+    expected = BundleIndex(DATASET['session_items'], DATASET['session_bundles_deduplication'])
+
+    def load(*args, **kwargs):
+        raise AssertionError('the .npy files are read again')
+
+    monkeypatch.setattr(BundleIndex, 'load', load)
+    index = BundleIndex.from_dataset(dataset, data_path, cache_dir=str(tmp_path / 'temp'))
+    assert index.items == expected.items
+    assert index.gt_masks == expected.gt_masks
+    monkeypatch.undo()
+
+    # the pickled dicts go through the cached load
+    index = BundleIndex.from_dataset(load_dataset(data_path, compact=False), data_path,
+                                     cache_dir=str(tmp_path / 'temp'))
+    assert index.gt_masks == expected.gt_masks
+    assert len(list((tmp_path / 'temp').glob('bundle_index_v*.pkl'))) == 1
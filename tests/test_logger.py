@@ -0,0 +1,57 @@
+import gc
+import json
+import time
+import weakref
+
+from utils.logger import Logger
+
+
+def read_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+def test_queued_logger_writes_every_record_on_close(tmp_path):
+    path = str(tmp_path / 'run.log')
+    logger = Logger(path, console_level='ERROR', queued=True, flush_interval=60, structured=True)
+    for i in range(100):
+        logger.debug(f'record {i}', latency=i)
+    logger.close()
+    assert [line.split(': ', 1)[1] for line in read_lines(path)] == [f'record {i}' for i in range(100)]
+    entries = [json.loads(line) for line in read_lines(str(tmp_path / 'run.jsonl'))]
+    assert [entry['latency'] for entry in entries] == list(range(100))
+
+
+def test_queued_logger_flushes_warnings_at_once(tmp_path):
+    path = str(tmp_path / 'run.log')
+    logger = Logger(path, console_level='ERROR', queued=True, flush_interval=60)
+    logger.debug('first')
+    # the first record after a quiet period is flushed at once, the next ones wait for the interval
+    logger.debug('buffered')
+    logger.warning('urgent')
+    deadline = time.time() + 5
+    while len(read_lines(path)) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert [line.split(': ', 1)[1] for line in read_lines(path)] == ['first', 'buffered', 'urgent']
+    logger.close()
+
+
+def test_queued_logger_flushes_after_a_quiet_interval(tmp_path):
+    path = str(tmp_path / 'run.log')
+    logger = Logger(path, console_level='ERROR', queued=True, flush_interval=0.1)
+    logger.debug('first')
+    logger.debug('second')
+    time.sleep(0.5)
+    assert len(read_lines(path)) == 2
+    logger.close()
+
+
+def test_closed_loggers_are_not_kept_for_exit(tmp_path):
+    loggers = [Logger(str(tmp_path / f'run{i}.log'), console_level='ERROR', queued=bool(i % 2)) for i in range(4)]
+    refs = [weakref.ref(logger) for logger in loggers]
+    for logger in loggers:
+        logger.close()
+    del logger, loggers
+    gc.collect()
+    # no exit hook holds on to a closed logger
+    assert [ref() for ref in refs] == [None] * 4
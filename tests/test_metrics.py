@@ -0,0 +1,44 @@
+import random
+
+import pytest
+
+from utils.metrics import compute, compute_reference
+
+
+def random_dataset(rng, n_sessions):
+    session_items, session_bundles, predictions = {}, {}, {}
+    for test_id in range(n_sessions):
+        # up to 15 items, so 'product12' and 'product2' both exist and must not be confused
+        items = [f'i{rng.randrange(40)}' for _ in range(rng.randint(2, 15))]
+        session_items[test_id] = ','.join(items)
+        session_bundles[test_id] = [(f'intent {b}', ','.join(rng.sample(items, rng.randint(1, len(items)))))
+                                    for b in range(rng.randint(1, 4))]
+        pred = {}
+        for b in range(rng.randint(0, 4)):
+            refs = [f'product{rng.randint(1, len(items))}' for _ in range(rng.randint(1, 4))]
+            edge = rng.random()
+            if edge < 0.1:
+                refs.append('product0')
+            elif edge < 0.2:
+                refs.append(f'product{len(items) + 1}')
+            elif edge < 0.3 and len(items) >= 12:
+                refs = ['product12', 'product2']
+            pred[f'bundle{b + 1}'] = refs
+        predictions[test_id] = pred
+    return session_items, session_bundles, predictions
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_compute_matches_reference(seed):
+    session_items, session_bundles, predictions = random_dataset(random.Random(seed), 20)
+    expected = compute_reference(session_items, session_bundles, predictions)
+    assert compute(session_items, session_bundles, predictions) == pytest.approx(expected, abs=1e-12)
+
+
+def test_multi_digit_and_zero_references():
+    session_items = {1: ','.join(f'i{n}' for n in range(1, 13))}
+    session_bundles = {1: [('charging', 'i2,i12')]}
+    # product12 is item i12, not the second item again; product0 references no item
+    predictions = {1: {'bundle1': ['product12', 'product2'], 'bundle2': ['product0', 'product2']}}
+    assert compute(session_items, session_bundles, predictions) == pytest.approx((0.5, 1.0, 1.0))
+    assert compute_reference(session_items, session_bundles, predictions) == pytest.approx((0.5, 1.0, 1.0))
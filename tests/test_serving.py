@@ -0,0 +1,114 @@
+import asyncio
+import threading
+
+import pytest
+import requests
+
+from prompt.prompts import PromptGenerator
+from tests.conftest import completion, send_json
+from utils.ChatAPI import OpenAI
+from utils.demo_bank import DemoBank
+from utils.scheduler import RequestScheduler
+from utils.serving import BundleServer, BundleService, load_demonstrations
+from utils.stages import RULES_QUESTION, TEST_INTENT_QUESTION
+from utils.transport import HTTPTransport
+
+CONTEXT = [{'role': 'user', 'content': 'Bundle these products'},
+           {'role': 'assistant', 'content': '{"bundle1": ["product1", "product2"]}'}]
+
+
+def test_load_demonstrations_from_demo_bank(tmp_path):
+    demo_bank = DemoBank(str(tmp_path / 'demo_bank.sqlite'), 'fingerprint')
+    demo_bank.record({7: ((7, CONTEXT), 4), 8: (None, 2)})
+    demo_bank.close()
+
+    # the dropped session 8 is skipped, another fingerprint finds nothing
+    assert load_demonstrations(str(tmp_path), 'fingerprint') == {7: CONTEXT}
+    with pytest.raises(ValueError):
+        load_demonstrations(str(tmp_path), 'other')
+
+
+def test_load_demonstrations_without_any_raises(tmp_path):
+    with pytest.raises(ValueError):
+        load_demonstrations(str(tmp_path))
+
+
+TRAINING_SET = {7: 'Laptop 13-inch|USB-C Charger|Laptop Sleeve', 8: 'Garden Hose|Hose Nozzle'}
+
+
+def stub_llm(handler, body):
+    question = body['messages'][-1]['content']
+    if question == RULES_QUESTION:
+        content = 'Products used together form a bundle.'
+    elif question == TEST_INTENT_QUESTION:
+        content = '{"bundle1": "charging a laptop"}'
+    else:
+        content = '{"bundle1": ["product1", "product2"], "bundle2": ["product3"]}'
+    send_json(handler, completion(content))
+
+
+@pytest.fixture
+def bundle_server(stub_server):
+    """A `BundleServer` on an ephemeral port, its LLM calls answered by `stub_llm`."""
+    llm = stub_server(stub_llm)
+    chat = OpenAI('stub', 'key', base_url=llm.url, transport=HTTPTransport(pool_size=2),
+                  scheduler=RequestScheduler('stub', max_retries=0))
+    service = BundleService('electronic', chat, PromptGenerator({}, {}), TRAINING_SET, {7: CONTEXT, 8: CONTEXT})
+    server = BundleServer({'electronic': service}, max_concurrency=2, deadline=10)
+
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    task = loop.create_task(server.serve(port=0, ready=ready))
+    thread = threading.Thread(target=loop.run_until_complete, args=(asyncio.wait([task]),), daemon=True)
+    thread.start()
+    assert ready.wait(10)
+    server.llm = llm
+    server.url = f'http://127.0.0.1:{server.port}'
+    yield server
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join(10)
+    loop.close()
+
+
+def test_basket_is_answered_with_bundles(bundle_server):
+    basket = ['Laptop 13-inch', 'USB-C Charger', 'Mouse Pad']
+    response = requests.post(f'{bundle_server.url}/bundles', json={'products': basket}, timeout=10)
+    assert response.status_code == 200
+    result = response.json()
+    assert set(result) == {'dataset', 'neighbor_session', 'bundles', 'bundle_titles', 'intents', 'latency'}
+    assert result['dataset'] == 'electronic'
+    assert result['neighbor_session'] == 7
+    # the single-product bundle is dropped
+    assert result['bundles'] == {'bundle1': ['product1', 'product2']}
+    assert result['bundle_titles'] == {'bundle1': ['Laptop 13-inch', 'USB-C Charger']}
+    assert result['intents'] == {'bundle1': 'charging a laptop'}
+    # rules, bundles and intents
+    assert len(bundle_server.llm.requests) == 3
+
+
+def test_neighbor_is_matched_off_the_event_loop(bundle_server, monkeypatch):
+    service = bundle_server.services['electronic']
+    threads = []
+    neighbor = service.neighbor
+
+    def recording_neighbor(basket):
+        threads.append(threading.current_thread())
+        return neighbor(basket)
+
+    monkeypatch.setattr(service, 'neighbor', recording_neighbor)
+    response = requests.post(f'{bundle_server.url}/bundles', json={'products': ['Garden Hose', 'Nozzle']}, timeout=10)
+    assert response.status_code == 200
+    assert response.json()['neighbor_session'] == 8
+    assert len(threads) == 1
+    # the event loop runs on the fixture's thread, the matching on an executor thread
+    assert threads[0].name.startswith('ThreadPoolExecutor')
+
+
+@pytest.mark.parametrize('body', [b'not json', b'{}', b'{"products": []}', b'{"products": "Laptop"}',
+                                  b'{"products": ["Laptop"], "dataset": "garden"}',
+                                  b'{"products": ["Laptop"], "deadline": "soon"}'])
+def test_bad_requests_are_rejected(bundle_server, body):
+    response = requests.post(f'{bundle_server.url}/bundles', data=body, timeout=10)
+    assert response.status_code == 400
+    assert 'error' in response.json()
+    assert bundle_server.llm.requests == []
@@ -0,0 +1,149 @@
+import argparse
+import random
+import time
+
+import pytest
+
+import run_shards
+from run_shards import merge, run_worker, shard_path
+from utils.bundle_index import BundleIndex
+from utils.logger import Logger
+from utils.metrics import compute
+from utils.shards import ShardQueue, save_shard_predictions, shard_keys
+
+from tests.test_metrics import random_dataset
+
+
+def make_opt(**kwargs):
+    opt = argparse.Namespace(dataset='toy', shards=2, lease=60.0, max_claims=2, resume=False, stream=False,
+                             batch=False)
+    for name, value in kwargs.items():
+        setattr(opt, name, value)
+    return opt
+
+
+def make_config(tmp_path):
+    return {'data_path': f'{tmp_path}/data/', 'temp_path': f'{tmp_path}/temp/', 'log_path': f'{tmp_path}/run.log',
+            'model': 'stub', 'log_console_level': 'ERROR'}
+
+
+def test_expired_lease_is_handed_to_another_worker(tmp_path):
+    queue = ShardQueue(str(tmp_path / 'queue.sqlite'), 1)
+    assert queue.claim('w1', 0.1) == 0
+    # still leased to w1
+    assert queue.claim('w2', 0.1) is None
+    time.sleep(0.2)
+    assert queue.claim('w2', 60) == 0
+    # w1 lost the shard and can neither renew nor complete it
+    assert not queue.renew(0, 'w1', 60)
+    assert not queue.complete(0, 'w1')
+    assert queue.complete(0, 'w2')
+    assert queue.claim('w3', 60) is None
+    assert queue.status() == {'done': 1}
+    queue.close()
+
+
+def test_heartbeat_keeps_the_lease(tmp_path):
+    queue = ShardQueue(str(tmp_path / 'queue.sqlite'), 1)
+    assert queue.claim('w1', 0.3) == 0
+    with queue.lease(0, 'w1', 0.3) as heartbeat:
+        time.sleep(0.5)
+        assert queue.claim('w2', 60) is None
+    assert not heartbeat.lost
+    queue.close()
+
+
+def test_failed_shard_is_released_then_given_up(tmp_path):
+    queue = ShardQueue(str(tmp_path / 'queue.sqlite'), 1)
+    assert queue.claim('w1', 60) == 0
+    assert queue.fail(0, 'w2', max_claims=2) is None
+    assert queue.fail(0, 'w1', max_claims=2) == 'pending'
+    # released at once, not when the lease runs out
+    assert queue.claim('w2', 60) == 0
+    assert queue.fail(0, 'w2', max_claims=2) == 'failed'
+    assert queue.claim('w3', 60) is None
+    assert queue.status() == {'failed': 1}
+    queue.close()
+
+
+@pytest.fixture
+def worker_env(monkeypatch):
+    test_set = {test_id: f'title {test_id}' for test_id in range(6)}
+    monkeypatch.setattr(run_shards, 'configure_clients', lambda config, logger: None)
+    monkeypatch.setattr(run_shards, 'open_response_cache', lambda config: None)
+    monkeypatch.setattr(run_shards, 'load_dataset', lambda data_path, compact=True, logger=None: {'test_set': test_set})
+    return test_set
+
+
+def test_worker_releases_a_shard_whose_run_raises(tmp_path, monkeypatch, worker_env):
+    calls = []
+
+    def run_experiment(dataset, opt, config, logger=None, response_cache=None, test_ids=None, run_path=None):
+        calls.append((opt.resume, test_ids))
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(run_shards, 'run_experiment', run_experiment)
+    opt = make_opt()
+    queue = ShardQueue(str(tmp_path / 'queue.sqlite'), opt.shards)
+    logger = Logger(str(tmp_path / 'shards.log'), console_level='ERROR')
+
+    # each shard is retried at once up to max_claims, then given up on
+    assert run_worker(opt, make_config(tmp_path), queue, f'{tmp_path}/shards/', logger) == 4
+    assert calls == [(True, [0, 2, 4])] * 2 + [(True, [1, 3, 5])] * 2
+    assert queue.status() == {'failed': 2}
+    assert opt.resume is False
+    assert merge(opt, make_config(tmp_path), queue, f'{tmp_path}/shards/', logger) is None
+    logger.close()
+    queue.close()
+
+
+def test_worker_completes_its_shards(tmp_path, monkeypatch, worker_env):
+    def run_experiment(dataset, opt, config, logger=None, response_cache=None, test_ids=None, run_path=None):
+        predictions = {test_id: {'bundle1': ['product1', 'product2']} for test_id in test_ids}
+        return {'error': None, 'predictions': predictions, 'elapsed': 0.0}
+
+    monkeypatch.setattr(run_shards, 'run_experiment', run_experiment)
+    opt = make_opt()
+    queue = ShardQueue(str(tmp_path / 'queue.sqlite'), opt.shards)
+    logger = Logger(str(tmp_path / 'shards.log'), console_level='ERROR')
+
+    assert run_worker(opt, make_config(tmp_path), queue, f'{tmp_path}/shards/', logger) == 0
+    assert queue.status() == {'done': 2}
+    logger.close()
+    queue.close()
+
+
+def test_merge_matches_a_single_run(tmp_path, monkeypatch):
+    session_items, session_bundles, predictions = random_dataset(random.Random(0), 20)
+    # sessions without a valid bundle are absent from the predictions
+    predictions = {test_id: pred for test_id, pred in predictions.items() if test_id % 7}
+    dataset = {'test_set': {test_id: '' for test_id in session_items}, 'session_items': session_items,
+               'session_bundles_deduplication': session_bundles}
+    monkeypatch.setattr(run_shards, 'load_dataset', lambda data_path, compact=True, logger=None: dataset)
+    monkeypatch.setattr(BundleIndex, 'load', classmethod(
+        lambda cls, items_path, bundles_path, cache_dir=None, logger=None: cls(session_items, session_bundles)))
+
+    opt = make_opt(shards=3)
+    shards_dir = f'{tmp_path}/shards/'
+    queue = ShardQueue(f'{shards_dir}queue.sqlite', opt.shards)
+    logger = Logger(str(tmp_path / 'shards.log'), console_level='ERROR')
+    for shard in range(opt.shards):
+        test_ids = shard_keys(list(session_items), opt.shards, shard)
+        save_shard_predictions(f'{shard_path(shards_dir, shard)}predictions.pkl',
+                               {test_id: predictions[test_id] for test_id in test_ids if test_id in predictions})
+        assert queue.claim('w1', 60) == shard
+        if shard < opt.shards - 1:
+            assert queue.complete(shard, 'w1')
+
+    # the last shard is still leased
+    assert merge(opt, make_config(tmp_path), queue, shards_dir, logger) is None
+    assert queue.complete(opt.shards - 1, 'w1')
+
+    result = merge(opt, make_config(tmp_path), queue, shards_dir, logger)
+    expected = compute(session_items, session_bundles, predictions)
+    assert (result['precision'], result['recall'], result['coverage']) == pytest.approx(expected, abs=1e-12)
+    assert result['valid_bundles'] == len(predictions)
+    assert result['total_test_sessions'] == len(session_items)
+    assert result['error'] is None
+    logger.close()
+    queue.close()
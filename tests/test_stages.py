@@ -0,0 +1,106 @@
+import asyncio
+import contextvars
+import logging
+
+import pytest
+
+import utils.stages
+from utils.convergence import ConvergenceTracker, normalize_bundles
+from utils.stages import bundle_feedback, self_correction
+from utils.usage import current_dataset
+
+logger = logging.getLogger(__name__)
+
+SESSION_ITEMS = {7: 'i1,i2,i3'}
+SESSION_BUNDLES = {7: [('charging', 'i1,i2')]}
+
+
+class ScriptedChat(object):
+    """Answers each call with the next scripted answer and keeps the prompts it was asked."""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.prompts = []
+
+    async def acreate_chat_completion(self, messages, stop_at_object=False):
+        self.prompts.append(messages[-1]['content'])
+        return self.answers.pop(0)
+
+
+class Prompts(object):
+
+    def get_Self_correction(self, i):
+        return f'self-correction {i}'
+
+    def get_Feedback(self, kind, error_dict):
+        return f'feedback {sorted(error_dict)}'
+
+
+@pytest.fixture
+def tracker(monkeypatch):
+    tracker = ConvergenceTracker()
+    monkeypatch.setattr(utils.stages, 'convergence_tracker', tracker)
+    return tracker
+
+
+def test_normalize_bundles_ignores_keys_order_and_spelling():
+    bundles = normalize_bundles({'bundle1': ['product1', 'product3'], 'bundle2': ['product2']})
+    assert normalize_bundles({'b1': ['product2'], 'b2': ['Product 3', '1']}) == bundles
+    assert normalize_bundles({'bundle1': ['product3', 'product1'], 'bundle2': 'product2'}) == bundles
+    assert normalize_bundles({'bundle1': ['product1'], 'bundle2': ['product2', 'product3']}) != bundles
+    assert normalize_bundles(None) is None
+
+
+def test_adjust_round_is_skipped_without_errors(tracker):
+    chat = ScriptedChat(["{'bundle1': ['product1', 'product2']}", "{'bundle1': 'charging kit'}",
+                         "{'bundle1': 'phone charging kit'}"])
+    message = asyncio.run(self_correction(chat, Prompts(), 'detect bundles', 3, logger, 1, topk_session_idx=7,
+                                          session_bundles=SESSION_BUNDLES, session_items=SESSION_ITEMS))
+    assert chat.prompts == ['detect bundles', 'self-correction 0', 'self-correction 2']
+    assert len(message) == 6
+    assert tracker.summary() == {'Self-correction': {'sessions': 1, 'stopped_early': 1, 'saved_calls': 1}}
+
+
+def test_adjust_round_runs_with_errors(tracker):
+    chat = ScriptedChat(["{'bundle1': ['product3']}", "{'bundle1': 'charging kit'}",
+                         "{'bundle1': ['product1', 'product2']}", "{'bundle1': 'phone charging kit'}"])
+    asyncio.run(self_correction(chat, Prompts(), 'detect bundles', 3, logger, 1, topk_session_idx=7,
+                                session_bundles=SESSION_BUNDLES, session_items=SESSION_ITEMS))
+    assert chat.prompts == ['detect bundles', 'self-correction 0', 'self-correction 1', 'self-correction 2']
+    assert tracker.summary() == {'Self-correction': {'sessions': 1, 'stopped_early': 0, 'saved_calls': 0}}
+
+
+def test_self_correction_stops_on_repeated_bundles(tracker):
+    chat = ScriptedChat(["{'bundle1': ['product1', 'product2']}", "{'b1': ['Product 2', 'product1']}"])
+    asyncio.run(self_correction(chat, Prompts(), 'detect bundles', 4, logger, 1))
+    # rounds 1 to 3 are not asked
+    assert chat.prompts == ['detect bundles', 'self-correction 0']
+    assert tracker.summary() == {'Self-correction': {'sessions': 1, 'stopped_early': 1, 'saved_calls': 3}}
+
+
+def test_bundle_feedback_stops_on_unchanged_bundles(tracker):
+    chat = ScriptedChat(["{'bundle1': ['product3']}"])
+    context = asyncio.run(bundle_feedback(chat, Prompts(), 7, {'bundle1': ['product3']}, [], 3,
+                                          SESSION_BUNDLES, SESSION_ITEMS, logger, 1))
+    assert chat.prompts == ['feedback [6]']
+    assert len(context) == 2
+    assert tracker.summary() == {'Bundle feedback': {'sessions': 1, 'stopped_early': 1, 'saved_calls': 2}}
+
+
+def test_saved_calls_are_summed_per_stage_and_dataset():
+    tracker = ConvergenceTracker()
+    tracker.record('Self-correction', 2)
+    tracker.record('Self-correction', 0)
+    tracker.record('Bundle feedback', 1)
+    assert tracker.summary() == {'Self-correction': {'sessions': 2, 'stopped_early': 1, 'saved_calls': 2},
+                                 'Bundle feedback': {'sessions': 1, 'stopped_early': 1, 'saved_calls': 1}}
+    assert tracker.summary(dataset='electronic') == {}
+
+    def record_electronic():
+        current_dataset.set('electronic')
+        tracker.record('Self-correction', 3)
+
+    contextvars.copy_context().run(record_electronic)
+    assert tracker.summary(dataset='electronic') == {
+        'Self-correction': {'sessions': 1, 'stopped_early': 1, 'saved_calls': 3}}
+    assert tracker.summary()['Self-correction'] == {'sessions': 3, 'stopped_early': 2, 'saved_calls': 5}
@@ -0,0 +1,112 @@
+import json
+import time
+
+from tests.conftest import send_json
+from utils.ChatAPI import OpenAI, read_all, read_until_object
+from utils.scheduler import RequestScheduler
+from utils.transport import HTTPTransport
+from utils.usage import usage_tracker
+
+
+class Deltas(object):
+    """Generator-like iterable of text deltas that remembers whether it was closed."""
+
+    def __init__(self, deltas):
+        self.deltas = iter(deltas)
+        self.read = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        delta = next(self.deltas)
+        self.read += 1
+        return delta
+
+    def close(self):
+        self.closed = True
+
+
+def test_read_until_object_stops_at_the_complete_object():
+    deltas = Deltas(['Sure: {"bundle1": ["prod', 'uct1", "product2"]}', ' These go together {because', ' ...}'])
+    text, chunks, stopped_early = read_until_object(deltas)
+    assert json.loads(text[text.index('{'):]) == {'bundle1': ['product1', 'product2']}
+    assert (chunks, stopped_early) == (2, True)
+    assert deltas.read == 2 and deltas.closed
+
+
+def test_read_all_keeps_text_after_braces():
+    parts = ['Rule 1: bundles like {"bundle1": ["product1"]}', ' share a brand.', ' Rule 2: {sizes} match.']
+    deltas = Deltas(parts)
+    assert read_all(deltas) == (''.join(parts), 3, False)
+    assert deltas.closed
+
+
+def sse_stub(parts):
+    def respond(handler, body):
+        assert body['stream'] is True
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+
+        def write_chunk(data):
+            handler.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+            handler.wfile.flush()
+
+        try:
+            for part in parts:
+                event = {'choices': [{'delta': {'content': part}}]}
+                write_chunk(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+                time.sleep(0.05)
+            if (body.get('stream_options') or {}).get('include_usage'):
+                # the usage chunk comes last, with no choices
+                event = {'choices': [], 'usage': {'prompt_tokens': 42, 'completion_tokens': 17}}
+                write_chunk(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+            write_chunk(b'data: [DONE]\n\n')
+            write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        handler.close_connection = True
+    return respond
+
+
+def client(url):
+    return OpenAI('stub', 'key', stream=True, base_url=url, transport=HTTPTransport(),
+                  scheduler=RequestScheduler('stub', max_retries=0))
+
+
+def test_streamed_json_answer_is_cut_at_the_object(stub_server):
+    parts = ['{"bundle1": ', '["product1", "product2"]}', ' Explanation', ' that', ' goes', ' on', ' and on.']
+    server = stub_server(sse_stub(parts))
+    start = time.time()
+    content = client(server.url).create_chat_completion([{'role': 'user', 'content': 'bundles?'}],
+                                                         stop_at_object=True)
+    assert content == '{"bundle1": ["product1", "product2"]}'
+    # the remaining deltas were not waited for
+    assert time.time() - start < 0.05 * len(parts)
+
+
+def test_streamed_free_text_is_read_to_the_end(stub_server):
+    parts = ['Rules: a bundle such as {"bundle1": ["product1", "product2"]}', ' pairs a device', ' with its charger.']
+    server = stub_server(sse_stub(parts))
+    content = client(server.url).create_chat_completion([{'role': 'user', 'content': 'rules?'}])
+    assert content == ''.join(parts)
+
+
+def test_full_stream_records_the_reported_usage(stub_server):
+    parts = ['Rules:', ' a device', ' with its charger.']
+    server = stub_server(sse_stub(parts))
+    client(server.url).create_chat_completion([{'role': 'user', 'content': 'rules?'}])
+    assert server.requests[-1]['stream_options'] == {'include_usage': True}
+    record = usage_tracker.records[-1]
+    assert (record['prompt_tokens'], record['completion_tokens']) == (42, 17)
+
+
+def test_non_streamed_answer(stub_server):
+    server = stub_server(lambda handler, body: send_json(handler, {'choices': [{'message': {'content': 'ok'}}]}))
+    chat = OpenAI('stub', 'key', base_url=server.url, transport=HTTPTransport(),
+                  scheduler=RequestScheduler('stub', max_retries=0))
+    assert chat.create_chat_completion([{'role': 'user', 'content': 'hi'}], stop_at_object=True) == 'ok'
@@ -0,0 +1,97 @@
+import logging
+import time
+
+from tests.conftest import completion, send_json
+from utils.ChatAPI import API_ERROR_RESPONSE, OpenAI
+from utils.scheduler import RequestScheduler
+from utils.transport import HTTPTransport
+from utils.usage import usage_tracker
+
+MESSAGES = [{'role': 'user', 'content': 'bundles?'}]
+
+
+def start(stub_server, *replies):
+    server = None
+
+    def respond(handler, body):
+        n = len(server.requests) - 1
+        status, headers = replies[n] if n < len(replies) else (200, None)
+        if status == 200:
+            send_json(handler, completion('{"bundle1": ["product1", "product2"]}'))
+        else:
+            send_json(handler, {'error': {'message': f'status {status}'}}, status=status, headers=headers)
+
+    server = stub_server(respond)
+    return server
+
+
+def client(url, max_retries=3):
+    return OpenAI('stub', 'key', base_url=url, transport=HTTPTransport(pool_size=2),
+                  scheduler=RequestScheduler('stub', max_retries=max_retries, base_delay=0.01, max_delay=0.05))
+
+
+def test_rate_limit_and_server_errors_are_retried(stub_server):
+    server = start(stub_server, (429, {'Retry-After': '0.3'}), (503, None))
+    start_time = time.time()
+    content = client(server.url).create_chat_completion(MESSAGES)
+    assert content == '{"bundle1": ["product1", "product2"]}'
+    assert len(server.requests) == 3
+    assert usage_tracker.records[-1]['retries'] == 2
+    # the 429 asked for 0.3s, far more than the backoff of the first retry
+    assert time.time() - start_time >= 0.3
+
+
+def test_retries_are_bounded(stub_server):
+    server = start(stub_server, *[(500, None)] * 10)
+    assert client(server.url, max_retries=2).create_chat_completion(MESSAGES) == API_ERROR_RESPONSE
+    assert len(server.requests) == 3
+    assert usage_tracker.records[-1]['failed']
+
+
+def test_bad_request_is_not_retried(stub_server):
+    server = start(stub_server, (400, None))
+    assert client(server.url).create_chat_completion(MESSAGES) == API_ERROR_RESPONSE
+    assert len(server.requests) == 1
+
+
+def test_failed_call_is_logged(stub_server, caplog, capsys):
+    server = start(stub_server, (400, None))
+    with caplog.at_level(logging.ERROR, logger='utils.ChatAPI'):
+        assert client(server.url).create_chat_completion(MESSAGES) == API_ERROR_RESPONSE
+    assert [record.getMessage().startswith('Error in OpenAI API call') for record in caplog.records] == [True]
+    assert capsys.readouterr().out == ''
+
+
+def test_calls_reuse_one_connection(stub_server):
+    server = start(stub_server, (429, {'Retry-After': '0'}))
+    chat = client(server.url)
+    for _ in range(5):
+        chat.create_chat_completion(MESSAGES)
+    assert len(server.requests) == 6
+    # one keep-alive connection, retries included
+    assert len(set(server.client_ports)) == 1
+
+
+def test_long_retry_after_is_not_waited_for(stub_server):
+    server = start(stub_server, (429, {'Retry-After': '3600'}))
+    chat = client(server.url)
+    start_time = time.time()
+    assert chat.create_chat_completion(MESSAGES) == API_ERROR_RESPONSE
+    assert time.time() - start_time < 5
+    assert len(server.requests) == 1
+    # the model is not paused for the hour either
+    assert chat.scheduler.paused_until < time.monotonic() + 1
+
+
+def test_reconfiguring_closes_the_previous_pool(stub_server):
+    server = start(stub_server)
+    chat = client(server.url)
+    chat.create_chat_completion(MESSAGES)
+    previous = chat.transport.session
+    assert previous.adapters['http://'].poolmanager.pools
+    chat.transport.configure(pool_size=4)
+    assert chat.transport.session is not previous
+    assert not previous.adapters['http://'].poolmanager.pools
+    # calls go through the new pool
+    chat.create_chat_completion(MESSAGES)
+    assert len(set(server.client_ports)) == 2
@@ -1,100 +1,248 @@
-import backoff
-import openai
-import requests
-import json
-
-# Try importing from various possible locations based on OpenAI SDK version
-try:
-    # For newer OpenAI SDK versions
-    from openai import BadRequestError, RateLimitError, APIError, APIConnectionError
-except ImportError:
-    try:
-        # For slightly older OpenAI SDK versions
-        from openai.types.error import APIError, APIConnectionError, RateLimitError
-        from openai.types.error import BadRequestError, AuthenticationError, NotFoundError
-    except ImportError:
-        # For much older versions
-        BadRequestError = Exception
-        RateLimitError = Exception
-        APIError = Exception
-        APIConnectionError = Exception
+import asyncio
+import logging
+import time
+
+from utils.json_extract import ObjectScanner
+from utils.scheduler import ServerError, estimate_tokens, scheduler_registry
+from utils.transport import http_transport
+from utils.usage import usage_tracker
+
 'sk-yBXqyyoFm78JSPB5MtrW6HZOT9Cu8yRVqGakSJQeh1fOEGzN'
 
+# Returned instead of a completion when the API call failed
+API_ERROR_RESPONSE = "{'error': 'API call failed'}"
+
+
+def read_all(deltas):
+    """Join streamed text deltas up to the end of the stream, see `read_until_object`."""
+    parts, chunks = [], 0
+    try:
+        for delta in deltas:
+            if delta:
+                parts.append(delta)
+                chunks += 1
+    finally:
+        deltas.close()
+    return ''.join(parts), chunks, False
+
+
+def read_until_object(deltas):
+    """Join streamed text deltas, stopping as soon as the first `{...}` object is complete.
+
+    Used for prompts that ask for a JSON object only, so whatever the model
+    writes after the object is not needed. Closing `deltas` closes the
+    stream, which stops the generation.
+
+    Returns:
+        (text up to the end of the object, number of deltas read, whether the stream was cut short)
+    """
+    scanner = ObjectScanner()
+    parts, chunks = [], 0
+    try:
+        for delta in deltas:
+            if not delta:
+                continue
+            parts.append(delta)
+            chunks += 1
+            if scanner.feed(delta):
+                return ''.join(parts)[:scanner.end], chunks, True
+    finally:
+        deltas.close()
+    return ''.join(parts), chunks, False
+
+
 class OpenAI:
-    def __init__(self, model, api_key, temperature=0):
-        try:
-            # For newer versions of the API
-            self.client = openai.OpenAI(api_key=api_key, base_url="https://api.chatanywhere.tech/v1")
-        except (AttributeError, TypeError):
-            # For older versions of the API
-            openai.api_key = api_key
-            openai.api_base = "https://api.chatanywhere.tech/v1"
-
-            self.client = openai
-            
+    def __init__(self, model, api_key, temperature=0, scheduler=None, transport=None,
+                 base_url="https://api.chatanywhere.tech/v1", stream=False, logger=None):
+        self.base_url = base_url
+        # stream the completion and stop reading once the JSON object is complete
+        self.stream = stream
+        self.api_key = api_key
         self.model = model
         self.temperature = temperature
+        # retries, rate limits and concurrency are shared by all clients of the model
+        self.scheduler = scheduler or scheduler_registry.get('openai', model)
+        # and connections by all clients of every provider
+        self.transport = transport or http_transport
+        self.logger = logger or logging.getLogger(__name__)
 
-    @backoff.on_exception(backoff.expo, 
-                         Exception,  # Catch all exceptions for maximum compatibility
-                         max_tries=5, factor=2, max_time=60)
-    def create_chat_completion(self, messages):
+    def _request(self, messages, attempts, stop_at_object=False):
+        attempts.append(time.time())
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": self.temperature
+        }
+        if self.stream:
+            return self._stream_request(headers, payload, stop_at_object)
+        completion = self.transport.post_json(f"{self.base_url}/chat/completions", headers, payload)
         try:
-            # Try newer client.chat.completions.create format
+            content = completion["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError) as e:
+            raise ServerError(f"unexpected response: {str(completion)[:500]}") from e
+        usage = completion.get("usage") or {}
+        return content, usage.get("prompt_tokens"), usage.get("completion_tokens"), False, time.time()
+
+    def _stream_request(self, headers, payload, stop_at_object=False):
+        usage = {}
+
+        def deltas(events):
             try:
-                completion = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    temperature=self.temperature
-                )
-                return completion.choices[0].message.content
-            except (AttributeError, TypeError):
-                # Fall back to older ChatCompletion.create format
-                completion = self.client.ChatCompletion.create(
-                    model=self.model,
-                    messages=messages,
-                    temperature=self.temperature
-                )
-                return completion.choices[0].message.content
+                for event in events:
+                    if event.get("usage"):
+                        usage.update(event["usage"])
+                    for choice in event.get("choices") or []:
+                        yield (choice.get("delta") or {}).get("content")
+            finally:
+                events.close()
+
+        # without include_usage the stream carries no usage chunk at all
+        events = self.transport.post_stream(f"{self.base_url}/chat/completions", headers,
+                                            dict(payload, stream=True, stream_options={"include_usage": True}))
+        read = read_until_object if stop_at_object else read_all
+        content, chunks, stopped_early = read(deltas(events))
+        # each streamed chunk carries one token when the stream ends before reporting usage
+        return content, usage.get("prompt_tokens"), usage.get("completion_tokens", chunks), stopped_early, time.time()
+
+    def create_chat_completion(self, messages, stop_at_object=False):
+        """Return the completion of `messages`, API_ERROR_RESPONSE if the call failed.
+
+        With `stop_at_object`, for prompts that ask for a JSON object only, a
+        streamed completion is cut at the end of its first `{...}` object.
+        """
+        start = time.time()
+        attempts = []
+        try:
+            content, prompt_tokens, completion_tokens, stopped_early, ready = self.scheduler.call(
+                lambda: self._request(messages, attempts, stop_at_object), tokens=estimate_tokens(messages),
+                count_tokens=lambda result: None if result[1] is None else result[1] + (result[2] or 0))
         except Exception as e:
-            print(f"Error in OpenAI API call: {str(e)}")
+            self.logger.error(f"Error in OpenAI API call: {str(e)}")
+            usage_tracker.record('openai', self.model, None, None, time.time() - start,
+                                 max(0, len(attempts) - 1), failed=True)
             # Return a fallback response that can be properly parsed
-            return "{'error': 'API call failed'}"
+            return API_ERROR_RESPONSE
+        usage_tracker.record('openai', self.model, prompt_tokens, completion_tokens, time.time() - start,
+                             len(attempts) - 1, time_to_result=ready - start, stopped_early=stopped_early)
+        return content
+
+    async def acreate_chat_completion(self, messages, stop_at_object=False):
+        """Async variant of `create_chat_completion`, runs the call on a worker thread."""
+        return await asyncio.to_thread(self.create_chat_completion, messages, stop_at_object)
     
 class Claude:
-    def __init__(self, model, api_key, temperature=0):
+    def __init__(self, model, api_key, temperature=0, scheduler=None, transport=None, max_tokens=1000,
+                 stream=False, logger=None):
         self.Claude_url = "https://api.anthropic.com/v1"
+        self.stream = stream
         self.Claude_api_key = api_key
         self.model = model
         self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.scheduler = scheduler or scheduler_registry.get('claude', model)
+        self.transport = transport or http_transport
+        self.logger = logger or logging.getLogger(__name__)
+
+    @staticmethod
+    def to_messages(messages):
+        """Convert chat messages to the Messages API format.
+
+        System messages become the `system` prompt, consecutive messages of
+        the same role are joined since the API requires alternating roles,
+        and a conversation may not start with the assistant.
+
+        Returns:
+            (system prompt or None, messages)
+        """
+        system, converted = [], []
+        for message in messages:
+            if message["role"] == "system":
+                system.append(message["content"])
+            elif converted and converted[-1]["role"] == message["role"]:
+                converted[-1]["content"] += "\n\n" + message["content"]
+            else:
+                converted.append({"role": message["role"], "content": message["content"]})
+        if converted and converted[0]["role"] != "user":
+            converted.insert(0, {"role": "user", "content": "Continue."})
+        return ("\n\n".join(system) or None), converted
 
-    @backoff.on_exception(backoff.expo, (requests.exceptions.Timeout,requests.exceptions.ConnectionError,requests.exceptions.RequestException), max_tries=5, factor=2, max_time=60)
-    def create_chat_completion(self, messages):
-        # convert messages to string
-        formatted_string = "\n\n{}: {}\n\nAssistant: ".format("Human" if messages[0]["role"] == "user" else "Assistant", messages[0]["content"])
-        url = f"{self.Claude_url}/complete"
+    def _request(self, messages, attempts, stop_at_object=False):
+        attempts.append(time.time())
+        system, messages = self.to_messages(messages)
         headers = {
             "accept": "application/json",
             "anthropic-version": "2023-06-01",
             "x-api-key": self.Claude_api_key,
             "Content-Type": "application/json"
         }
-        
-        # Add your implementation here
-        # This is placeholder code and needs to be completed
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens
+        }
+        if system:
+            payload["system"] = system
+        if self.stream:
+            return self._stream_request(headers, payload, stop_at_object)
+        response = self.transport.post_json(f"{self.Claude_url}/messages", headers, payload)
         try:
-            response = requests.post(
-                url,
-                headers=headers,
-                json={
-                    "prompt": formatted_string,
-                    "model": self.model,
-                    "temperature": self.temperature,
-                    "max_tokens_to_sample": 1000
-                }
-            )
-            response.raise_for_status()
-            return response.json()["completion"]
+            content = "".join(block["text"] for block in response["content"] if block.get("type") == "text")
+        except (KeyError, TypeError) as e:
+            raise ServerError(f"unexpected response: {str(response)[:500]}") from e
+        usage = response.get("usage") or {}
+        return content, usage.get("input_tokens"), usage.get("output_tokens"), False, time.time()
+
+    def _stream_request(self, headers, payload, stop_at_object=False):
+        usage = {}
+
+        def deltas(events):
+            try:
+                for event in events:
+                    if event.get("type") == "error":
+                        error = event.get("error") or {}
+                        raise ServerError(f"{error.get('type')}: {error.get('message')}")
+                    if event.get("type") == "message_start":
+                        usage.update((event.get("message") or {}).get("usage") or {})
+                    elif event.get("type") == "message_delta":
+                        usage.update(event.get("usage") or {})
+                    elif event.get("type") == "content_block_delta":
+                        yield (event.get("delta") or {}).get("text")
+            finally:
+                events.close()
+
+        events = self.transport.post_stream(f"{self.Claude_url}/messages", headers, dict(payload, stream=True))
+        read = read_until_object if stop_at_object else read_all
+        content, chunks, stopped_early = read(deltas(events))
+        # output_tokens arrives with message_delta at the very end, count the chunks read when cut short
+        output_tokens = chunks if stopped_early else usage.get("output_tokens", chunks)
+        return content, usage.get("input_tokens"), output_tokens, stopped_early, time.time()
+
+    def create_chat_completion(self, messages, stop_at_object=False):
+        """Return the completion of `messages`, API_ERROR_RESPONSE if the call failed.
+
+        With `stop_at_object`, for prompts that ask for a JSON object only, a
+        streamed completion is cut at the end of its first `{...}` object.
+        """
+        start = time.time()
+        attempts = []
+        try:
+            content, prompt_tokens, completion_tokens, stopped_early, ready = self.scheduler.call(
+                lambda: self._request(messages, attempts, stop_at_object), tokens=estimate_tokens(messages),
+                count_tokens=lambda result: None if result[1] is None else result[1] + (result[2] or 0))
         except Exception as e:
-            print(f"Error in Claude API call: {str(e)}")
-            return "{'error': 'API call failed'}"
\ No newline at end of file
+            self.logger.error(f"Error in Claude API call: {str(e)}")
+            usage_tracker.record('claude', self.model, None, None, time.time() - start,
+                                 max(0, len(attempts) - 1), failed=True)
+            return API_ERROR_RESPONSE
+        usage_tracker.record('claude', self.model, prompt_tokens, completion_tokens, time.time() - start,
+                             len(attempts) - 1, time_to_result=ready - start, stopped_early=stopped_early)
+        return content
+
+    async def acreate_chat_completion(self, messages, stop_at_object=False):
+        """Async variant of `create_chat_completion`, runs the call on a worker thread."""
+        return await asyncio.to_thread(self.create_chat_completion, messages, stop_at_object)
@@ -0,0 +1,153 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.tqdm_logger import tqdm_with_logger
+from utils.usage import set_usage_context
+
+
+def run_sessions(items, worker, concurrency=8, logger=None, desc='Progress', store=None, batcher=None):
+    """Run one pipeline stage over many sessions concurrently.
+
+    Each ``(key, value)`` pair is handed to ``worker(key, value)``, a coroutine
+    that performs every LLM call of that session in order. Up to
+    ``concurrency`` sessions are in flight at once, so different sessions
+    overlap their network waits while each conversation stays sequential.
+
+    Args:
+        items: iterable of ``(key, value)`` pairs, e.g. ``dict.items()``
+        worker: async callable returning the session result, or None to drop it
+        concurrency: maximum number of sessions processed at the same time
+        logger: optional Logger used for progress reporting
+        desc: stage name shown by the progress bar
+        store: optional RunStore; each result is recorded under ``desc`` as
+            soon as it is produced, and sessions it already holds are skipped
+        batcher: optional BatchRunner; every session runs at once and the
+            calls of each turn are sent as one batch file
+
+    Returns:
+        dict of ``key -> result`` in the input order, without None results
+    """
+    return asyncio.run(_run_sessions(list(items), worker, concurrency, logger, desc, store, batcher))
+
+
+async def _run_sessions(items, worker, concurrency, logger, desc, store, batcher):
+    if batcher is not None:
+        # a turn can only be batched if every session has reached it
+        concurrency = len(items)
+        batcher.start_stage(desc)
+    concurrency = max(1, int(concurrency))
+    # blocking API clients run on worker threads, size the pool to the limit
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    results = [None] * len(items)
+    done = store.load(desc) if store is not None else {}
+    pending = []
+    for pos, (key, value) in enumerate(items):
+        if key in done:
+            results[pos] = done[key]
+        else:
+            pending.append((pos, key, value))
+    if logger and len(pending) < len(items):
+        logger.info(f"Resuming {desc}: {len(items) - len(pending)} sessions already completed")
+
+    progress = tqdm_with_logger(total=len(items), logger=logger, desc=desc, initial=len(items) - len(pending))
+
+    async def run_one(pos, key, value):
+        set_usage_context(desc, key)
+        async with semaphore:
+            start = time.time()
+            if batcher is None:
+                results[pos] = await worker(key, value)
+            else:
+                batcher.session_started()
+                try:
+                    results[pos] = await worker(key, value)
+                finally:
+                    batcher.session_finished()
+        if logger:
+            latency = time.time() - start
+            logger.debug(f"{desc}: test_id {key} done in {latency:.2f}s", latency=latency)
+        if store is not None:
+            store.record(desc, key, results[pos])
+        progress.update(1)
+
+    try:
+        await asyncio.gather(*(run_one(pos, key, value) for pos, key, value in pending))
+    finally:
+        progress.close()
+
+    return {key: res for (key, _), res in zip(items, results) if res is not None}
+
+
+def stream_sessions(items, worker, concurrency=8, logger=None, desc='Progress', total=None, store=None):
+    """Run whole sessions concurrently and yield each one as soon as it finishes.
+
+    Unlike `run_sessions`, ``items`` is consumed lazily and at most
+    ``concurrency`` sessions are held in memory, so a session can be emitted
+    before the later ones have even been built.
+
+    Args:
+        items: iterable of ``(key, value)`` pairs, e.g. a generator
+        worker: async callable returning the session result, or None to drop it
+        concurrency: maximum number of sessions processed at the same time
+        logger: optional Logger used for progress reporting
+        desc: stage name shown by the progress bar
+        total: number of items, if known, for the progress bar
+        store: optional RunStore; finished sessions are recorded under ``desc``
+            and sessions it already holds are replayed without calling ``worker``
+
+    Yields:
+        ``(key, result)`` pairs in completion order, without None results
+    """
+    concurrency = max(1, int(concurrency))
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    done = store.load(desc) if store is not None else {}
+    progress = tqdm_with_logger(total=total, logger=logger, desc=desc)
+
+    async def run_one(key, value):
+        set_usage_context(desc, key)
+        start = time.time()
+        result = await worker(key, value)
+        if logger:
+            latency = time.time() - start
+            # the worker moved the stage on, the latency is that of the whole session
+            set_usage_context(desc, key)
+            logger.debug(f"{desc}: test_id {key} done in {latency:.2f}s", latency=latency)
+        if store is not None:
+            store.record(desc, key, result)
+        return key, result
+
+    items = iter(items)
+    pending = set()
+    try:
+        while True:
+            # keep the pipeline full, build new sessions only when a slot is free
+            for key, value in items:
+                if key in done:
+                    progress.update(1)
+                    if done[key] is not None:
+                        yield key, done[key]
+                    continue
+                pending.add(loop.create_task(run_one(key, value)))
+                if len(pending) >= concurrency:
+                    break
+            if not pending:
+                break
+            finished, pending = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for task in finished:
+                key, result = task.result()
+                progress.update(1)
+                if result is not None:
+                    yield key, result
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        progress.close()
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
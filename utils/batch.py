@@ -0,0 +1,173 @@
+import asyncio
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.ChatAPI import API_ERROR_RESPONSE
+from utils.cache import cache_sample
+from utils.usage import current_dataset, current_test_id, set_usage_context
+
+
+class LocalBatchExecutor(object):
+    """`LocalBatchExecutor` processes a batch file with the local API clients.
+
+    It stands in for a bulk job service: every line of the input file is
+    sent through the client serving its model (a live, cached or replay
+    client) on a pool of worker threads, and the replies are written to an
+    output file in the same line format a batch service returns.
+    """
+
+    def __init__(self, clients, concurrency=8):
+        self.clients = {(client.model, float(client.temperature)): client for client in clients}
+        self.concurrency = max(1, int(concurrency))
+
+    def run(self, input_path, output_path, stage=None):
+        with open(input_path, 'r', encoding='utf-8') as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+
+        # pool threads do not inherit the context of the caller
+        dataset = current_dataset.get()
+
+        def complete(request):
+            body = request['body']
+            current_dataset.set(dataset)
+            cache_sample.set(request.get('sample'))
+            set_usage_context(stage, request['custom_id'].rsplit('-', 1)[0])
+            client = self.clients[(body['model'], float(body['temperature']))]
+            content = client.create_chat_completion(body['messages'])
+            if content == API_ERROR_RESPONSE:
+                return {'custom_id': request['custom_id'], 'response': None, 'error': {'message': 'API call failed'}}
+            return {'custom_id': request['custom_id'], 'error': None,
+                    'response': {'status_code': 200, 'body': {'model': body['model'], 'choices': [
+                        {'index': 0, 'message': {'role': 'assistant', 'content': content}}]}}}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results = list(pool.map(complete, requests))
+        with open(output_path, 'w', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+
+class BatchRunner(object):
+    """`BatchRunner` turns the calls of a whole stage into batch files, one per turn.
+
+    Every session of a stage runs as usual, but its API calls are parked
+    until all running sessions are waiting on one. The parked calls are then
+    written to a JSONL file with `custom_id` = "<test_id>-<turn>", the
+    executor processes the file and the replies are handed back from its
+    output file. Sessions thus advance in lockstep, so a multi-turn stage
+    such as self-correction becomes one batch per turn index.
+    """
+
+    def __init__(self, executor, batch_dir, logger=None):
+        self.executor = executor
+        self.batch_dir = batch_dir
+        self.logger = logger
+        if not os.path.exists(batch_dir):
+            os.makedirs(batch_dir)
+        self.start_stage(None)
+
+    def start_stage(self, stage):
+        """Reset the turn counters, called by `run_sessions` before a stage starts."""
+        self.stage = stage
+        self._turns = {}
+        self._pending = []
+        # sessions with a call in `_pending`; a session may park several, e.g. the rating fan-out
+        self._waiting = set()
+        self._active = 0
+        self._batches = 0
+        self._flushing = False
+
+    def session_started(self):
+        self._active += 1
+
+    def session_finished(self):
+        self._active -= 1
+        self._maybe_flush()
+
+    async def submit(self, client, messages):
+        """Park one API call until the batch of its turn has been processed."""
+        test_id = current_test_id.get()
+        turn = self._turns.get(test_id, 0)
+        self._turns[test_id] = turn + 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((f'{test_id}-{turn}', client, messages, cache_sample.get(), future))
+        self._waiting.add(test_id)
+        self._maybe_flush()
+        return await future
+
+    def _maybe_flush(self):
+        # every running session is waiting on a reply: nothing else can join this batch
+        if self._pending and len(self._waiting) >= self._active and not self._flushing:
+            self._flushing = True
+            asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        self._waiting = set()
+        name = re.sub(r'\W+', '_', str(self.stage)).strip('_').lower()
+        input_path = os.path.join(self.batch_dir, f'{name}_{self._batches:03d}.jsonl')
+        output_path = os.path.join(self.batch_dir, f'{name}_{self._batches:03d}_output.jsonl')
+        self._batches += 1
+        try:
+            with open(input_path, 'w', encoding='utf-8') as f:
+                for custom_id, client, messages, sample, _ in batch:
+                    request = {'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions',
+                               'body': {'model': client.model, 'temperature': client.temperature,
+                                        'messages': messages}}
+                    if sample is not None:
+                        # the cache sample of a repeated call, read back by the local executor
+                        request['sample'] = sample
+                    f.write(json.dumps(request, ensure_ascii=False) + '\n')
+            if self.logger:
+                self.logger.info(f"{self.stage}: submitting batch {input_path} with {len(batch)} requests")
+            await asyncio.to_thread(self.executor.run, input_path, output_path, self.stage)
+            replies = read_batch_output(output_path)
+        except Exception as e:
+            for _, _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._flushing = False
+        for custom_id, _, _, _, future in batch:
+            # a caller may have given up on its reply, e.g. a rating quorum was already reached
+            if not future.done():
+                future.set_result(replies.get(custom_id, API_ERROR_RESPONSE))
+        # sessions woken by this batch may finish without another call
+        self._maybe_flush()
+
+
+class BatchChat(object):
+    """`BatchChat` sends the async calls of a client through a `BatchRunner`."""
+
+    def __init__(self, client, runner):
+        self.client = client
+        self.runner = runner
+        self.provider = getattr(client, 'provider', type(client).__name__.lower())
+        self.model = client.model
+        self.temperature = client.temperature
+
+    def create_chat_completion(self, messages, stop_at_object=False):
+        return self.client.create_chat_completion(messages, stop_at_object=stop_at_object)
+
+    async def acreate_chat_completion(self, messages, stop_at_object=False):
+        # batch replies are complete completions, a batch request is never cut short
+        return await self.runner.submit(self.client, messages)
+
+
+def read_batch_output(path):
+    """Read a batch output file as a dict of custom_id -> reply, failed requests get the error sentinel."""
+    replies = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response')
+            if result.get('error') or not response or response.get('status_code') != 200:
+                replies[result['custom_id']] = API_ERROR_RESPONSE
+            else:
+                replies[result['custom_id']] = response['body']['choices'][0]['message']['content']
+    return replies
@@ -0,0 +1,167 @@
+import hashlib
+import os
+import pickle
+import re
+from functools import lru_cache
+
+import numpy as np
+
+from utils.dataset import CompactTable
+
+INDEX_VERSION = 1
+
+# 'productN' references in generated bundles, N is 1-based in the session item list
+PRODUCT_REF = re.compile(r'product\s*(\d+)', re.IGNORECASE)
+TRAILING_NUMBER = re.compile(r'(\d+)\s*$')
+
+
+@lru_cache(maxsize=4096)
+def product_number(ref):
+    """Return N of a 'productN' reference, None if it holds no number."""
+    if not isinstance(ref, str):
+        return None
+    match = PRODUCT_REF.search(ref) or TRAILING_NUMBER.search(ref)
+    return int(match.group(1)) if match else None
+
+
+class BundleIndex(object):
+    """`BundleIndex` holds the parsed items and ground-truth bundles of a dataset.
+
+    Every session's item list is split once, items are numbered as bits of
+    the session and each ground-truth bundle is kept as a frozenset and a
+    bitmask. Subset queries against the ground truth are memoized per
+    (session, candidate mask), so repeated queries are O(1).
+    """
+
+    def __init__(self, session_items, session_bundles):
+        self.items = {}
+        self.bits = {}
+        self.pos_bits = {}
+        self.gt_sets = {}
+        self.gt_masks = {}
+        self.gt_sizes = {}
+        self._match_cache = {}
+        for session_idx, items in session_items.items():
+            self._add_session(session_idx, items, session_bundles.get(session_idx, []))
+
+    def _add_session(self, session_idx, items, bundles):
+        all_items = tuple(items.split(','))
+        bits = {item: i for i, item in enumerate(all_items)}
+        next_bit = len(all_items)
+        gt_sets, gt_masks = [], []
+        for bundle in bundles:
+            bundle_set = frozenset(bundle[-1].split(','))
+            mask = 0
+            for item in bundle_set:
+                bit = bits.get(item)
+                if bit is None:
+                    # ground-truth items missing from the session list still need a bit
+                    bit = bits[item] = next_bit
+                    next_bit += 1
+                mask |= 1 << bit
+            gt_sets.append(bundle_set)
+            gt_masks.append(mask)
+        self.items[session_idx] = all_items
+        self.bits[session_idx] = bits
+        self.pos_bits[session_idx] = tuple(bits[item] for item in all_items)
+        self.gt_sets[session_idx] = tuple(gt_sets)
+        self.gt_masks[session_idx] = tuple(gt_masks)
+        self.gt_sizes[session_idx] = tuple(len(bundle_set) for bundle_set in gt_sets)
+
+    @classmethod
+    def from_dataset(cls, dataset, data_path, cache_dir=None, logger=None):
+        """Build the index of a dataset returned by `load_dataset`.
+
+        The memory-mapped tables of the compact layout are indexed as they
+        are; the `.npy` files behind pickled dicts go through `load` and its
+        cache.
+        """
+        session_items = dataset['session_items']
+        session_bundles = dataset['session_bundles_deduplication']
+        if isinstance(session_items, CompactTable):
+            return cls(session_items, session_bundles)
+        return cls.load(os.path.join(data_path, 'session_items.npy'),
+                        os.path.join(data_path, 'session_bundles_deduplication.npy'), cache_dir=cache_dir, logger=logger)
+
+    @classmethod
+    def load(cls, session_items_path, session_bundles_path, cache_dir=None, logger=None):
+        """Build the index of two `.npy` dataset files, reusing a cached copy when possible.
+
+        The cache file is keyed on the hash of both source files, so it is
+        rebuilt whenever the data changes.
+        """
+        digest = hashlib.sha256()
+        for path in (session_items_path, session_bundles_path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, f'bundle_index_v{INDEX_VERSION}_{digest.hexdigest()[:16]}.pkl')
+            if os.path.exists(cache_path):
+                with open(cache_path, 'rb') as f:
+                    index = pickle.load(f)
+                if logger:
+                    logger.info(f"Loaded bundle index from cache: {cache_path}")
+                return index
+
+        session_items = np.load(session_items_path, allow_pickle=True).item()
+        session_bundles = np.load(session_bundles_path, allow_pickle=True).item()
+        index = cls(session_items, session_bundles)
+        if cache_path is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            with open(cache_path, 'wb') as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            if logger:
+                logger.info(f"Saved bundle index to cache: {cache_path}")
+        return index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_match_cache'] = {}
+        return state
+
+    def product_item(self, session_idx, ref):
+        """Return the item id a 'productN' reference points to, None if it is invalid."""
+        num = product_number(ref) if isinstance(ref, str) else None
+        items = self.items[session_idx]
+        if num is None or not 0 < num <= len(items):
+            return None
+        return items[num-1]
+
+    def resolve(self, session_idx, refs):
+        """Return the set of item ids of a generated bundle, None if any reference is invalid."""
+        items = self.items[session_idx]
+        reidx_items = set()
+        for ref in refs:
+            num = product_number(ref) if isinstance(ref, str) else None
+            if num is None or not 0 < num <= len(items):
+                return None
+            reidx_items.add(items[num-1])
+        return reidx_items
+
+    def mask(self, session_idx, item_ids):
+        """Return the bitmask of a set of item ids, None if one is not in the session."""
+        bits = self.bits[session_idx]
+        mask = 0
+        for item in item_ids:
+            bit = bits.get(item)
+            if bit is None:
+                return None
+            mask |= 1 << bit
+        return mask
+
+    def match(self, session_idx, item_ids):
+        """Return the position of the first ground-truth bundle containing `item_ids`, None if none does."""
+        mask = self.mask(session_idx, item_ids)
+        if mask is None:
+            return None
+        key = (session_idx, mask)
+        if key not in self._match_cache:
+            self._match_cache[key] = next((pos for pos, gt_mask in enumerate(self.gt_masks[session_idx])
+                                           if mask & ~gt_mask == 0), None)
+        return self._match_cache[key]
+
+    def session_encoding(self, session_idx):
+        """Return (bit of each item position, ground-truth masks, ground-truth sizes) of a session."""
+        return self.pos_bits[session_idx], self.gt_masks[session_idx], self.gt_sizes[session_idx]
@@ -0,0 +1,198 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from utils.ChatAPI import API_ERROR_RESPONSE
+
+# Sample index of the calls made from now on in this task, for repeats that must be answered independently
+# even at temperature 0, such as the rating repeats; None numbers repeats by temperature (`SampleCounter`)
+cache_sample = contextvars.ContextVar('cache_sample', default=None)
+
+
+class ResponseCache(object):
+    """`ResponseCache` is a content-addressed on-disk store for LLM completions.
+
+    Completions are keyed on a hash of (provider, model, temperature, messages)
+    and kept in a SQLite database. When the stored responses grow beyond
+    `max_size_mb`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_size_mb=512):
+        """Initializes a new `ResponseCache` instance.
+
+        Args:
+            path (str): SQLite file to use. The directory component of this
+                file will be created automatically if it is not existing.
+            max_size_mb (float): size limit of the stored responses in MB.
+        """
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # the API clients run on worker threads, the lock serializes access
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                response TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                last_access REAL NOT NULL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(provider, model, temperature, messages, sample=0):
+        """Hash a request into the key of its cache entry.
+
+        `sample` tells apart repeated requests that must get independent
+        answers; sample 0 keeps the key of a request without one.
+        """
+        request = [provider, model, float(temperature), messages] + ([sample] if sample else [])
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached response of `key`, None on a miss."""
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key, response):
+        """Store a response, failed calls are never cached."""
+        if not isinstance(response, str) or response == API_ERROR_RESPONSE:
+            return
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                               (key, response, size, time.time()))
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_size:
+            return
+        # drop the least recently used entries until we are back under the limit
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if total <= self.max_size:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        """Return the hit/miss counters of this cache."""
+        lookups = self.hits + self.misses
+        return {
+            'cache_hits': self.hits,
+            'cache_misses': self.misses,
+            'cache_hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'cache_evictions': self.evictions,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SampleCounter(object):
+    """`SampleCounter` numbers the repeats of identical sampled requests.
+
+    At a temperature above 0 every repeat of a request is a new sample, so
+    the n-th identical request of a run gets sample index n and its own
+    cache or replay entry. A rerun sends the repeats again in the same
+    numbering and is served the same samples. At temperature 0 the index
+    is always 0 and repeats share one entry. A `cache_sample` set by the
+    caller takes precedence at any temperature.
+    """
+
+    def __init__(self, temperature):
+        self.sampled = float(temperature) > 0
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def next(self, key):
+        """Return the sample index of the next request with request key `key`."""
+        sample = cache_sample.get()
+        if sample is not None:
+            return sample
+        if not self.sampled:
+            return 0
+        with self._lock:
+            sample = self._counts.get(key, 0)
+            self._counts[key] = sample + 1
+        return sample
+
+
+class CachedChat(object):
+    """Wrap a chat client so identical requests are answered from a `ResponseCache`.
+
+    Identical requests that are in flight at the same time are coalesced: only
+    the first one is sent, the others wait for its response. At a temperature
+    above 0, repeats of a request are separate samples, see `SampleCounter`.
+    """
+
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+        self.provider = getattr(client, 'provider', type(client).__name__.lower())
+        self.model = client.model
+        self.temperature = client.temperature
+        self._inflight_lock = threading.Lock()
+        self._inflight = {}
+        self._samples = SampleCounter(self.temperature)
+
+    def _key(self, messages):
+        key = ResponseCache.make_key(self.provider, self.model, self.temperature, messages)
+        sample = self._samples.next(key)
+        return ResponseCache.make_key(self.provider, self.model, self.temperature, messages, sample) if sample else key
+
+    def create_chat_completion(self, messages, stop_at_object=False):
+        key = self._key(messages)
+        # look up and register under one lock: an owner stores its response before it leaves `_inflight`,
+        # so a request either finds the response, waits for the owner or becomes the owner itself
+        with self._inflight_lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            event = self._inflight.get(key)
+            owner = event is None
+            if owner:
+                event = self._inflight[key] = threading.Event()
+
+        if not owner:
+            # an identical request is already on the wire, reuse its answer
+            event.wait()
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            return self.client.create_chat_completion(messages, stop_at_object=stop_at_object)
+
+        try:
+            response = self.client.create_chat_completion(messages, stop_at_object=stop_at_object)
+            self.cache.put(key, response)
+            return response
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            event.set()
+
+    async def acreate_chat_completion(self, messages, stop_at_object=False):
+        """Async variant of `create_chat_completion`, runs the call on a worker thread."""
+        return await asyncio.to_thread(self.create_chat_completion, messages, stop_at_object)
+
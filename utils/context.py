@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from utils.json_extract import extract_object
+from utils.scheduler import estimate_tokens
+from utils.usage import current_stage, current_test_id
+
+
+def answer_kind(content):
+    """Classify an assistant answer as 'bundle', 'intent' or None by the object it holds."""
+    if '{' not in content:
+        return None
+    try:
+        value = extract_object(content)
+    except ValueError:
+        return None
+    if not isinstance(value, dict) or not value:
+        return None
+    if all(isinstance(v, (list, tuple, set)) for v in value.values()):
+        return 'bundle'
+    if all(isinstance(v, str) for v in value.values()):
+        return 'intent'
+    return None
+
+
+class ContextCompactor(object):
+    """`ContextCompactor` fits a conversation into a token budget before it is sent.
+
+    The conversation is split into turns (a user message and the answer to
+    it). The original prompt, the latest bundle answer, the latest intent
+    answer, the last `keep_recent` turns and the pending question are always
+    kept. Superseded turns, such as earlier self-correction and feedback
+    rounds, are dropped oldest first until the estimated size fits
+    `max_tokens`, and a one-line note tells the model how many were left
+    out. Every call's size before and after is recorded.
+
+    Args:
+        max_tokens (int): token budget of one request.
+        keep_recent (int): number of latest turns that are never dropped.
+    """
+
+    def __init__(self, max_tokens, keep_recent=1):
+        self.max_tokens = max_tokens
+        self.keep_recent = keep_recent
+        self._lock = threading.Lock()
+        self.records = []
+
+    @staticmethod
+    def _turns(messages):
+        """Split messages into turns, lists of consecutive message positions ending with an answer."""
+        turns, turn = [], []
+        for pos, message in enumerate(messages):
+            turn.append(pos)
+            if message['role'] == 'assistant':
+                turns.append(turn)
+                turn = []
+        return turns, turn
+
+    def compact(self, messages):
+        """Return `messages` fitted into the budget, unchanged if they already fit."""
+        sizes = [estimate_tokens([message]) for message in messages]
+        before = sum(sizes)
+        if before <= self.max_tokens:
+            self._record(before, before, 0)
+            return messages
+
+        turns, pending = self._turns(messages)
+        latest = {}
+        for t, turn in enumerate(turns):
+            kind = answer_kind(messages[turn[-1]]['content'])
+            if kind is not None:
+                latest[kind] = t
+        # the first turn holds the original prompt
+        pinned = {0} | set(latest.values()) | set(range(max(0, len(turns) - self.keep_recent), len(turns)))
+
+        size = before
+        dropped = set()
+        for t, turn in enumerate(turns):
+            if size <= self.max_tokens:
+                break
+            if t in pinned:
+                continue
+            dropped.add(t)
+            size -= sum(sizes[pos] for pos in turn)
+        if not dropped:
+            self._record(before, before, 0)
+            return messages
+
+        compacted = []
+        note_pending = False
+        for t, turn in enumerate(turns + [pending]):
+            if t in dropped:
+                note_pending = True
+                continue
+            for pos in turn:
+                message = messages[pos]
+                if note_pending and message['role'] == 'user':
+                    message = {'role': 'user', 'content': f"({len(dropped)} earlier turns were superseded and "
+                                                          f"left out.)\n{message['content']}"}
+                    note_pending = False
+                compacted.append(message)
+        after = sum(estimate_tokens([message]) for message in compacted)
+        self._record(before, after, len(dropped))
+        return compacted
+
+    def _record(self, before, after, dropped):
+        with self._lock:
+            self.records.append({
+                'stage': current_stage.get(),
+                'test_id': current_test_id.get(),
+                'context_tokens': before,
+                'sent_tokens': after,
+                'dropped_turns': dropped,
+            })
+
+    def stats(self):
+        """Return the number of compacted calls and the estimated context tokens before and after."""
+        with self._lock:
+            records = list(self.records)
+        before = np.array([rec['context_tokens'] for rec in records] or [0])
+        after = np.array([rec['sent_tokens'] for rec in records] or [0])
+        return {
+            'context_calls': len(records),
+            'context_compacted_calls': sum(rec['dropped_turns'] > 0 for rec in records),
+            'context_tokens': int(before.sum()),
+            'context_sent_tokens': int(after.sum()),
+            'context_tokens_p95': round(float(np.percentile(before, 95)), 1),
+            'context_sent_tokens_p95': round(float(np.percentile(after, 95)), 1),
+        }
+
+    def save(self, path):
+        """Write the stats and the size of every call to a JSON file."""
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        with self._lock:
+            records = list(self.records)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'summary': self.stats(), 'calls': records}, f, indent=2, default=str)
+
+
+class CompactingChat(object):
+    """Wrap a chat client so every request is fitted into a `ContextCompactor` budget first."""
+
+    def __init__(self, client, compactor):
+        self.client = client
+        self.compactor = compactor
+        self.provider = getattr(client, 'provider', type(client).__name__.lower())
+        self.model = client.model
+        self.temperature = client.temperature
+
+    def create_chat_completion(self, messages, stop_at_object=False):
+        return self.client.create_chat_completion(self.compactor.compact(messages), stop_at_object=stop_at_object)
+
+    async def acreate_chat_completion(self, messages, stop_at_object=False):
+        return await self.client.acreate_chat_completion(self.compactor.compact(messages),
+                                                         stop_at_object=stop_at_object)
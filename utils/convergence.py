@@ -0,0 +1,61 @@
+import threading
+
+from utils.bundle_index import product_number
+from utils.usage import current_dataset
+
+
+def normalize_bundles(bundle_dict):
+    """Return a parsed bundle dict as a set of product sets, ignoring bundle keys and order.
+
+    Products are compared by their number, so 'product3', 'Product 3' and
+    '3' are the same product. Returns None if `bundle_dict` is not a dict.
+    """
+    if not isinstance(bundle_dict, dict):
+        return None
+    bundles = set()
+    for items in bundle_dict.values():
+        if isinstance(items, str) or not hasattr(items, '__iter__'):
+            items = [items]
+        products = set()
+        for item in items:
+            num = product_number(item) if isinstance(item, str) else None
+            products.add(num if num is not None else str(item).strip().lower())
+        bundles.add(frozenset(products))
+    return frozenset(bundles)
+
+
+class ConvergenceTracker(object):
+    """`ConvergenceTracker` counts the iterations a loop skipped because its result converged.
+
+    Each stage loop reports, per session, how many of its LLM calls it did
+    not need to make, so the summary shows what early stopping saved.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+
+    def record(self, stage, saved_calls):
+        """Record one session of `stage` that stopped `saved_calls` calls early (0 if it ran to the end)."""
+        with self._lock:
+            stats = self.stages.setdefault((current_dataset.get(), stage),
+                                           {'sessions': 0, 'stopped_early': 0, 'saved_calls': 0})
+            stats['sessions'] += 1
+            stats['stopped_early'] += saved_calls > 0
+            stats['saved_calls'] += saved_calls
+
+    def summary(self, dataset=None):
+        """Return the counts per stage, of one dataset if given."""
+        summary = {}
+        with self._lock:
+            for (stage_dataset, stage), stats in self.stages.items():
+                if dataset is not None and stage_dataset != dataset:
+                    continue
+                total = summary.setdefault(stage, {'sessions': 0, 'stopped_early': 0, 'saved_calls': 0})
+                for key, value in stats.items():
+                    total[key] += value
+        return summary
+
+
+# Shared by the stage loops in `utils.stages`
+convergence_tracker = ConvergenceTracker()
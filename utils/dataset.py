@@ -0,0 +1,308 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not POSIX, e.g. Windows
+    fcntl = None
+
+import numpy as np
+
+DATASET_FILES = ['training_set', 'test_set', 'TopK_related_sessions', 'session_items',
+                 'session_bundles_deduplication', 'item_titles']
+COMPACT_VERSION = 1
+COMPACT_DIR = 'compact'
+
+
+def _write_strings(out_dir, name, strings):
+    """Write strings as an offset table and a utf-8 byte array."""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    np.save(os.path.join(out_dir, f'{name}.offsets.npy'), offsets)
+    np.save(os.path.join(out_dir, f'{name}.data.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+
+def _write_csr(out_dir, name, rows, dtype):
+    """Write a list of integer lists as CSR `indptr` / `indices` arrays."""
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=indptr[1:])
+    np.save(os.path.join(out_dir, f'{name}.indptr.npy'), indptr)
+    np.save(os.path.join(out_dir, f'{name}.indices.npy'), np.array([v for row in rows for v in row], dtype=dtype))
+
+
+def _write_keys(out_dir, name, keys):
+    np.save(os.path.join(out_dir, f'{name}.keys.npy'), np.array(keys, dtype=np.int64))
+
+
+def source_stamp(data_path):
+    """Size and modification time of the six `.npy` files of a dataset."""
+    stamp = {}
+    for name in DATASET_FILES:
+        stat = os.stat(os.path.join(data_path, f'{name}.npy'))
+        stamp[name] = [stat.st_size, stat.st_mtime_ns]
+    return stamp
+
+
+def convert_dataset(data_path, out_dir=None):
+    """Write a dataset in the compact, memory-mappable layout.
+
+    Item ids become integers into a shared item table, session items,
+    bundles and neighbours become CSR arrays and every string is stored in
+    an offset table. Dict order is kept, so iterating the loaded tables
+    gives the same order as the pickled dicts.
+
+    The files are written to a temporary directory next to `out_dir` and
+    then moved into place with `os.replace`, `meta.json` last. A file that
+    another process has mapped is thus never truncated or rewritten: the
+    mapping keeps the old file until it is closed.
+
+    Returns:
+        str: the directory written to, `<data_path>/compact/` by default
+    """
+    out_dir = out_dir or os.path.join(data_path, COMPACT_DIR)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f'.{os.path.basename(os.path.normpath(out_dir))}-',
+                               dir=os.path.dirname(os.path.normpath(out_dir)))
+    try:
+        _convert(data_path, tmp_dir)
+        names = sorted(os.listdir(tmp_dir), key=lambda name: name == 'meta.json')
+        for name in names:
+            os.replace(os.path.join(tmp_dir, name), os.path.join(out_dir, name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out_dir
+
+
+def _convert(data_path, out_dir):
+    data = {name: np.load(os.path.join(data_path, f'{name}.npy'), allow_pickle=True).item() for name in DATASET_FILES}
+
+    session_items = data['session_items']
+    session_bundles = data['session_bundles_deduplication']
+    vocab = set()
+    for items in session_items.values():
+        vocab.update(items.split(','))
+    for bundles in session_bundles.values():
+        for bundle in bundles:
+            vocab.update(bundle[-1].split(','))
+    vocab = sorted(vocab)
+    item_id = {item: i for i, item in enumerate(vocab)}
+    _write_strings(out_dir, 'items', vocab)
+
+    for name in ('training_set', 'test_set'):
+        _write_keys(out_dir, name, list(data[name]))
+        _write_strings(out_dir, name, list(data[name].values()))
+
+    _write_keys(out_dir, 'TopK_related_sessions', list(data['TopK_related_sessions']))
+    _write_csr(out_dir, 'TopK_related_sessions', list(data['TopK_related_sessions'].values()), np.int64)
+
+    _write_keys(out_dir, 'session_items', list(session_items))
+    _write_csr(out_dir, 'session_items', [[item_id[item] for item in items.split(',')]
+                                          for items in session_items.values()], np.int32)
+
+    bundles = [bundle for session in session_bundles.values() for bundle in session]
+    _write_keys(out_dir, 'session_bundles_deduplication', list(session_bundles))
+    # bundles are stored in session order, so a session's bundles are one contiguous run
+    bundle_indptr = np.zeros(len(session_bundles) + 1, dtype=np.int64)
+    np.cumsum([len(session) for session in session_bundles.values()], out=bundle_indptr[1:])
+    np.save(os.path.join(out_dir, 'session_bundles_deduplication.indptr.npy'), bundle_indptr)
+    _write_strings(out_dir, 'bundle_intents', [bundle[0] for bundle in bundles])
+    _write_csr(out_dir, 'bundle_items', [[item_id[item] for item in bundle[-1].split(',')] for bundle in bundles],
+               np.int32)
+
+    _write_strings(out_dir, 'item_titles.keys', list(data['item_titles']))
+    _write_strings(out_dir, 'item_titles', list(data['item_titles'].values()))
+
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'version': COMPACT_VERSION, 'source': source_stamp(data_path),
+                   'sizes': {name: len(data[name]) for name in DATASET_FILES}}, f, indent=2)
+
+
+class _Strings(object):
+    """`_Strings` decodes entries of an offset table on access."""
+
+    def __init__(self, arrays, name):
+        self.offsets = arrays(f'{name}.offsets')
+        self.data = arrays(f'{name}.data')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tobytes().decode('utf-8')
+
+    def tolist(self):
+        data, offsets = self.data.tobytes(), self.offsets.tolist()
+        return [data[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:])]
+
+
+class CompactTable(Mapping, ABC):
+    """`CompactTable` is a read-only dict over the memory-mapped arrays of one dataset file.
+
+    Values are decoded on access, so only the entries that are used are
+    ever turned into Python objects. The key -> row index is built on the
+    first lookup.
+    """
+
+    def __init__(self, compact_dir, name):
+        self.compact_dir = compact_dir
+        self.name = name
+        self._arrays = {}
+        self._rows = None
+
+    def _array(self, name):
+        if name not in self._arrays:
+            # a plain ndarray view of the mapping indexes faster than np.memmap
+            self._arrays[name] = np.load(os.path.join(self.compact_dir, f'{name}.npy'), mmap_mode='r').view(np.ndarray)
+        return self._arrays[name]
+
+    def __reduce__(self):
+        # worker processes reopen the files and share the mapped pages
+        return type(self), (self.compact_dir, self.name)
+
+    def _keys(self):
+        return self._array(f'{self.name}.keys').tolist()
+
+    def _row(self, key):
+        if self._rows is None:
+            self._rows = {k: row for row, k in enumerate(self._keys())}
+        return self._rows.get(key)
+
+    def __getitem__(self, key):
+        row = self._row(key)
+        if row is None:
+            raise KeyError(key)
+        return self._decode(row)
+
+    def __contains__(self, key):
+        return self._row(key) is not None
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._array(f'{self.name}.keys')) if self._rows is None else len(self._rows)
+
+    @abstractmethod
+    def _decode(self, row):
+        """Return the value stored in `row`."""
+
+
+class StringTable(CompactTable):
+    """session id -> string, e.g. `training_set` and `test_set`."""
+
+    def _decode(self, row):
+        return _Strings(self._array, self.name)[row]
+
+
+class NeighborTable(CompactTable):
+    """session id -> list of related session ids."""
+
+    def _decode(self, row):
+        indptr = self._array(f'{self.name}.indptr')
+        return self._array(f'{self.name}.indices')[indptr[row]:indptr[row+1]].tolist()
+
+
+class SessionItemTable(CompactTable):
+    """session id -> comma separated item ids."""
+
+    def _decode(self, row):
+        items = _Strings(self._array, 'items')
+        indptr = self._array(f'{self.name}.indptr')
+        return ','.join([items[i] for i in self._array(f'{self.name}.indices')[indptr[row]:indptr[row+1]]])
+
+
+class SessionBundleTable(CompactTable):
+    """session id -> list of (intent, comma separated item ids)."""
+
+    def _decode(self, row):
+        items = _Strings(self._array, 'items')
+        intents = _Strings(self._array, 'bundle_intents')
+        session_indptr = self._array(f'{self.name}.indptr')
+        item_indptr = self._array('bundle_items.indptr')
+        item_indices = self._array('bundle_items.indices')
+        bundles = []
+        for b in range(session_indptr[row], session_indptr[row+1]):
+            bundles.append((intents[b], ','.join([items[i] for i in item_indices[item_indptr[b]:item_indptr[b+1]]])))
+        return bundles
+
+
+class ItemTitleTable(CompactTable):
+    """item id -> title."""
+
+    def _keys(self):
+        return _Strings(self._array, f'{self.name}.keys').tolist()
+
+    def __len__(self):
+        return len(_Strings(self._array, f'{self.name}.keys'))
+
+    def _decode(self, row):
+        return _Strings(self._array, self.name)[row]
+
+
+TABLES = {
+    'training_set': StringTable,
+    'test_set': StringTable,
+    'TopK_related_sessions': NeighborTable,
+    'session_items': SessionItemTable,
+    'session_bundles_deduplication': SessionBundleTable,
+    'item_titles': ItemTitleTable,
+}
+
+
+def _is_current(compact_dir, data_path):
+    meta_path = os.path.join(compact_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return meta.get('version') == COMPACT_VERSION and meta.get('source') == source_stamp(data_path)
+
+
+@contextmanager
+def _conversion_lock(data_path):
+    """Hold an exclusive lock on the dataset's conversion; a no-op without `fcntl`.
+
+    The conversion replaces its files atomically, so without the lock
+    concurrent runs only duplicate the work.
+    """
+    with open(os.path.join(data_path, f'{COMPACT_DIR}.lock'), 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def load_dataset(data_path, compact=True, logger=None):
+    """Load the six dataset files as dicts keyed by file name.
+
+    With `compact`, the memory-mapped layout in `<data_path>/compact/` is
+    used and (re)built from the `.npy` files when it is missing or they
+    changed since; otherwise the pickled dicts are loaded as before.
+    """
+    if not compact:
+        return {name: np.load(os.path.join(data_path, f'{name}.npy'), allow_pickle=True).item() for name in DATASET_FILES}
+
+    compact_dir = os.path.join(data_path, COMPACT_DIR)
+    if not _is_current(compact_dir, data_path):
+        # concurrent runs convert one at a time, the others find the result when they get the lock
+        with _conversion_lock(data_path):
+            if not _is_current(compact_dir, data_path):
+                if logger:
+                    logger.info(f"Converting dataset to the compact format: {compact_dir}")
+                convert_dataset(data_path, compact_dir)
+    return {name: table(compact_dir, name) for name, table in TABLES.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a dataset to the compact memory-mapped format')
+    parser.add_argument('data_paths', nargs='+', help='dataset directories such as data/electronic/')
+    args = parser.parse_args()
+    for data_path in args.data_paths:
+        print(f"Wrote {convert_dataset(data_path)}")
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+
+# stages of the refinement chain, as the usage records are tagged
+REFINEMENT_STAGES = ('Self-correction', 'Bundle feedback', 'Intent feedback', 'Rating intents')
+# settings the refined demonstration of a related session depends on
+DEMO_SETTINGS = ['model', 'temperature', 'self_correction_max_iter', 'feedback_iteration', 'intent_rating_repeats',
+                 'rating_quorum', 'rating_tolerance', 'max_context_length', 'context_keep_recent',
+                 'stream_completions', 'llm_backend']
+# and the prompts, which live in these files
+DEMO_SOURCES = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'prompt', 'prompts.py'),
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stages.py')]
+
+
+def demo_fingerprint(config):
+    """Hash of the settings, rater models and prompt sources that shape a refined demonstration."""
+    settings = {key: config.get(key) for key in DEMO_SETTINGS}
+    # rater models without their API keys
+    settings['intent_raters'] = [{provider: {k: v for k, v in rater.items() if k != 'api_key'}
+                                  for provider, rater in rater_config.items()}
+                                 for rater_config in config.get('intent_raters', [])]
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+    for path in DEMO_SOURCES:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class DemoBank(object):
+    """`DemoBank` keeps the refined demonstration context of every related session across runs.
+
+    Self-correction, bundle feedback, intent regeneration and intent rating
+    only depend on the related training session, so their result is stored
+    once per session and reused by every test session that has it as its
+    top-1 neighbour, in this run and in later ones. Entries are keyed on a
+    fingerprint of the settings and prompts (see `demo_fingerprint`), so a
+    change to either starts a new set of demonstrations. A related session
+    that refinement dropped, because its bundles did not parse or held
+    hallucinated products, is stored with demonstration None so that it is
+    not refined again; callers skip these entries.
+    """
+
+    def __init__(self, path, fingerprint):
+        """Initializes a new `DemoBank` instance.
+
+        Args:
+            path (str): SQLite file to use. The directory component of this
+                file will be created automatically if it is not existing.
+            fingerprint (str): fingerprint of the current settings.
+        """
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        self.fingerprint = fingerprint
+        # shard workers of one dataset share the bank
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS demos (
+                               fingerprint TEXT NOT NULL,
+                               session TEXT NOT NULL,
+                               value BLOB NOT NULL,
+                               calls INTEGER NOT NULL,
+                               PRIMARY KEY (fingerprint, session))""")
+        self.conn.commit()
+
+    def load(self):
+        """Return the stored demonstrations as a dict of `session -> (demonstration, calls it took)`.
+
+        The demonstration of a dropped session is None.
+        """
+        rows = self.conn.execute("SELECT value, calls FROM demos WHERE fingerprint = ?", (self.fingerprint,))
+        demos = {}
+        for value, calls in rows.fetchall():
+            session, demonstration = pickle.loads(value)
+            demos[session] = (demonstration, calls)
+        return demos
+
+    def record(self, demos):
+        """Store a dict of `session -> (demonstration, calls it took)`."""
+        rows = [(self.fingerprint, repr(session), pickle.dumps((session, demonstration),
+                                                               protocol=pickle.HIGHEST_PROTOCOL), calls)
+                for session, (demonstration, calls) in demos.items()]
+        self.conn.executemany("INSERT OR REPLACE INTO demos (fingerprint, session, value, calls) VALUES (?, ?, ?, ?)",
+                              rows)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def demo_savings(related_session, demo_calls, refined, reused):
+    """Return how many refinement calls sharing demonstrations saved.
+
+    Args:
+        related_session (dict): test_id -> related session, of the test sessions that needed a demonstration.
+        demo_calls (dict): related session -> calls its refinement took, in this run or the run that banked it.
+        refined (iterable): related sessions refined in this run.
+        reused (iterable): related sessions taken from the demo bank.
+
+    Returns:
+        dict with the number of test sessions, related sessions, refined and
+        reused demonstrations, the refinement calls made and the calls a
+        separate chain per test session would have made on top
+    """
+    refined, reused = set(refined), set(reused)
+    made = sum(demo_calls.get(session, 0) for session in refined)
+    per_test_session = sum(demo_calls.get(session, 0) for session in related_session.values())
+    return {
+        'test_sessions': len(related_session),
+        'related_sessions': len(set(related_session.values())),
+        'demos_refined': len(refined),
+        'demos_reused': len(reused),
+        'refinement_calls': made,
+        'refinement_calls_saved': per_test_session - made,
+    }
@@ -0,0 +1,150 @@
+import glob
+import os
+
+import numpy as np
+
+from utils.functions import output_parser, process_results
+from utils.metrics import MetricsEngine
+from utils.run_store import RunStore
+from utils.shards import load_shard_predictions
+
+METRICS = ('precision', 'recall', 'coverage')
+# run store stages holding the final bundles: parsed bundles in --stream, test contexts otherwise
+STREAM_STAGE = 'Streaming sessions'
+TEST_STAGE = 'Generating test bundles'
+# bootstrap weights are drawn in blocks of at most this many entries
+MAX_BLOCK_WEIGHTS = 1 << 24
+
+
+def _bundles_from_store(path):
+    store = RunStore(path, resume=True)
+    try:
+        bundle_res = {test_id: bundles for test_id, bundles in store.load(STREAM_STAGE).items() if bundles is not None}
+        for test_id, value in store.load(TEST_STAGE).items():
+            if value is None:
+                continue
+            parsered_res = output_parser(value[1][-3]['content'])
+            if parsered_res['state_code'] != 404:
+                bundle_res[test_id] = parsered_res['output']
+    finally:
+        store.close()
+    if not bundle_res:
+        raise ValueError(f"{path} holds no '{STREAM_STAGE}' or '{TEST_STAGE}' results")
+    return bundle_res
+
+
+def load_bundle_res(path, test_set=None):
+    """Return the generated bundles of a run, before `process_results`.
+
+    Args:
+        path (str): a `bundle_res.npy`, a run store, a shard `predictions.pkl`,
+            a run directory holding `bundle_res.npy` or `run_store.sqlite`, or
+            the `shards/` directory of `run_shards.py`.
+        test_set (dict): optional test set; bundles read from a run store or
+            shards are put in its order, as `run.py` evaluates them.
+
+    Returns:
+        dict of test_id -> {bundle id: ['product1', ...]}
+    """
+    if os.path.isdir(path):
+        if os.path.exists(os.path.join(path, 'bundle_res.npy')):
+            return load_bundle_res(os.path.join(path, 'bundle_res.npy'), test_set)
+        if os.path.exists(os.path.join(path, 'run_store.sqlite')):
+            return load_bundle_res(os.path.join(path, 'run_store.sqlite'), test_set)
+        shard_files = sorted(glob.glob(os.path.join(path, '*', 'predictions.pkl')))
+        if not shard_files:
+            raise ValueError(f"{path} holds no bundle_res.npy, run_store.sqlite or shard predictions")
+        bundle_res = {}
+        for shard_file in shard_files:
+            bundle_res.update(load_shard_predictions(shard_file))
+    elif path.endswith('.npy'):
+        return np.load(path, allow_pickle=True).item()
+    elif path.endswith('.pkl'):
+        bundle_res = load_shard_predictions(path)
+    else:
+        bundle_res = _bundles_from_store(path)
+    if test_set is not None:
+        bundle_res = {test_id: bundle_res[test_id] for test_id in test_set if test_id in bundle_res}
+    return bundle_res
+
+
+def session_table(index, runs, logger=None):
+    """Score several runs on the union of their test sessions.
+
+    Args:
+        index (BundleIndex): index of the dataset the runs were made on.
+        runs (list): bundles of each run, as returned by `load_bundle_res`.
+        logger: optional Logger.
+
+    Returns:
+        dict of `(n_sessions, n_runs)` arrays: `valid` marks the sessions a
+        run is evaluated on after `process_results`, the other entries are
+        the per-session terms of `MetricsEngine.session_scores`, 0 where a
+        run has no valid bundles
+    """
+    engine = MetricsEngine(index)
+    predictions = [process_results(bundle_res, logger) for bundle_res in runs]
+    sessions = list(dict.fromkeys(test_id for format_res in predictions for test_id in format_res))
+    row = {test_id: i for i, test_id in enumerate(sessions)}
+    table = {key: np.zeros((len(sessions), len(runs))) for key in ('valid', 'precision', 'recall', 'coverage', 'hits')}
+    for r, format_res in enumerate(predictions):
+        rows = np.array([row[test_id] for test_id in format_res], dtype=np.int64)
+        table['valid'][rows, r] = 1
+        for key, values in engine.session_scores(format_res, logger).items():
+            table[key][rows, r] = values
+    return table
+
+
+def _ratio(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+
+def bootstrap(table, n_resamples=10000, confidence=0.95, baseline=0, seed=0):
+    """Bootstrap confidence intervals of every run and paired differences to a baseline run.
+
+    Test sessions are resampled with replacement, the same resamples for
+    every run, so the differences between runs are paired. A resample is a
+    row of session counts, and the metrics of all resamples and runs are
+    weighted sums of the per-session terms, i.e. one matrix product per
+    block of resamples. Precision and recall are averaged over the valid
+    sessions of a run and coverage over its hit bundles, as in `compute`.
+
+    Args:
+        table (dict): per-session terms, see `session_table`.
+        n_resamples (int): number of bootstrap resamples.
+        confidence (float): level of the confidence intervals.
+        baseline (int): column of the run the others are compared with.
+        seed (int): seed of the resampling.
+
+    Returns:
+        dict with the `value` and `ci` of each metric and run, shaped
+        `(n_runs,)` and `(n_runs, 2)`, and the `diff`, `diff_ci` and
+        two-sided bootstrap `p_value` of each run against the baseline
+    """
+    n_sessions, n_runs = table['valid'].shape
+    # metric-major columns: precision of every run, then recall, then coverage
+    numerator = np.concatenate([table['precision'], table['recall'], table['coverage']], axis=1)
+    denominator = np.concatenate([table['valid'], table['valid'], table['hits']], axis=1)
+    value = _ratio(numerator.sum(axis=0), denominator.sum(axis=0)).reshape(len(METRICS), n_runs)
+
+    rng = np.random.default_rng(seed)
+    samples = np.empty((n_resamples, len(METRICS) * n_runs))
+    block = max(1, MAX_BLOCK_WEIGHTS // max(1, n_sessions))
+    uniform = np.full(n_sessions, 1.0 / n_sessions)
+    for start in range(0, n_resamples, block):
+        stop = min(n_resamples, start + block)
+        weights = rng.multinomial(n_sessions, uniform, size=stop - start).astype(float)
+        samples[start:stop] = _ratio(weights @ numerator, weights @ denominator)
+    samples = samples.reshape(n_resamples, len(METRICS), n_runs)
+
+    alpha = (1 - confidence) / 2 * 100
+    diff = samples - samples[:, :, baseline:baseline + 1]
+    p_value = 2 * np.minimum((diff <= 0).mean(axis=0), (diff >= 0).mean(axis=0))
+    p_value[:, baseline] = 1.0
+    return {
+        'value': value,
+        'ci': np.moveaxis(np.percentile(samples, [alpha, 100 - alpha], axis=0), 0, -1),
+        'diff': value - value[:, baseline:baseline + 1],
+        'diff_ci': np.moveaxis(np.percentile(diff, [alpha, 100 - alpha], axis=0), 0, -1),
+        'p_value': np.minimum(p_value, 1.0),
+    }
@@ -0,0 +1,221 @@
+import json
+import re
+
+# One token of a JSON or Python literal. A quote inside a string only ends it when
+# a delimiter follows, so apostrophes such as "men's" stay inside the string.
+TOKEN = re.compile(r'''
+    \s*
+    (?:
+    (?P<string>"(?:[^"\\]|\\.|"(?!\s*(?:[,:}\])]|$)))*"?
+              |'(?:[^'\\]|\\.|'(?!\s*(?:[,:}\])]|$)))*'?)
+  | (?P<open>[{\[(])
+  | (?P<close>[}\])])
+  | (?P<comma>,)
+  | (?P<colon>:)
+  | (?P<comment>(?:\#|//)[^\n,}\]]*)
+  | (?P<word>[^\s,:{}\[\]()'"\#]+(?:[ \t]+[^\s,:{}\[\]()'"\#]+)*)
+    )
+''', re.VERBOSE | re.DOTALL)
+# a quoted key and the start of its value, for objects whose '{' was left out
+IMPLIED_OBJECT = re.compile(r'"[^"\n]+"\s*:\s*["\[{]')
+NEXT_OBJECT = re.compile(r'\s*,?\s*\{')
+NUMBER = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?$')
+SMART_QUOTES = str.maketrans({'“': '"', '”': '"', '‘': "'", '’': "'"})
+WORDS = {'true': 'true', 'false': 'false', 'null': 'null', 'none': 'null'}
+CLOSERS = {'{': '}', '[': ']', '(': ']'}
+
+
+def _string(text):
+    """Re-quote a single- or double-quoted string token as a JSON string."""
+    quote = text[0]
+    closed = len(text) > 1 and text[-1] == quote and text[-2] != '\\'
+    body = text[1:-1] if closed else text[1:].rstrip('\\')
+    if "\\'" in body:
+        body = body.replace("\\'", "'")
+    if '"' in body:
+        body = re.sub(r'(?<!\\)"', r'\\"', body)
+    return '"' + body + '"'
+
+
+def _close(out, stack, last):
+    """Close the innermost bracket, dropping a trailing comma or a key without a value."""
+    if last == 'value' and stack[-1][2] and out[-2] == ',' and out[-1][-1] not in '}]':
+        # a key without a colon, e.g. the '...' of an echoed format template
+        out.pop()
+        last = 'comma'
+    if last == 'comma':
+        out.pop()
+    elif last == 'colon':
+        out.pop()
+        out.pop()
+        if out[-1] == ',':
+            out.pop()
+    closer, opened, is_dict = stack.pop()
+    if closer == '}' and not is_dict and len(out) > opened + 1:
+        # a Python set literal
+        out[opened] = '['
+        closer = ']'
+    out.append(closer)
+
+
+def extract_object(text):
+    """Return the first `{...}` object of `text` as a Python value.
+
+    The text is tokenized once from its first '{' (or its first quoted key
+    when the brace was left out) and rewritten as JSON on the way: smart
+    quotes are straightened, single-quoted strings and bare words are
+    re-quoted, Python literals become JSON ones, comments, '...'
+    placeholders and trailing commas are dropped, missing commas are
+    inserted and objects cut off at the end of the text are closed.
+    Objects that directly follow the first one are merged into it, and
+    sets become lists.
+
+    Raises:
+        ValueError: if there is no object or it cannot be repaired
+    """
+    start = text.find('{')
+    if start >= 0:
+        text = text[start:]
+    else:
+        match = IMPLIED_OBJECT.search(text)
+        if match is None:
+            raise ValueError("no object found")
+        text = '{' + text[match.start():]
+    text = text.translate(SMART_QUOTES)
+
+    # stack holds (closer, index of the opening bracket in out, is a dict)
+    out, stack = [], []
+    last = None
+    pos, end = 0, len(text)
+    while pos < end:
+        match = TOKEN.match(text, pos)
+        if match is None:
+            # only trailing whitespace is left
+            break
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'comment' or kind == 'word' and not match.group(kind).strip('.…'):
+            # comments and '...' placeholders
+            continue
+
+        if kind == 'string' or kind == 'word':
+            if last == 'value':
+                out.append(',')
+            value = match.group(kind)
+            if kind == 'string':
+                out.append(_string(value))
+            elif NUMBER.match(value):
+                out.append(value)
+            else:
+                out.append(WORDS.get(value.lower()) or json.dumps(value))
+            last = 'value'
+        elif kind == 'comma':
+            if last == 'open' or last == 'comma':
+                continue
+            if last == 'colon':
+                out.append('null')
+            out.append(',')
+            last = 'comma'
+        elif kind == 'colon':
+            if last != 'value' or not stack or stack[-1][0] != '}':
+                continue
+            if out[-1][0] != '"':
+                if out[-1] in ('}', ']'):
+                    raise ValueError("cannot repair object: unhashable key")
+                out[-1] = '"' + out[-1].strip('"') + '"'
+            out.append(':')
+            if not stack[-1][2]:
+                stack[-1] = ('}', stack[-1][1], True)
+            last = 'colon'
+        elif kind == 'open':
+            if last == 'value':
+                out.append(',')
+            value = match.group(kind)
+            stack.append((CLOSERS[value], len(out), False))
+            out.append('[' if value == '(' else value)
+            last = 'open'
+        else:
+            _close(out, stack, last)
+            last = 'value'
+            if not stack:
+                follow = NEXT_OBJECT.match(text, pos)
+                if follow is None:
+                    break
+                # '{...} {...}' reads as one object
+                out[-1] = ','
+                stack.append(('}', 0, True))
+                pos = follow.end()
+                last = 'comma'
+
+    if stack and last == 'value' and stack[-1][0] == '}' and (out[-2] == '{' or out[-2] == ',' and stack[-1][2]):
+        # the text ended in the middle of a key
+        out.pop()
+        last = 'comma' if out[-1] == ',' else 'open'
+    while stack:
+        # the text ended inside the object
+        _close(out, stack, last)
+        last = 'value'
+    try:
+        return json.loads(''.join(out), strict=False)
+    except (ValueError, RecursionError) as e:
+        raise ValueError(f"cannot repair object: {e}")
+
+
+def as_bundles(value):
+    """Coerce an extracted object to {bundle id: [items]}."""
+    if isinstance(value, (set, list, tuple)):
+        # a bare collection is either one bundle or a list of bundles
+        if all(isinstance(v, (set, list, tuple)) for v in value):
+            value = {f'bundle{i+1}': v for i, v in enumerate(value)}
+        else:
+            value = {'bundle1': value}
+    if not isinstance(value, dict):
+        raise ValueError(f"expected a dict of bundles, got {type(value).__name__}")
+    return {str(bid): list(items) if isinstance(items, (set, tuple)) else items for bid, items in value.items()}
+
+
+def as_intents(value):
+    """Coerce an extracted object to {bundle id: intent or scores}."""
+    if not isinstance(value, dict):
+        raise ValueError(f"expected a dict of intents, got {type(value).__name__}")
+    return {str(bid): intent for bid, intent in value.items()}
+
+
+class ObjectScanner(object):
+    """`ObjectScanner` finds the end of the first `{...}` object in streamed text.
+
+    Text is fed chunk by chunk and scanned once: braces are counted outside
+    double-quoted strings, so `feed` reports the moment the outermost
+    object is balanced and `end` holds the offset just past its '}'.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.offset = 0
+        self.in_string = False
+        self.escape = False
+        self.end = None
+
+    def feed(self, chunk):
+        """Scan the next chunk, return True once the first object is complete."""
+        if self.end is not None:
+            return True
+        for i, char in enumerate(chunk):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"' and self.depth > 0:
+                self.in_string = True
+            elif char == '{':
+                self.depth += 1
+            elif char == '}' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = self.offset + i + 1
+                    return True
+        self.offset += len(chunk)
+        return False
@@ -1,93 +1,298 @@
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
 import sys
 import time
 from contextlib import contextmanager
 
+from utils.usage import current_dataset, current_stage, current_test_id
+
+
+def logger_options(config):
+    """Return the `Logger` keyword arguments set in the config"""
+    return {
+        'console_level': config.get('log_console_level', 'DEBUG'),
+        'file_level': config.get('log_file_level', 'DEBUG'),
+        'queued': config.get('log_async', False),
+        'flush_interval': config.get('log_flush_interval', 1.0),
+        'structured': config.get('log_json', False),
+    }
+
+
+def _level(level):
+    if isinstance(level, int):
+        return level
+    if not isinstance(getattr(logging, str(level).upper(), None), int):
+        raise ValueError(f"Unknown log level: {level}")
+    return getattr(logging, str(level).upper())
+
+
+class _ContextFilter(logging.Filter):
+    """Tags each record with the dataset, stage and test_id of the task logging it."""
+
+    def filter(self, record):
+        record.dataset = current_dataset.get()
+        record.stage = current_stage.get()
+        record.test_id = current_test_id.get()
+        if not hasattr(record, 'fields'):
+            record.fields = {}
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object with its context and structured fields."""
+
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'dataset': getattr(record, 'dataset', None),
+            'stage': getattr(record, 'stage', None),
+            'test_id': getattr(record, 'test_id', None),
+            'pid': record.process,
+        }
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+class AppendFileHandler(logging.Handler):
+    """`AppendFileHandler` appends formatted records to a file with one `os.write` per flush.
+
+    The file is opened with `O_APPEND` and every flush writes whole lines in
+    a single call, so several processes can append to the same log without
+    interleaving partial records.
+
+    Args:
+        filename (str): file to append to.
+        buffered (bool): keep records until `flush` instead of writing each one.
+        max_buffer (int): bytes after which a buffered handler writes anyway.
+    """
+
+    def __init__(self, filename, buffered=False, max_buffer=1 << 16):
+        super().__init__()
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.buffered = buffered
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._size = 0
+
+    def emit(self, record):
+        try:
+            line = (self.format(record) + '\n').encode('utf-8')
+        except Exception:
+            self.handleError(record)
+            return
+        self._buffer.append(line)
+        self._size += len(line)
+        if not self.buffered or self._size >= self.max_buffer:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self._buffer and self.fd is not None:
+                data = b''.join(self._buffer)
+                self._buffer, self._size = [], 0
+                while data:
+                    data = data[os.write(self.fd, data):]
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            self.flush()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+        finally:
+            self.release()
+        super().close()
+
+
+class _BufferedStreamHandler(logging.StreamHandler):
+    """StreamHandler that leaves flushing to the queue listener."""
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the listener queue as they are; they are formatted by the listener thread."""
+
+    def prepare(self, record):
+        # records never leave the process, so they need no formatting or copy
+        return record
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """Queue listener that flushes its handlers at most every `flush_interval` seconds.
+
+    Records at WARNING or above, and the first record after a quiet
+    period, are flushed at once.
+    """
+
+    def __init__(self, records, handlers, flush_interval):
+        super().__init__(records, *handlers, respect_handler_level=True)
+        self.flush_interval = flush_interval
+        self._last_flush = 0.0
+        self._dirty = False
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+        self._last_flush = time.time()
+        self._dirty = False
+
+    def dequeue(self, block):
+        if self._dirty:
+            try:
+                return self.queue.get(timeout=max(0.0, self.flush_interval - (time.time() - self._last_flush)))
+            except queue.Empty:
+                self.flush()
+        return self.queue.get(block)
+
+    def handle(self, record):
+        super().handle(record)
+        self._dirty = True
+        if record.levelno >= logging.WARNING or time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def stop(self):
+        super().stop()
+        self.flush()
+
+
 class Logger(object):
     """`Logger` is a comprehensive logging system for bundle generation experiments.
 
     This class can show messages on standard output and write them into the
     file simultaneously. It also supports performance metrics logging and
     progress tracking.
+
+    With `queued`, messages are put on a queue and written by a listener
+    thread, so logging from the pipeline never waits on the console or the
+    disk. With `structured`, every record is also written as a JSON line to
+    the log file name with a `.jsonl` extension, carrying the dataset, stage
+    and test_id of the session that logged it and any keyword fields, such as
+    `latency`, passed to the log methods.
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, console_level='DEBUG', file_level='DEBUG', queued=False, flush_interval=1.0,
+                 structured=False):
         """Initializes a new `Logger` instance.
 
         Args:
             filename (str): File name to create. The directory component of this
                 file will be created automatically if it is not existing.
+            console_level (str): lowest level shown on standard output.
+            file_level (str): lowest level written to the file(s).
+            queued (bool): write from a listener thread instead of the caller.
+            flush_interval (float): longest time in seconds queued records stay unflushed.
+            structured (bool): also write JSON lines records.
         """
         dir_name = os.path.dirname(filename)
-        if not os.path.exists(dir_name):
-            os.makedirs(dir_name)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name, exist_ok=True)
 
         # Remove existing handlers to prevent duplication
         for handler in logging.root.handlers[:]:
             logging.root.removeHandler(handler)
             
         self.logger = logging.getLogger(filename)
-        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        console_level, file_level = _level(console_level), _level(file_level)
+        self.logger.setLevel(min(console_level, file_level))
         
         # Clear any existing handlers
         self.logger.handlers.clear()
+        self.logger.filters.clear()
+        self.logger.addFilter(_ContextFilter())
         
         formatter = logging.Formatter('%(asctime)s.%(msecs)03d: %(message)s',
                                       datefmt='%Y-%m-%d %H:%M:%S')
 
         # write into file
-        fh = logging.FileHandler(filename, mode='a', encoding='utf-8')
-        fh.setLevel(logging.DEBUG)
+        fh = AppendFileHandler(filename, buffered=queued)
+        fh.setLevel(file_level)
         fh.setFormatter(formatter)
 
         # show on console
-        ch = logging.StreamHandler(sys.stdout)
-        ch.setLevel(logging.DEBUG)
+        ch = _BufferedStreamHandler(sys.stdout) if queued else logging.StreamHandler(sys.stdout)
+        ch.setLevel(console_level)
         ch.setFormatter(formatter)
+        handlers = [fh, ch]
+
+        if structured:
+            jh = AppendFileHandler(os.path.splitext(filename)[0] + '.jsonl', buffered=queued)
+            jh.setLevel(file_level)
+            jh.setFormatter(JsonFormatter())
+            handlers.append(jh)
 
-        # add to Handler
-        self.logger.addHandler(fh)
-        self.logger.addHandler(ch)
+        self.handlers = handlers
+        self.listener = None
+        if queued:
+            records = queue.SimpleQueue()
+            self._attached = [_QueueHandler(records)]
+            self.listener = _QueueListener(records, handlers, flush_interval)
+            self.listener.start()
+        else:
+            self._attached = handlers
+        for handler in self._attached:
+            self.logger.addHandler(handler)
+        atexit.register(self.close)
         
         # Initialize metrics tracking
         self.start_time = time.time()
         self.step_times = {}
 
-    def _flush(self):
-        """Flush all handlers to ensure immediate writing."""
-        for handler in self.logger.handlers:
-            handler.flush()
+    def close(self):
+        """Write out the queued records and close the files."""
+        atexit.unregister(self.close)
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        for handler in self._attached:
+            self.logger.removeHandler(handler)
+        for handler in self.handlers:
+            handler.close()
+        self._attached, self.handlers = [], []
+
+    def _log(self, level, message, fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, message, extra={'fields': fields})
 
-    def debug(self, message):
+    def debug(self, message, **fields):
         """Log debug message."""
-        self.logger.debug(message)
-        self._flush()
+        self._log(logging.DEBUG, message, fields)
 
-    def info(self, message):
+    def info(self, message, **fields):
         """Log info message."""
-        self.logger.info(message)
-        self._flush()
+        self._log(logging.INFO, message, fields)
 
-    def warning(self, message):
+    def warning(self, message, **fields):
         """Log warning message."""
-        self.logger.warning(message)
-        self._flush()
+        self._log(logging.WARNING, message, fields)
 
-    def error(self, message):
+    def error(self, message, **fields):
         """Log error message."""
-        self.logger.error(message)
-        self._flush()
+        self._log(logging.ERROR, message, fields)
 
-    def critical(self, message):
+    def critical(self, message, **fields):
         """Log critical message."""
-        self.logger.critical(message)
-        self._flush()
+        self._log(logging.CRITICAL, message, fields)
     
     def log_metrics(self, **kwargs):
         """Log performance metrics with special formatting."""
         metrics_str = "METRICS: " + ", ".join([f"{k}={v}" for k, v in kwargs.items()])
-        self.info(metrics_str)
+        self.info(metrics_str, metrics=kwargs)
     
     def log_progress(self, step_name, current, total, additional_info=""):
         """Log progress information."""
@@ -95,7 +300,7 @@ class Logger(object):
         progress_str = f"PROGRESS [{step_name}]: {current}/{total} ({percentage:.1f}%)"
         if additional_info:
             progress_str += f" - {additional_info}"
-        self.info(progress_str)
+        self.info(progress_str, step=step_name, current=current, total=total)
     
     def start_step(self, step_name):
         """Start timing a step."""
@@ -106,7 +311,7 @@ class Logger(object):
         """End timing a step and log duration."""
         if step_name in self.step_times:
             duration = time.time() - self.step_times[step_name]
-            self.info(f"STEP_END: {step_name} (Duration: {duration:.2f}s)")
+            self.info(f"STEP_END: {step_name} (Duration: {duration:.2f}s)", step=step_name, latency=duration)
             del self.step_times[step_name]
         else:
             self.warning(f"Step '{step_name}' was not started")
@@ -127,10 +332,16 @@ class Logger(object):
             self.info(f"CONFIG: {key} = {value}")
         self.info("=== END CONFIGURATION ===")
     
-    def log_final_results(self, precision, recall, coverage, **additional_metrics):
-        """Log final experiment results with special formatting."""
+    def log_final_results(self, precision, recall, coverage, usage_summary=None, **additional_metrics):
+        """Log final experiment results with special formatting.
+
+        Args:
+            usage_summary (dict): optional per-stage API usage from
+                `utils.usage.UsageTracker.summary`.
+        """
         self.info("=" * 60)
-        self.info("FINAL RESULTS")
+        self.info("FINAL RESULTS", results=dict(additional_metrics, precision=precision, recall=recall,
+                                                coverage=coverage), usage=usage_summary)
         self.info("=" * 60)
         self.info(f"Precision: {precision:.6f}")
         self.info(f"Recall: {recall:.6f}")
@@ -140,6 +351,17 @@ class Logger(object):
             self.info("Additional Metrics:")
             for metric, value in additional_metrics.items():
                 self.info(f"  {metric}: {value}")
+
+        if usage_summary:
+            self.info("API Usage:")
+            for stage, usage in usage_summary.items():
+                self.info(f"  {stage}: calls={usage['calls']}, failed={usage['failed_calls']}, "
+                          f"retries={usage['retries']}, prompt_tokens={usage['prompt_tokens']}, "
+                          f"completion_tokens={usage['completion_tokens']}, "
+                          f"latency p50/p95/p99={usage['latency_p50']:.2f}/{usage['latency_p95']:.2f}/"
+                          f"{usage['latency_p99']:.2f}s, "
+                          f"time to result p50/p95={usage['time_to_result_p50']:.2f}/"
+                          f"{usage['time_to_result_p95']:.2f}s, stopped_early={usage['stopped_early']}")
         
         total_time = time.time() - self.start_time
         self.info(f"Total Execution Time: {total_time:.2f} seconds")
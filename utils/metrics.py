@@ -1,16 +1,29 @@
 from collections import defaultdict
 import re
 
+import numpy as np
 
-def compute(session_item, session_bundle, predictions, logger=None):
+from utils.bundle_index import BundleIndex, product_number
+
+
+def resolve_products(content, all_items):
+    """Map the product references of one bundle to the set of session item ids."""
+    reidx_items = set()
+    for ref in content:
+        num = product_number(ref)
+        if num is None or not 0 < num <= len(all_items):
+            raise ValueError(f"invalid product reference: {ref}")
+        reidx_items.add(all_items[num-1])
+    return reidx_items
+
+
+def compute_reference(session_item, session_bundle, predictions):
+    """Plain-Python version of `compute`, used to check the vectorized one."""
     session_precision = 0
     session_recall = 0
     coverage_item = 0
     all_hitted_bundle = 0
-    
-    if logger:
-        logger.info(f"Computing metrics for {len(predictions)} test sessions")
-    
+
     for test_id, pred in predictions.items():
         if len(pred) == 0:
             continue
@@ -19,41 +32,171 @@ def compute(session_item, session_bundle, predictions, logger=None):
         hitted_bundle = 0
         for bid, content in pred.items():
             try:
-                reidx_items = set([all_items[int(i[-1])-1] for i in content])
-            except Exception as e:
-                if logger:
-                    logger.error(f"Error processing test_id {test_id}: {e}")
-                else:
-                    print(f"Error processing test_id {test_id}: {e}")
+                reidx_items = resolve_products(content, all_items)
+            except ValueError:
                 continue
             for bundle in all_bundle:
                 bundle_list = set(bundle[-1].split(','))
-                if reidx_items <= bundle_list: 
+                if reidx_items <= bundle_list:
                     hitted_bundle += 1
-                    union_items = len(bundle_list & reidx_items)
-                    coverage_item += union_items / len(bundle_list)
+                    coverage_item += len(bundle_list & reidx_items) / len(bundle_list)
                     all_hitted_bundle += 1
                     break
         session_precision += hitted_bundle / len(pred)
         session_recall += hitted_bundle / len(all_bundle)
-    
+
     session_precision /= len(predictions)
     session_recall /= len(predictions)
     coverage = coverage_item / all_hitted_bundle if all_hitted_bundle > 0 else 0
+    return session_precision, session_recall, coverage
 
-    if logger:
-        logger.info("Metrics computation completed successfully")
-        logger.log_metrics(
-            precision=session_precision,
-            recall=session_recall,
-            coverage=coverage,
-            total_predictions=len(predictions),
-            total_hit_bundles=all_hitted_bundle
-        )
 
-    return session_precision, session_recall, coverage
+class MetricsEngine(object):
+    """`MetricsEngine` scores predicted bundles with the bitmasks of a `BundleIndex`.
 
-def findErrors(session_idx, generated_bundles, session_bundles, session_items):
+    Items and ground-truth bundles come pre-encoded from the index, so an
+    evaluation only encodes the predictions.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def _encode(self, predictions, logger=None):
+        """Encode the predicted bundles and the ground truth of their sessions as flat arrays."""
+        n_pred, n_gt, gt_start = [], [], []
+        pred_session, pred_mask, pred_size = [], [], []
+        gt_mask, gt_size = [], []
+
+        for s, (test_id, pred) in enumerate(predictions.items()):
+            gt_start.append(len(gt_mask))
+            if len(pred) == 0:
+                n_pred.append(0)
+                n_gt.append(0)
+                continue
+            pos_bit, session_gt_mask, session_gt_size = self.index.session_encoding(test_id)
+            n_pred.append(len(pred))
+            n_gt.append(len(session_gt_mask))
+            gt_mask.extend(session_gt_mask)
+            gt_size.extend(session_gt_size)
+
+            n_items = len(pos_bit)
+            for content in pred.values():
+                mask = 0
+                for ref in content:
+                    num = product_number(ref) if isinstance(ref, str) else None
+                    if num is None or not 0 < num <= n_items:
+                        break
+                    mask |= 1 << pos_bit[num-1]
+                else:
+                    pred_session.append(s)
+                    pred_mask.append(mask)
+                    pred_size.append(bin(mask).count('1'))
+                    continue
+                # a bundle with an invalid reference is a miss
+                message = f"Error processing test_id {test_id}: invalid product reference: {ref}"
+                if logger:
+                    logger.error(message)
+                else:
+                    print(message)
+
+        # Python ints beyond 64 bits keep working as object arrays, just slower
+        dtype = np.uint64 if max(max(gt_mask, default=0), max(pred_mask, default=0)) < 2 ** 64 else object
+        return (np.array(n_pred, dtype=float), np.array(n_gt, dtype=float), np.array(gt_start, dtype=np.int64),
+                np.array(pred_session, dtype=np.int64), np.array(pred_mask, dtype=dtype),
+                np.array(pred_size, dtype=float), np.array(gt_mask, dtype=dtype), np.array(gt_size, dtype=float))
+
+    def _match(self, predictions, logger=None):
+        """Return the bundle counts of every session and the predicted bundles that hit, with their ground truth."""
+        (n_pred, n_gt, gt_start, pred_session, pred_mask, pred_size,
+         gt_mask, gt_size) = self._encode(predictions, logger)
+
+        # one row per (predicted bundle, ground-truth bundle of the same session), in bundle order
+        counts = n_gt.astype(np.int64)[pred_session]
+        pair_pred = np.repeat(np.arange(len(pred_session)), counts)
+        pair_offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_gt = np.repeat(gt_start[pred_session], counts) + pair_offset
+        is_subset = (pred_mask[pair_pred] & ~gt_mask[pair_gt]) == 0
+
+        # a predicted bundle hits the first ground-truth bundle that contains it
+        hit_pairs = np.flatnonzero(is_subset)
+        _, first = np.unique(pair_pred[hit_pairs], return_index=True)
+        hit_pred = pair_pred[hit_pairs[first]]
+        hit_gt = pair_gt[hit_pairs[first]]
+        return n_pred, n_gt, pred_session, pred_size, gt_size, hit_pred, hit_gt
+
+    def session_scores(self, predictions, logger=None):
+        """Return the per-session terms of the metrics, in the order of `predictions`.
+
+        `precision` and `recall` are each session's hit fractions, `coverage`
+        the summed coverage of its hit bundles and `hits` their number, so
+        that e.g. coverage = coverage.sum() / hits.sum().
+        """
+        n = len(predictions)
+        if n == 0:
+            return {key: np.zeros(0) for key in ('precision', 'recall', 'coverage', 'hits')}
+        n_pred, n_gt, pred_session, pred_size, gt_size, hit_pred, hit_gt = self._match(predictions, logger)
+        hitted_bundle = np.bincount(pred_session[hit_pred], minlength=n).astype(float)
+        evaluated = n_pred > 0
+        precision, recall = np.zeros(n), np.zeros(n)
+        precision[evaluated] = hitted_bundle[evaluated] / n_pred[evaluated]
+        recall[evaluated] = hitted_bundle[evaluated] / n_gt[evaluated]
+        coverage = np.bincount(pred_session[hit_pred], weights=pred_size[hit_pred] / gt_size[hit_gt], minlength=n)
+        return {'precision': precision, 'recall': recall, 'coverage': coverage, 'hits': hitted_bundle}
+
+    def compute(self, predictions, logger=None):
+        """Compute session precision, session recall and coverage of `predictions`, see `compute`."""
+        if logger:
+            logger.info(f"Computing metrics for {len(predictions)} test sessions")
+        if len(predictions) == 0:
+            return 0, 0, 0
+
+        n_pred, n_gt, pred_session, pred_size, gt_size, hit_pred, hit_gt = self._match(predictions, logger)
+
+        hitted_bundle = np.bincount(pred_session[hit_pred], minlength=len(predictions))
+        evaluated = n_pred > 0
+        session_precision = float(np.sum(hitted_bundle[evaluated] / n_pred[evaluated])) / len(predictions)
+        session_recall = float(np.sum(hitted_bundle[evaluated] / n_gt[evaluated])) / len(predictions)
+        all_hitted_bundle = len(hit_pred)
+        # a hit bundle is a subset, so its overlap with the ground truth is its own size
+        coverage = float(np.sum(pred_size[hit_pred] / gt_size[hit_gt])) / all_hitted_bundle if all_hitted_bundle > 0 else 0
+
+        if logger:
+            logger.info("Metrics computation completed successfully")
+            logger.log_metrics(
+                precision=session_precision,
+                recall=session_recall,
+                coverage=coverage,
+                total_predictions=len(predictions),
+                total_hit_bundles=all_hitted_bundle
+            )
+
+        return session_precision, session_recall, coverage
+
+
+def compute(session_item, session_bundle, predictions, logger=None, index=None):
+    """Compute session precision, session recall and coverage of the predictions.
+
+    Each predicted bundle hits the first ground-truth bundle of its session
+    that contains all of its products. Bundles with invalid product
+    references are logged and count as misses.
+
+    Args:
+        session_item: session id -> comma separated item ids
+        session_bundle: session id -> list of (intent, comma separated item ids)
+        predictions: session id -> {bundle id: ['product1', ...]}
+        logger: optional Logger
+        index: optional `BundleIndex` of the dataset, built for the predicted
+            sessions when not given
+
+    Returns:
+        (precision, recall, coverage)
+    """
+    if index is None:
+        index = BundleIndex({test_id: session_item[test_id] for test_id in predictions},
+                            {test_id: session_bundle[test_id] for test_id in predictions})
+    return MetricsEngine(index).compute(predictions, logger)
+
+def findErrors(session_idx, generated_bundles, session_bundles, session_items, index=None):
     """
     Check the generated bundles for errors
     
@@ -62,6 +205,7 @@ def findErrors(session_idx, generated_bundles, session_bundles, session_items):
         generated_bundles: the generated bundles from LLM
         session_bundles: real bundles in the session
         session_items: items in the session
+        index: optional `BundleIndex` of the dataset
     
     Returns:
         error_dict: a dict of error codes and their descriptions
@@ -92,8 +236,9 @@ def findErrors(session_idx, generated_bundles, session_bundles, session_items):
         error_dict[1] = "Empty generated bundles"
         return error_dict
     
-    items_session = session_items[session_idx].split(',')
-    ground_truth_bundles = session_bundles[session_idx]  # Fix: using session_bundles[session_idx] consistently
+    if index is None:
+        index = BundleIndex({session_idx: session_items[session_idx]}, {session_idx: session_bundles[session_idx]})
+    items_session = index.items[session_idx]
     
     # For each generated bundle, check if it's a valid bundle
     for bid, items in generated_bundles.items():  
@@ -122,15 +267,14 @@ def findErrors(session_idx, generated_bundles, session_bundles, session_items):
         if is_hallucination:
             error_dict[5] = "Bundle contains hallucinated products"
     
-    # Check if the ground truth bundles exist
-    for bundle in ground_truth_bundles:  # Fix: using ground_truth_bundles here
-        bundle_items = bundle[-1].split(',')
-        found = False
-        for bid, items in generated_bundles.items():
-            if set(items).issubset(set(bundle_items)):
-                found = True
-                break
-        if not found:
+    # Check if the ground truth bundles exist, comparing item ids rather than 'productN' references
+    generated_masks = []
+    for items in generated_bundles.values():
+        reidx_items = index.resolve(session_idx, items)
+        if reidx_items is not None:
+            generated_masks.append(index.mask(session_idx, reidx_items))
+    for gt_mask in index.gt_masks[session_idx]:
+        if not any(mask & ~gt_mask == 0 for mask in generated_masks):
             error_dict[6] = "Bundle is not found in ground truth"
     
     # If no errors, add a success code
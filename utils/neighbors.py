@@ -0,0 +1,234 @@
+import argparse
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+INDEX_VERSION = 1
+TOKEN = re.compile(r'[a-z0-9]+')
+# scores held per block, 128 MB of float64 whatever the block size asked for
+MAX_BLOCK_SCORES = 1 << 24
+
+
+def tokenize(titles):
+    """Split the `|` separated item titles of a session into lowercase word tokens."""
+    return [token for token in TOKEN.findall(titles.lower()) if len(token) > 1]
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def vectorize(texts, term_ids, idf):
+    """Return the L2 normalized TF-IDF rows of `texts` as CSR (indptr, indices, data).
+
+    Tokens outside `term_ids` are dropped.
+    """
+    indptr = np.zeros(len(texts) + 1, dtype=np.int64)
+    indices, data = [], []
+    for i, text in enumerate(texts):
+        ids = [term_ids[token] for token in tokenize(text) if token in term_ids]
+        terms, counts = np.unique(np.array(ids, dtype=np.int32), return_counts=True)
+        weights = counts * idf[terms]
+        norm = np.sqrt((weights ** 2).sum())
+        indices.append(terms)
+        data.append(weights / norm if norm > 0 else weights)
+        indptr[i+1] = indptr[i] + len(terms)
+    return (indptr, np.concatenate(indices or [np.zeros(0, dtype=np.int32)]).astype(np.int32),
+            np.concatenate(data or [np.zeros(0)]))
+
+
+class SessionVectors(object):
+    """`SessionVectors` holds the TF-IDF vectors of the training sessions as sparse rows.
+
+    The vocabulary and IDF weights are fitted on the training sessions, so
+    other sessions are vectorized against them without refitting. Rows are
+    L2 normalized, so the dot product of two rows is their cosine
+    similarity. The transposed matrix (term -> training sessions) is kept as
+    well, it is what the top-K search multiplies with.
+
+    Args:
+        keys (np.ndarray): training session ids, one per row.
+        vocab (np.ndarray): token of every term id.
+        idf (np.ndarray): IDF weight of every term id.
+        indptr, indices, data (np.ndarray): CSR rows of the training sessions.
+    """
+
+    def __init__(self, keys, vocab, idf, indptr, indices, data):
+        self.keys = keys
+        self.vocab = vocab
+        self.idf = idf
+        self.indptr, self.indices, self.data = indptr, indices, data
+        self.term_ids = {token: i for i, token in enumerate(vocab.tolist())}
+        # CSC of the same matrix: the training sessions and weights of each term
+        order = np.argsort(indices, kind='stable')
+        self.post_rows = np.repeat(np.arange(len(keys), dtype=np.int32), np.diff(indptr))[order]
+        self.post_data = data[order]
+        self.post_indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(indices, minlength=len(vocab)), out=self.post_indptr[1:])
+
+    @classmethod
+    def fit(cls, sessions):
+        """Fit the vocabulary and IDF weights on `sessions` (session id -> titles) and vectorize them."""
+        docs = [tokenize(titles) for titles in sessions.values()]
+        vocab = sorted({token for doc in docs for token in doc})
+        term_ids = {token: i for i, token in enumerate(vocab)}
+        df = np.zeros(len(vocab), dtype=np.int64)
+        for doc in docs:
+            df[[term_ids[token] for token in set(doc)]] += 1
+        # smoothed IDF, a term in every session still weighs 1
+        idf = np.log((1 + len(docs)) / (1 + df)) + 1
+        indptr, indices, data = vectorize(list(sessions.values()), term_ids, idf)
+        return cls(np.array(list(sessions), dtype=np.int64), np.array(vocab, dtype=str), idf, indptr, indices, data)
+
+    def transform(self, texts):
+        """Return the CSR rows of `texts` over this vocabulary, see `vectorize`."""
+        return vectorize(texts, self.term_ids, self.idf)
+
+    def save(self, path, **meta):
+        np.savez(path, version=INDEX_VERSION, keys=self.keys, vocab=self.vocab, idf=self.idf, indptr=self.indptr,
+                 indices=self.indices, data=self.data, **meta)
+
+    @classmethod
+    def load(cls, path):
+        """Return the saved vectors and the extra fields saved with them."""
+        with np.load(path, allow_pickle=False) as f:
+            fields = {name: f[name] for name in f.files}
+        vectors = cls(fields.pop('keys'), fields.pop('vocab'), fields.pop('idf'), fields.pop('indptr'),
+                      fields.pop('indices'), fields.pop('data'))
+        return vectors, fields
+
+
+def _topk_block(post_indptr, post_rows, post_data, n_train, query, k):
+    """Top-k training rows of a block of query rows, by the sparse product of the block with the postings."""
+    indptr, indices, data = query
+    n_query = len(indptr) - 1
+    query_row = np.repeat(np.arange(n_query, dtype=np.int64), np.diff(indptr))
+    # one pair per (query term, training session holding that term)
+    starts = post_indptr[indices]
+    counts = post_indptr[indices + 1] - starts
+    pair_term = np.repeat(np.arange(len(indices)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    post = np.repeat(starts, counts) + offsets
+    scores = np.bincount(query_row[pair_term] * n_train + post_rows[post], weights=data[pair_term] * post_data[post],
+                         minlength=n_query * n_train).reshape(n_query, n_train)
+    if k < n_train:
+        top = np.sort(np.argpartition(-scores, k - 1, axis=1)[:, :k], axis=1)
+    else:
+        top = np.broadcast_to(np.arange(n_train), (n_query, n_train))
+    # highest score first, ties in training set order
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+
+_worker_vectors = None
+
+
+def _init_worker(vectors):
+    global _worker_vectors
+    _worker_vectors = vectors
+
+
+def _worker_topk(query, k):
+    vectors = _worker_vectors
+    return _topk_block(vectors.post_indptr, vectors.post_rows, vectors.post_data, len(vectors.keys), query, k)
+
+
+def topk_related(vectors, texts, k, block_size=256, workers=None):
+    """Return the ids of the `k` training sessions most similar to each of `texts`, most similar first.
+
+    Queries are scored in blocks, so at most `block_size` rows of scores
+    against the training set are held at once, and the blocks are spread
+    over `workers` processes (all cores when None).
+    """
+    n_train = len(vectors.keys)
+    block_size = max(1, min(block_size, MAX_BLOCK_SCORES // max(1, n_train)))
+    indptr, indices, data = vectors.transform(texts)
+    blocks = []
+    for start in range(0, len(texts), block_size):
+        end = min(start + block_size, len(texts))
+        lo, hi = indptr[start], indptr[end]
+        blocks.append((indptr[start:end+1] - lo, indices[lo:hi], data[lo:hi]))
+
+    workers = min(workers or os.cpu_count() or 1, len(blocks))
+    if workers <= 1:
+        rows = [_topk_block(vectors.post_indptr, vectors.post_rows, vectors.post_data, n_train, block, k)
+                for block in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(vectors,)) as pool:
+            rows = list(pool.map(_worker_topk, blocks, [k] * len(blocks)))
+    if not rows:
+        return []
+    return vectors.keys[np.concatenate(rows)].tolist()
+
+
+def build_topk(data_path, k=10, rebuild=False, workers=None, block_size=256, logger=None):
+    """Write `TopK_related_sessions.npy` of a dataset, computing only the test sessions it is missing.
+
+    The fitted training vectors are saved next to it in `TopK_index.npz`.
+    As long as `training_set.npy` and `k` are unchanged, test sessions added
+    to `test_set.npy` are scored against the saved vectors and appended;
+    otherwise every test session is scored again. A neighbour file that was
+    not written by this builder is only replaced with `rebuild`.
+
+    Returns:
+        int: number of test sessions whose neighbours were computed
+    """
+    train_path = os.path.join(data_path, 'training_set.npy')
+    out_path = os.path.join(data_path, 'TopK_related_sessions.npy')
+    index_path = os.path.join(data_path, 'TopK_index.npz')
+    train_digest = file_digest(train_path)
+    test_set = np.load(os.path.join(data_path, 'test_set.npy'), allow_pickle=True).item()
+
+    vectors, topk = None, {}
+    if not rebuild and os.path.exists(index_path):
+        vectors, meta = SessionVectors.load(index_path)
+        if (int(meta['version']) != INDEX_VERSION or str(meta['train_digest']) != train_digest
+                or int(meta['k']) != k):
+            if logger:
+                logger.info(f"Training set or k changed since {index_path} was built, rebuilding")
+            vectors = None
+        elif os.path.exists(out_path):
+            topk = np.load(out_path, allow_pickle=True).item()
+    elif not rebuild and os.path.exists(out_path):
+        raise ValueError(f"{out_path} was not built by this builder, pass rebuild=True (--rebuild) to replace it")
+
+    if vectors is None:
+        training_set = np.load(train_path, allow_pickle=True).item()
+        vectors = SessionVectors.fit(training_set)
+        vectors.save(index_path, train_digest=train_digest, k=k)
+        if logger:
+            logger.info(f"Fitted TF-IDF vectors: {len(vectors.keys)} training sessions, {len(vectors.vocab)} terms")
+
+    missing = [test_id for test_id in test_set if test_id not in topk]
+    for test_id, neighbors in zip(missing, topk_related(vectors, [test_set[test_id] for test_id in missing], k,
+                                                        block_size=block_size, workers=workers)):
+        topk[test_id] = neighbors
+    topk = {test_id: topk[test_id] for test_id in test_set}
+
+    # np.save appends .npy to any other name
+    np.save(f'{out_path}.tmp.npy', topk, allow_pickle=True)
+    os.replace(f'{out_path}.tmp.npy', out_path)
+    if logger:
+        logger.info(f"Wrote {out_path}: {len(missing)} of {len(topk)} test sessions computed")
+    return len(missing)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build TopK_related_sessions.npy from the session titles')
+    parser.add_argument('data_paths', nargs='+', help='dataset directories such as data/electronic/')
+    parser.add_argument('--k', type=int, default=10, help='related training sessions kept per test session')
+    parser.add_argument('--rebuild', action='store_true', help='refit and recompute every test session')
+    parser.add_argument('--workers', type=int, default=None, help='processes scoring blocks, all cores by default')
+    parser.add_argument('--block-size', type=int, default=256, help='test sessions scored per block')
+    args = parser.parse_args()
+    for data_path in args.data_paths:
+        computed = build_topk(data_path, args.k, rebuild=args.rebuild, workers=args.workers,
+                              block_size=args.block_size)
+        print(f"{data_path}: computed the related sessions of {computed} test sessions")
@@ -0,0 +1,142 @@
+import asyncio
+
+from utils.demo_bank import REFINEMENT_STAGES
+from utils.functions import output_parser
+from utils.usage import set_usage_context, usage_tracker
+from utils.stages import (self_correction, parse_bundle_result, bundle_feedback, intent_regeneration,
+                          match_related_bundles, rate_intents, generate_test_bundles)
+
+
+class SessionPipeline(object):
+    """`SessionPipeline` runs one test session through every stage of `run.py`.
+
+    It is the per-session worker of the streaming mode: self-correction,
+    bundle feedback, intent regeneration, intent rating and test bundle
+    generation are chained for a single session, so it can be evaluated
+    without waiting for the rest of the dataset. The refinement before test
+    bundle generation only depends on the related session, so it runs once
+    per related session and test sessions sharing it wait for that one;
+    demonstrations in `demo_bank` are not refined again.
+    """
+
+    def __init__(self, chat, intent_raters, prompt_generator, test_set, session_items, session_bundles,
+                 item_titles, config, logger, index=None, demo_bank=None, banked=None):
+        self.chat = chat
+        self.intent_raters = intent_raters
+        self.prompt_generator = prompt_generator
+        self.test_set = test_set
+        self.session_items = session_items
+        self.session_bundles = session_bundles
+        self.item_titles = item_titles
+        self.logger = logger
+        self.index = index
+        self.max_iter = config.get('self_correction_max_iter', 2)
+        self.n_iter = config['feedback_iteration']
+        # the scores are only logged, see `intent_rating` in the README
+        self.intent_rating = config.get('intent_rating', False)
+        self.rating_repeats = config.get('intent_rating_repeats', 1)
+        self.rating_quorum = config.get('rating_quorum')
+        self.rating_tolerance = config.get('rating_tolerance', 0)
+        self.demo_bank = demo_bank
+        # related session -> (demonstration, calls its refinement took)
+        self.banked = banked or {}
+        self.demo_calls = {session: calls for session, (_, calls) in self.banked.items()}
+        # test session -> related session, of the test sessions run
+        self.related_session = {}
+        # related session -> test session that refined it, and the demonstrations it produced
+        self.refined = {}
+        self.new_demos = {}
+        # related sessions refinement dropped, for unparsable or hallucinated bundles
+        self.dropped = set()
+        self.reused = set()
+        self._demos = {}
+
+    async def __call__(self, test_id, value):
+        """Return the generated test bundles of one session, None if it was dropped."""
+        topk_session_idx, prompt = value
+        self.related_session[test_id] = topk_session_idx
+        demo = await self.demonstration(test_id, topk_session_idx, prompt)
+        if demo is None:
+            return None
+        _, context = demo
+
+        set_usage_context('Generating test bundles', test_id)
+        test_context = await generate_test_bundles(self.chat, self.prompt_generator, context, self.test_set[test_id])
+        parsered_res = output_parser(test_context[-3]['content'])
+        if parsered_res['state_code'] == 404:
+            self.logger.warning(f'Error when evaluating test_id: {test_id}')
+            return None
+        return parsered_res['output']
+
+    async def demonstration(self, test_id, topk_session_idx, prompt):
+        """Return the refined (related session, context) of a related session, None if refinement dropped it."""
+        if topk_session_idx in self.banked:
+            self.reused.add(topk_session_idx)
+            return self.banked[topk_session_idx][0]
+        if topk_session_idx not in self._demos:
+            self._demos[topk_session_idx] = asyncio.ensure_future(self._refine(test_id, topk_session_idx, prompt))
+        # a cancelled test session must not cancel the refinement other test sessions wait for
+        return await asyncio.shield(self._demos[topk_session_idx])
+
+    async def _refine(self, test_id, topk_session_idx, prompt):
+        """Self-correction, bundle feedback, intent regeneration and rating of one related session."""
+        chat, logger = self.chat, self.logger
+        # its calls are tagged with the test session that started it
+        self.refined[topk_session_idx] = test_id
+        set_usage_context('Self-correction', test_id)
+        message = await self_correction(chat, self.prompt_generator, prompt, self.max_iter, logger, test_id,
+                                        topk_session_idx, self.session_bundles, self.session_items, self.index)
+        bundle_dict = parse_bundle_result(message, logger, test_id)
+        if bundle_dict is None:
+            self.dropped.add(topk_session_idx)
+            return None
+
+        set_usage_context('Bundle feedback', test_id)
+        context = await bundle_feedback(chat, self.prompt_generator, topk_session_idx, bundle_dict, message,
+                                        self.n_iter, self.session_bundles, self.session_items, logger, test_id,
+                                        self.index)
+        if context is None:
+            self.dropped.add(topk_session_idx)
+            return None
+        set_usage_context('Intent feedback', test_id)
+        context = await intent_regeneration(chat, self.prompt_generator, context)
+
+        if self.intent_rating:
+            related_bundles = match_related_bundles(topk_session_idx, context, self.session_items,
+                                                    self.session_bundles, logger, test_id, self.index)
+            if related_bundles is not None:
+                set_usage_context('Rating intents', test_id)
+                await self._rate(test_id, topk_session_idx, related_bundles)
+        self.new_demos[topk_session_idx] = (topk_session_idx, context)
+        return self.new_demos[topk_session_idx]
+
+    def record_demos(self, dataset=None):
+        """Count the calls every refinement of this run took and store its demonstration in the demo bank.
+
+        Dropped sessions are stored as None, unless one of their calls failed
+        and the next run should try them again.
+        """
+        calls = usage_tracker.calls_per_test_id(REFINEMENT_STAGES, dataset=dataset)
+        failed = usage_tracker.calls_per_test_id(REFINEMENT_STAGES, dataset=dataset, failed=True)
+        for topk_session_idx, test_id in self.refined.items():
+            self.demo_calls[topk_session_idx] = calls[str(test_id)]
+        if self.demo_bank is not None:
+            demos = {topk_session_idx: (None, self.demo_calls[topk_session_idx]) for topk_session_idx in self.dropped
+                     if not failed[str(self.refined[topk_session_idx])]}
+            demos.update({topk_session_idx: (demo, self.demo_calls[topk_session_idx])
+                          for topk_session_idx, demo in self.new_demos.items()})
+            self.demo_bank.record(demos)
+
+    async def _rate(self, test_id, topk_session_idx, related_bundles):
+        rater_prompt = self.prompt_generator.get_Intent_rater({test_id: (topk_session_idx, related_bundles)},
+                                                              self.item_titles)[test_id]
+        try:
+            final_scores = await rate_intents(self.intent_raters, rater_prompt, self.rating_repeats,
+                                              self.logger, test_id, self.rating_quorum, self.rating_tolerance)
+        except Exception as e:
+            self.logger.error(f"Error processing test_id {test_id}: {str(e)}")
+            return
+        if final_scores is None:
+            self.logger.warning(f"No valid metrics for test_id: {test_id}")
+        else:
+            self.logger.debug(f"Processed intent feedback for test_id {test_id} with {len(final_scores)} bundles")
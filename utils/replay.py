@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+from utils.ChatAPI import API_ERROR_RESPONSE
+from utils.cache import ResponseCache, SampleCounter
+from utils.usage import usage_tracker
+
+
+class ReplayChat(object):
+    """`ReplayChat` records API conversations to a file or serves them back offline.
+
+    In record mode every request and response of the wrapped client is
+    appended to a JSONL file. In replay mode the responses are served from
+    that file, so the pipeline runs deterministically without network access.
+    Requests are matched on (provider, model, temperature, messages) and, at
+    a temperature above 0, on their sample index (see `SampleCounter`).
+    """
+
+    def __init__(self, provider, model, temperature, path, mode='replay', client=None,
+                 latency_mean=0.0, latency_std=0.0, seed=0, logger=None):
+        """Initializes a new `ReplayChat` instance.
+
+        Args:
+            provider (str): 'openai' or 'claude', part of the request key.
+            path (str): JSONL file with the recorded requests and responses.
+            mode (str): 'record' or 'replay'.
+            client: the real API client, required in record mode.
+            latency_mean (float): mean simulated latency of a replayed call in seconds.
+            latency_std (float): standard deviation of the simulated latency.
+            seed (int): seed of the simulated latency.
+            logger: optional Logger for replay misses, the module's `logging` logger by default.
+        """
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown replay mode: {mode}")
+        if mode == 'record' and client is None:
+            raise ValueError("Record mode needs the API client to record")
+
+        self.provider = provider
+        self.model = model
+        self.temperature = temperature
+        self.path = path
+        self.mode = mode
+        self.client = client
+        self.latency_mean = latency_mean
+        self.latency_std = latency_std
+        self.misses = 0
+        self.logger = logger or logging.getLogger(__name__)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.responses = load_corpus(path) if mode == 'replay' else {}
+        self._samples = SampleCounter(temperature)
+
+        dir_name = os.path.dirname(path)
+        if mode == 'record' and dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+    def _key(self, messages):
+        key = ResponseCache.make_key(self.provider, self.model, self.temperature, messages)
+        sample = self._samples.next(key)
+        return ResponseCache.make_key(self.provider, self.model, self.temperature, messages, sample) if sample else key
+
+    def create_chat_completion(self, messages, stop_at_object=False):
+        key = self._key(messages)
+        if self.mode == 'record':
+            response = self.client.create_chat_completion(messages, stop_at_object=stop_at_object)
+            if response != API_ERROR_RESPONSE:
+                with self._lock:
+                    append_record(self.path, key, messages, response)
+            return response
+
+        start = time.time()
+        with self._lock:
+            delay = max(0.0, self._rng.gauss(self.latency_mean, self.latency_std)) if self.latency_mean else 0.0
+        if delay:
+            time.sleep(delay)
+        response = self.responses.get(key)
+        if response is None:
+            self.misses += 1
+            self.logger.warning(f"Replay miss for {self.provider}/{self.model}: no recorded response")
+            usage_tracker.record(self.provider, self.model, None, None, time.time() - start, 0, failed=True)
+            return API_ERROR_RESPONSE
+        usage_tracker.record(self.provider, self.model, None, None, time.time() - start, 0)
+        return response
+
+    async def acreate_chat_completion(self, messages, stop_at_object=False):
+        """Async variant of `create_chat_completion`, runs the call on a worker thread."""
+        return await asyncio.to_thread(self.create_chat_completion, messages, stop_at_object)
+
+
+def append_record(path, key, messages, response):
+    """Append one request/response pair to a replay corpus."""
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'key': key, 'messages': messages, 'response': response}, ensure_ascii=False) + '\n')
+
+
+def load_corpus(path):
+    """Load a replay corpus as a dict of request key -> response."""
+    responses = {}
+    if not os.path.exists(path):
+        return responses
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                responses[record['key']] = record['response']
+    return responses
+
+
+def bootstrap_corpus(artifact_paths, out_path, provider, model, temperature):
+    """Build a replay corpus from saved conversation artifacts.
+
+    Every artifact is a `np.save` dict of `test_id -> (topk_session_idx, context)`
+    such as `self_correction_res.npy` or `intent_context.npy`. Each assistant
+    message of a context becomes the response to the messages before it.
+
+    Returns:
+        int: number of request/response pairs written
+    """
+    dir_name = os.path.dirname(out_path)
+    if dir_name and not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+
+    known = load_corpus(out_path)
+    written = 0
+    for artifact_path in artifact_paths:
+        artifact = np.load(artifact_path, allow_pickle=True).item()
+        for value in artifact.values():
+            context = value[-1]
+            # only conversation artifacts hold a message list
+            if not isinstance(context, list) or not all(isinstance(msg, dict) for msg in context):
+                continue
+            for i, msg in enumerate(context):
+                if msg.get('role') != 'assistant' or i == 0:
+                    continue
+                messages = context[:i]
+                key = ResponseCache.make_key(provider, model, temperature, messages)
+                if key in known:
+                    continue
+                append_record(out_path, key, messages, msg['content'])
+                known[key] = msg['content']
+                written += 1
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bootstrap a replay corpus from saved conversations')
+    parser.add_argument('artifacts', nargs='+', help='np.save dicts of test_id -> (topk_session_idx, context)')
+    parser.add_argument('--out', type=str, required=True, help='replay corpus to append to')
+    parser.add_argument('--provider', type=str, default='openai')
+    parser.add_argument('--model', type=str, required=True)
+    parser.add_argument('--temperature', type=float, default=0)
+    args = parser.parse_args()
+
+    n = bootstrap_corpus(args.artifacts, args.out, args.provider, args.model, args.temperature)
+    print(f"Wrote {n} request/response pairs to {args.out}")
@@ -0,0 +1,53 @@
+import os
+import pickle
+import sqlite3
+
+
+class RunStore(object):
+    """`RunStore` is an append-only record of per-session stage results.
+
+    Every result is written as soon as its session finishes a stage, so an
+    interrupted run can be resumed without repeating completed API calls.
+    Results are pickled like the `np.save` stage outputs in `temp/`.
+    """
+
+    def __init__(self, path, resume=False):
+        """Initializes a new `RunStore` instance.
+
+        Args:
+            path (str): SQLite file to use. The directory component of this
+                file will be created automatically if it is not existing.
+            resume (bool): keep the records of a previous run. Otherwise the
+                store is cleared and the run starts from scratch.
+        """
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                               stage TEXT NOT NULL,
+                               test_id TEXT NOT NULL,
+                               value BLOB NOT NULL,
+                               PRIMARY KEY (stage, test_id))""")
+        if not resume:
+            self.conn.execute("DELETE FROM results")
+        self.conn.commit()
+
+    def load(self, stage):
+        """Return the recorded results of `stage` as a dict of `test_id -> result`.
+
+        Sessions that were dropped by the stage are recorded with a None result.
+        """
+        rows = self.conn.execute("SELECT value FROM results WHERE stage = ?", (stage,)).fetchall()
+        return dict(pickle.loads(value) for value, in rows)
+
+    def record(self, stage, test_id, result):
+        """Append the result of one session, a None result marks a dropped session."""
+        value = pickle.dumps((test_id, result), protocol=pickle.HIGHEST_PROTOCOL)
+        self.conn.execute("INSERT OR REPLACE INTO results (stage, test_id, value) VALUES (?, ?, ?)",
+                          (stage, repr(test_id), value))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,305 @@
+import email.utils
+import random
+import threading
+import time
+
+
+class APICallError(Exception):
+    """Base class of the errors raised by the API clients.
+
+    Args:
+        message (str): description of the failure.
+        status (int): HTTP status of the response, None if there was none.
+        retry_after (float): seconds the provider asked to wait, None if not given.
+    """
+
+    retryable = False
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RateLimitError(APICallError):
+    """The provider rejected the call with a 429."""
+    retryable = True
+
+
+class RequestTimeout(APICallError):
+    """The call timed out or the connection dropped before a response arrived."""
+    retryable = True
+
+
+class ServerError(APICallError):
+    """The provider failed with a 5xx status or is overloaded."""
+    retryable = True
+
+
+class BadRequestError(APICallError):
+    """The request itself was rejected (4xx other than 429); retrying cannot help."""
+
+
+def parse_retry_after(headers):
+    """Return the wait in seconds asked for by `retry-after-ms` / `retry-after` headers, None if absent."""
+    if not headers:
+        return None
+    try:
+        value = headers.get('retry-after-ms') or headers.get('Retry-After-Ms')
+        if value is not None:
+            return max(0.0, float(value) / 1000)
+        value = headers.get('retry-after') or headers.get('Retry-After')
+    except AttributeError:
+        return None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        # an HTTP date
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def error_from_status(status, message, headers=None):
+    """Return the `APICallError` of an HTTP error status."""
+    retry_after = parse_retry_after(headers)
+    if status == 429:
+        return RateLimitError(message, status, retry_after)
+    if status == 408:
+        return RequestTimeout(message, status, retry_after)
+    if status >= 500:
+        return ServerError(message, status, retry_after)
+    return BadRequestError(message, status)
+
+
+def classify_error(error):
+    """Map an exception of an SDK or of `requests` to an `APICallError`.
+
+    The status code and headers are looked up on the exception and on its
+    response, which covers both generations of the OpenAI SDK and
+    `requests.HTTPError`. Exceptions that are no API failures are returned
+    unchanged.
+    """
+    if isinstance(error, APICallError):
+        return error
+    response = getattr(error, 'response', None)
+    status = getattr(error, 'status_code', None) or getattr(error, 'http_status', None) \
+        or getattr(response, 'status_code', None)
+    headers = getattr(error, 'headers', None) or getattr(response, 'headers', None)
+    message = f"{type(error).__name__}: {error}"
+    name = type(error).__name__
+    if status is not None and status >= 400:
+        return error_from_status(status, message, headers)
+    if 'RateLimit' in name:
+        return RateLimitError(message, status, parse_retry_after(headers))
+    if 'Timeout' in name or 'Connection' in name or isinstance(error, TimeoutError):
+        return RequestTimeout(message, status)
+    if 'ServiceUnavailable' in name or 'InternalServer' in name:
+        return ServerError(message, status)
+    if 'InvalidRequest' in name or 'BadRequest' in name:
+        return BadRequestError(message, status)
+    return error
+
+
+def estimate_tokens(messages):
+    """Rough prompt size in tokens, about four characters per token."""
+    return sum(len(str(message.get('content', ''))) for message in messages) // 4 + 1
+
+
+class TokenBucket(object):
+    """`TokenBucket` spreads a per-minute budget evenly over time.
+
+    The bucket refills at `per_minute / 60` units a second up to one
+    minute's worth. A reservation may overdraw it; the caller then waits
+    until the debt is paid back, so reservations are served in order.
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take `amount` units and return how many seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= min(amount, self.capacity)
+            return -self.level / self.rate if self.level < 0 else 0.0
+
+    def adjust(self, amount):
+        """Correct an earlier reservation by `amount` units, e.g. once the real token count is known."""
+        with self._lock:
+            self.level = min(self.capacity, self.level - amount)
+
+
+class RequestScheduler(object):
+    """`RequestScheduler` keeps the calls to one model within its rate limits.
+
+    Every call waits for a concurrency slot and for room in the
+    requests-per-minute and tokens-per-minute buckets. Rate-limited, timed
+    out and server-failed calls are retried with exponential backoff, or
+    after the provider's Retry-After, which also pauses every other call to
+    the model. The number of concurrent calls follows AIMD: it is halved on
+    a 429 and grows by one per window of successful calls, up to
+    `max_concurrency`.
+
+    Args:
+        name (str): model the scheduler is for, used in log messages.
+        rpm (int): requests per minute, None for no limit.
+        tpm (int): tokens per minute, None for no limit.
+        max_concurrency (int): upper bound of concurrent calls.
+        min_concurrency (int): lower bound the limit is never halved below.
+        max_retries (int): retries of one call before its error is raised.
+        base_delay (float): backoff of the first retry in seconds.
+        max_delay (float): backoff cap in seconds.
+        max_retry_after (float): longest `Retry-After` in seconds that is waited
+            for; a call asked to wait longer fails at once instead of holding
+            its thread and pausing the model.
+        logger: optional Logger.
+    """
+
+    def __init__(self, name, rpm=None, tpm=None, max_concurrency=8, min_concurrency=1, max_retries=5,
+                 base_delay=1.0, max_delay=60.0, max_retry_after=120.0, logger=None):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.min_concurrency = max(1, min(int(min_concurrency), self.max_concurrency))
+        self.limit = float(self.max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.logger = logger
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.rate_limited = 0
+        self._last_decrease = 0.0
+        self._slots = threading.Condition()
+
+    def _acquire(self):
+        with self._slots:
+            while self.in_flight >= int(self.limit):
+                self._slots.wait()
+            self.in_flight += 1
+
+    def _release(self, rate_limited=False):
+        with self._slots:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if rate_limited:
+                self.rate_limited += 1
+                # the calls already in flight were sent at the old limit, halve once per round trip
+                if now - self._last_decrease > 1.0:
+                    self.limit = max(float(self.min_concurrency), self.limit / 2)
+                    self._last_decrease = now
+                    if self.logger:
+                        self.logger.warning(f"{self.name}: rate limited, concurrency lowered to {int(self.limit)}")
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._slots.notify_all()
+
+    def _wait_for_capacity(self, tokens):
+        wait = max(self.paused_until - time.monotonic(), 0.0)
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        if wait > 0:
+            time.sleep(wait)
+
+    def _backoff(self, attempt):
+        # full jitter keeps retries of concurrent calls from lining up
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, request, tokens=0, count_tokens=None):
+        """Run `request()` under the limits of the model, retrying retryable errors.
+
+        Args:
+            request: callable performing one API call; it raises `APICallError`s.
+            tokens (int): estimated tokens of the call, reserved in the TPM bucket.
+            count_tokens: optional callable mapping the result to the tokens the
+                call really used, to correct the reservation.
+
+        Raises:
+            APICallError: the last error once the retries are used up, or at
+                once for an error that is not retryable.
+        """
+        attempt = 0
+        while True:
+            self._acquire()
+            self._wait_for_capacity(tokens)
+            try:
+                result = request()
+            except Exception as e:
+                error = classify_error(e)
+                self._release(rate_limited=isinstance(error, RateLimitError))
+                if not isinstance(error, APICallError) or not error.retryable or attempt >= self.max_retries:
+                    if error is e:
+                        raise
+                    raise error from e
+                if error.retry_after is not None and error.retry_after > self.max_retry_after:
+                    # e.g. a used-up daily quota: waiting would block this thread and every call to the model
+                    if self.logger:
+                        self.logger.warning(f"{self.name}: asked to retry after {error.retry_after:.0f}s, "
+                                            f"more than {self.max_retry_after:.0f}s, giving up")
+                    if error is e:
+                        raise
+                    raise error from e
+                delay = error.retry_after if error.retry_after is not None else self._backoff(attempt)
+                if error.retry_after is not None:
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._release()
+            if self.tokens is not None and count_tokens is not None:
+                used = count_tokens(result)
+                if used is not None:
+                    self.tokens.adjust(used - tokens)
+            return result
+
+
+class SchedulerRegistry(object):
+    """`SchedulerRegistry` hands out one shared `RequestScheduler` per (provider, model)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.schedulers = {}
+        self.configure()
+
+    def configure(self, rate_limits=None, max_concurrency=8, max_retries=5, logger=None):
+        """Set the limits of the schedulers created from now on.
+
+        Args:
+            rate_limits (dict): model -> {'rpm': ..., 'tpm': ...}
+            max_concurrency (int): upper bound of concurrent calls per model.
+            max_retries (int): retries of one call.
+            logger: optional Logger.
+        """
+        self.rate_limits = rate_limits or {}
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.logger = logger
+
+    def get(self, provider, model):
+        with self._lock:
+            key = (provider, model)
+            if key not in self.schedulers:
+                limits = self.rate_limits.get(model, {})
+                self.schedulers[key] = RequestScheduler(model, rpm=limits.get('rpm'), tpm=limits.get('tpm'),
+                                                        max_concurrency=self.max_concurrency,
+                                                        max_retries=self.max_retries, logger=self.logger)
+            return self.schedulers[key]
+
+
+# Shared by every client, so concurrent stages and raters of one model draw from one budget
+scheduler_registry = SchedulerRegistry()
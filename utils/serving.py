@@ -0,0 +1,300 @@
+import asyncio
+import collections
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import numpy as np
+
+from utils.bundle_index import product_number
+from utils.demo_bank import DemoBank
+from utils.functions import output_parser
+from utils.neighbors import SessionVectors, topk_related
+from utils.stages import generate_test_bundles
+from utils.usage import set_usage_context, usage_tracker
+
+
+def load_demonstrations(temp_path, fingerprint=None):
+    """Return the refined context of every related training session of the finished runs on a dataset.
+
+    These are the contexts `run.py` prompts test sessions with. With a
+    `fingerprint`, every demonstration in the demo bank under it is used,
+    since a run refines and saves only the sessions missing from the bank.
+    The regenerated intent contexts of the last run fill in the sessions
+    the bank lacks, e.g. when it is turned off.
+
+    Raises:
+        ValueError: if no demonstration is found.
+    """
+    demonstrations = {}
+    bank_path = os.path.join(temp_path, 'demo_bank.sqlite')
+    if fingerprint is not None and os.path.exists(bank_path):
+        demo_bank = DemoBank(bank_path, fingerprint)
+        try:
+            for session, (demo, _) in demo_bank.load().items():
+                # dropped sessions are banked without a demonstration
+                if demo is not None:
+                    demonstrations[session] = demo[1]
+        finally:
+            demo_bank.close()
+
+    intent_context_path = os.path.join(temp_path, 'intent_context.npy')
+    intent_context = np.load(intent_context_path, allow_pickle=True).item() if os.path.exists(intent_context_path) \
+        else {}
+    # keyed by related session; the intent ratings never change a demonstration
+    for topk_session_idx, context in intent_context.values():
+        demonstrations.setdefault(topk_session_idx, context)
+
+    if not demonstrations:
+        raise ValueError(f"No demonstrations in {bank_path} or {intent_context_path}, "
+                         f"run run.py on the dataset first")
+    return demonstrations
+
+
+class ServingStats(object):
+    """`ServingStats` counts the outcome of every request and keeps the latency of the latest ones.
+
+    Args:
+        window (int): number of latest requests the latency percentiles are taken over.
+    """
+
+    def __init__(self, window=10000):
+        self._lock = threading.Lock()
+        self.outcomes = collections.Counter()
+        self.latencies = collections.deque(maxlen=window)
+        self.queue_waits = collections.deque(maxlen=window)
+
+    def record(self, outcome, latency, queue_wait=0.0):
+        with self._lock:
+            self.outcomes[outcome] += 1
+            if outcome == 'ok':
+                self.latencies.append(latency)
+                self.queue_waits.append(queue_wait)
+
+    def summary(self):
+        """Return the request counts per outcome and the p50/p95/p99 latency of the latest successful ones."""
+        with self._lock:
+            latencies = np.array(self.latencies or [0.0])
+            queue_waits = np.array(self.queue_waits or [0.0])
+            summary = {'requests': sum(self.outcomes.values()), **self.outcomes}
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary.update({
+            'latency_p50': round(float(p50), 3),
+            'latency_p95': round(float(p95), 3),
+            'latency_p99': round(float(p99), 3),
+            'queue_wait_p95': round(float(np.percentile(queue_waits, 95)), 3),
+        })
+        return summary
+
+
+class BundleService(object):
+    """`BundleService` generates the bundles of a live basket with the demonstrations of one dataset.
+
+    The basket is matched to the most similar training session that has a
+    refined demonstration context, by TF-IDF cosine similarity of the
+    titles, and is then run through the test-time chain of `run.py`:
+    rules, `get_test_prompts` and intents.
+
+    Args:
+        name (str): dataset name.
+        chat: chat client the chain runs on.
+        prompt_generator (PromptGenerator): prompt generator of the dataset.
+        training_set (dict): training session id -> `|` separated titles.
+        demonstrations (dict): training session id -> refined context, see `load_demonstrations`.
+    """
+
+    def __init__(self, name, chat, prompt_generator, training_set, demonstrations):
+        self.name = name
+        self.chat = chat
+        self.prompt_generator = prompt_generator
+        self.demonstrations = demonstrations
+        self.vectors = SessionVectors.fit({idx: training_set[idx] for idx in demonstrations})
+
+    def neighbor(self, basket):
+        """Return the training session whose demonstration the basket is prompted with."""
+        return topk_related(self.vectors, [basket], 1, workers=1)[0][0]
+
+    async def generate(self, titles, request_id=None):
+        """Return the neighbour session, bundles, bundle titles and intents of a basket of product titles."""
+        set_usage_context('Serving', request_id)
+        # '|' separates the products of a session
+        basket = '|'.join(title.replace('|', '/') for title in titles)
+        # TF-IDF matching is CPU-bound and would stall every other request on the event loop
+        topk_session_idx = await asyncio.to_thread(self.neighbor, basket)
+        test_context = await generate_test_bundles(self.chat, self.prompt_generator,
+                                                   self.demonstrations[topk_session_idx], basket)
+        bundle_res = output_parser(test_context[-3]['content'])
+        intent_res = output_parser(test_context[-1]['content'], type='intent')
+        # bundles of a single product are dropped, as in the evaluation
+        bundles = {bid: items for bid, items in bundle_res['output'].items() if len(items) > 1}
+        bundle_titles = {}
+        for bid, items in bundles.items():
+            numbers = [product_number(item) for item in items]
+            bundle_titles[bid] = [titles[num - 1] if num and num <= len(titles) else None for num in numbers]
+        return {
+            'dataset': self.name,
+            'neighbor_session': int(topk_session_idx),
+            'bundles': bundles,
+            'bundle_titles': bundle_titles,
+            'intents': {bid: intent for bid, intent in intent_res['output'].items() if bid in bundles},
+        }
+
+
+class BundleServer(object):
+    """`BundleServer` is the asyncio HTTP front of one or more `BundleService`s.
+
+    `POST /bundles` takes `{"products": [titles], "dataset": name,
+    "deadline": seconds}` and answers with the result of
+    `BundleService.generate`. At most `max_concurrency` requests run at
+    once; others wait for a slot, and are turned away with 503 when
+    `max_queue` are already waiting. A request that does not finish within
+    its deadline (at most `deadline`), waiting included, gets a 504; LLM
+    calls it already started run to the end in the background, bounded by
+    `read_timeout`. `GET /metrics` reports the request outcomes and
+    latencies together with the LLM call totals, `GET /health` the loaded
+    datasets.
+
+    Args:
+        services (dict): dataset name -> `BundleService`; the first one is the default.
+        max_concurrency (int): requests generated at the same time.
+        deadline (float): longest time in seconds a request may take.
+        max_queue (int): requests allowed to wait for a slot.
+        logger: optional Logger.
+    """
+
+    def __init__(self, services, max_concurrency=8, deadline=60.0, max_queue=64, logger=None):
+        self.services = services
+        self.default_dataset = next(iter(services))
+        self.max_concurrency = max_concurrency
+        self.deadline = deadline
+        self.max_queue = max_queue
+        self.logger = logger
+        self.stats = ServingStats()
+        self.waiting = 0
+        self.in_flight = 0
+        self._request_ids = itertools.count(1)
+        self._slots = None
+
+    async def generate(self, payload):
+        """Return the HTTP status and JSON body of a `POST /bundles` request."""
+        start = time.time()
+        titles = payload.get('products') if isinstance(payload, dict) else None
+        if not isinstance(titles, list) or not titles or not all(isinstance(title, str) for title in titles):
+            self.stats.record('bad_request', 0.0)
+            return HTTPStatus.BAD_REQUEST, {'error': "'products' must be a non-empty list of product titles"}
+        dataset = payload.get('dataset', self.default_dataset)
+        if dataset not in self.services:
+            self.stats.record('bad_request', 0.0)
+            return HTTPStatus.BAD_REQUEST, {'error': f"unknown dataset {dataset!r}, serving {list(self.services)}"}
+        try:
+            deadline = min(float(payload.get('deadline', self.deadline)), self.deadline)
+        except (TypeError, ValueError):
+            self.stats.record('bad_request', 0.0)
+            return HTTPStatus.BAD_REQUEST, {'error': "'deadline' must be a number of seconds"}
+
+        if self.waiting >= self.max_queue:
+            self.stats.record('rejected', time.time() - start)
+            return HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'too many requests waiting'}
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), deadline)
+        except asyncio.TimeoutError:
+            self.stats.record('rejected', time.time() - start)
+            return HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'no free slot before the deadline'}
+        finally:
+            self.waiting -= 1
+
+        queue_wait = time.time() - start
+        request_id = next(self._request_ids)
+        self.in_flight += 1
+        try:
+            result = await asyncio.wait_for(self.services[dataset].generate(titles, request_id),
+                                            max(0.0, deadline - queue_wait))
+        except asyncio.TimeoutError:
+            self.stats.record('timeout', time.time() - start)
+            if self.logger:
+                self.logger.warning(f"Request {request_id} missed its {deadline:.1f}s deadline")
+            return HTTPStatus.GATEWAY_TIMEOUT, {'error': f'no result within {deadline:.1f}s'}
+        except Exception as e:
+            self.stats.record('error', time.time() - start)
+            if self.logger:
+                self.logger.error(f"Request {request_id} failed: {type(e).__name__}: {e}")
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f'{type(e).__name__}: {e}'}
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+        latency = time.time() - start
+        self.stats.record('ok', latency, queue_wait)
+        if self.logger:
+            self.logger.debug(f"Request {request_id}: {len(result['bundles'])} bundles in {latency:.2f}s")
+        return HTTPStatus.OK, dict(result, latency=round(latency, 3))
+
+    def metrics(self):
+        return {'requests': self.stats.summary(), 'in_flight': self.in_flight, 'waiting': self.waiting,
+                'llm_calls': usage_tracker.summary().get('total')}
+
+    async def dispatch(self, method, path, body):
+        path = path.split('?', 1)[0]
+        if method == 'GET' and path == '/health':
+            return HTTPStatus.OK, {'status': 'ok', 'datasets': list(self.services)}
+        if method == 'GET' and path == '/metrics':
+            return HTTPStatus.OK, self.metrics()
+        if method == 'POST' and path == '/bundles':
+            try:
+                payload = json.loads(body or b'{}')
+            except ValueError:
+                self.stats.record('bad_request', 0.0)
+                return HTTPStatus.BAD_REQUEST, {'error': 'request body is not JSON'}
+            return await self.generate(payload)
+        return HTTPStatus.NOT_FOUND, {'error': f'no route {method} {path}'}
+
+    async def _handle_connection(self, reader, writer):
+        """Answer the HTTP/1.1 requests of one keep-alive connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self.dispatch(method, path, body)
+                data = json.dumps(payload, default=str).encode('utf-8')
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}"
+                             f"\r\n\r\n".encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080, ready=None):
+        """Serve until cancelled; `ready` (a `threading.Event`) is set once the port is open."""
+        loop = asyncio.get_running_loop()
+        # blocking API clients run on worker threads; calls abandoned at a deadline keep theirs until they return
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=2 * self.max_concurrency))
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        if self.logger:
+            self.logger.info(f"Serving {', '.join(self.services)} on http://{host}:{self.port}")
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
@@ -0,0 +1,156 @@
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+
+
+def shard_keys(keys, n_shards, shard):
+    """Return the keys of one shard, every `n_shards`-th key of `keys` starting at `shard`."""
+    return [key for pos, key in enumerate(keys) if pos % n_shards == shard]
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class ShardQueue(object):
+    """`ShardQueue` hands out the shards of a run to workers through a SQLite file.
+
+    Workers on this machine, or on other hosts that see the same file on
+    shared storage, claim a shard under a lease and renew it while they work
+    on it. A shard whose lease runs out, because its worker died, is handed
+    out again. A shard whose run failed is handed out again at once, until
+    it has been claimed `max_claims` times; it is then marked failed.
+    Finished shards are never handed out twice.
+    """
+
+    def __init__(self, path, n_shards):
+        """Initializes a new `ShardQueue` instance, creating the shards on first use.
+
+        Args:
+            path (str): SQLite file to use. The directory component of this
+                file will be created automatically if it is not existing.
+            n_shards (int): number of shards; must be the same for every worker.
+        """
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        self.path = path
+        self.n_shards = n_shards
+        self._lock = threading.Lock()
+        # a heartbeat thread renews the lease while the pipeline runs
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS shards (
+                               shard INTEGER PRIMARY KEY,
+                               state TEXT NOT NULL,
+                               worker TEXT,
+                               lease_until REAL NOT NULL DEFAULT 0,
+                               claims INTEGER NOT NULL DEFAULT 0)""")
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            existing = self.conn.execute("SELECT COUNT(*) FROM shards").fetchone()[0]
+            if existing and existing != n_shards:
+                self.conn.execute("ROLLBACK")
+                raise ValueError(f"{path} holds {existing} shards, not {n_shards}")
+            self.conn.executemany("INSERT OR IGNORE INTO shards (shard, state) VALUES (?, 'pending')",
+                                  [(shard,) for shard in range(n_shards)])
+            self.conn.execute("COMMIT")
+
+    def claim(self, worker, lease):
+        """Lease the next pending or expired shard to `worker` for `lease` seconds, None if there is none."""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("""SELECT shard FROM shards
+                                       WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?)
+                                       ORDER BY shard LIMIT 1""", (time.time(),)).fetchone()
+            if row is not None:
+                self.conn.execute("""UPDATE shards SET state = 'leased', worker = ?, lease_until = ?,
+                                     claims = claims + 1 WHERE shard = ?""", (worker, time.time() + lease, row[0]))
+            self.conn.execute("COMMIT")
+        return None if row is None else row[0]
+
+    def renew(self, shard, worker, lease):
+        """Extend the lease of `worker` on `shard`, False if the shard was handed to another worker."""
+        with self._lock:
+            cursor = self.conn.execute("""UPDATE shards SET lease_until = ?
+                                          WHERE shard = ? AND worker = ? AND state = 'leased'""",
+                                       (time.time() + lease, shard, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, shard, worker):
+        """Mark `shard` as done, False if `worker` no longer held it."""
+        with self._lock:
+            cursor = self.conn.execute("""UPDATE shards SET state = 'done', lease_until = 0
+                                          WHERE shard = ? AND worker = ? AND state = 'leased'""", (shard, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, shard, worker, max_claims=3):
+        """Give up `shard` after a failed run: back to pending, or failed once it was claimed `max_claims` times.
+
+        Returns:
+            str: the new state of the shard, None if `worker` no longer held it
+        """
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT claims FROM shards WHERE shard = ? AND worker = ? AND state = 'leased'",
+                                    (shard, worker)).fetchone()
+            state = None
+            if row is not None:
+                state = 'failed' if row[0] >= max_claims else 'pending'
+                self.conn.execute("UPDATE shards SET state = ?, lease_until = 0 WHERE shard = ?", (state, shard))
+            self.conn.execute("COMMIT")
+        return state
+
+    def status(self):
+        """Return the number of shards per state."""
+        with self._lock:
+            rows = self.conn.execute("SELECT state, COUNT(*) FROM shards GROUP BY state").fetchall()
+        return dict(rows)
+
+    def lease(self, shard, worker, lease):
+        """Context manager that renews the lease of `shard` every third of `lease` seconds until it exits."""
+        return _Heartbeat(self, shard, worker, lease)
+
+    def close(self):
+        self.conn.close()
+
+
+class _Heartbeat(object):
+
+    def __init__(self, queue, shard, worker, lease):
+        self.queue, self.shard, self.worker, self.lease = queue, shard, worker, lease
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.lost = False
+
+    def _run(self):
+        while not self._stop.wait(self.lease / 3):
+            if not self.queue.renew(self.shard, self.worker, self.lease):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def save_shard_predictions(path, predictions):
+    """Write the predictions of a shard, atomically so a half-written file is never merged."""
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(predictions, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def load_shard_predictions(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
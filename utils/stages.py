@@ -0,0 +1,402 @@
+import asyncio
+
+import numpy as np
+
+from utils.bundle_index import BundleIndex, product_number
+from utils.cache import cache_sample
+from utils.context import answer_kind
+from utils.convergence import convergence_tracker, normalize_bundles
+from utils.functions import output_parser
+from utils.metrics import findErrors
+
+RULES_QUESTION = "Based on conversations above, which rules do you find when detecting bundles?"
+# index of the self-correction prompt that asks to adjust the bundles
+ADJUST_ROUND = 1
+TEST_INTENT_QUESTION = "Please use 3 to 5 words to generate intents behind the detected bundles, the output format is: {'bundle number':'intent'}"
+
+
+async def self_correction(chat, prompt_generator, prompt, max_iter, logger, test_id, topk_session_idx=None,
+                          session_bundles=None, session_items=None, index=None):
+    """Generate initial bundles and refine them with self-correction prompts.
+
+    With the related session given, the adjust-bundles round is skipped when
+    `findErrors` finds nothing wrong with the bundles so far. The loop also
+    stops once an answer repeats the previous bundles (compared as
+    normalized product sets), since the remaining rounds would only restate
+    them.
+    """
+    message = [{"role": "user", "content": prompt}]
+    init_res = await chat.acreate_chat_completion(message, stop_at_object=True)
+    message.append({"role": "assistant", "content": init_res})
+    bundle_dict = _bundle_dict(init_res)
+    bundles = normalize_bundles(bundle_dict)
+
+    saved_calls = 0
+    for i in range(max_iter):
+        if i == ADJUST_ROUND and topk_session_idx is not None and bundle_dict is not None:
+            error_dict = findErrors(topk_session_idx, bundle_dict, session_bundles, session_items, index)
+            if 0 in error_dict and len(error_dict) == 1:
+                saved_calls += 1
+                logger.debug(f"Skipped adjusting bundles for test_id {test_id}, no errors found")
+                continue
+        message.append({"role": "user", "content": prompt_generator.get_Self_correction(i)})
+        intent_res = await chat.acreate_chat_completion(message, stop_at_object=True)
+        message.append({"role": "assistant", "content": intent_res})
+
+        if answer_kind(intent_res) != 'bundle':
+            continue
+        new_bundle_dict = _bundle_dict(intent_res)
+        new_bundles = normalize_bundles(new_bundle_dict)
+        # Early stop if the adjusted bundles are the ones we already had
+        if new_bundles is not None and new_bundles == bundles:
+            saved_calls += max_iter - i - 1
+            logger.debug(f"Early stop for test_id {test_id} at iteration {i}, bundles unchanged")
+            break
+        bundle_dict, bundles = new_bundle_dict, new_bundles
+
+    convergence_tracker.record('Self-correction', saved_calls)
+    return message
+
+
+def _bundle_dict(response):
+    """Parsed bundles of a response, None if it holds none."""
+    output_parser_res = output_parser(response)
+    if output_parser_res['state_code'] != 200:
+        return None
+    return output_parser_res['output']
+
+
+def parse_bundle_result(message, logger, test_id):
+    """Parse the latest bundle answer of a conversation, None if there is none."""
+    bundle_str = None
+
+    # The last assistant message should contain the final bundle result
+    for i in range(len(message) - 1, -1, -1):
+        if message[i]['role'] == 'assistant':
+            # Check if this looks like a bundle result (contains 'bundle' and brackets)
+            content = message[i]['content'].replace('\n', '')
+            # an intent answer also has 'bundle' keys, e.g. after a skipped adjust round
+            if answer_kind(content) == 'intent':
+                continue
+            if 'bundle' in content.lower() and ('{' in content or '[' in content):
+                bundle_str = content
+                break
+
+    if not bundle_str:
+        logger.warning(f'No valid bundle result found for test_id: {test_id}')
+        return None
+
+    output_parser_res = output_parser(bundle_str)
+    if output_parser_res['state_code'] != 200:
+        logger.warning(f'Error when parsing test_id: {test_id}')
+        return None
+    return output_parser_res['output']
+
+
+async def bundle_feedback(chat, prompt_generator, topk_session_idx, bundle_dict, context,
+                          n_iter, session_bundles, session_items, logger, test_id, index=None):
+    """Feed detected errors back to the model, None if it hallucinated products."""
+    context = context.copy()
+    saved_calls = 0
+    # iterately generate feedback for N times
+    for iteration in range(n_iter):
+        error_dict = findErrors(topk_session_idx, bundle_dict, session_bundles, session_items, index)
+        if 0 in error_dict and len(error_dict) == 1:
+            logger.debug(f"No errors found for test_id {test_id}")
+            break
+        elif 5 in error_dict:
+            # hallucination
+            logger.warning(f"Hallucination detected for test_id {test_id}")
+            return None
+        else:
+            # Get the prompt
+            feedback_prompt = prompt_generator.get_Feedback('bundle', error_dict)
+            context.append({"role": "user", "content": feedback_prompt})
+            # Create a new chat completion
+            reply_str = await chat.acreate_chat_completion(context, stop_at_object=True)
+            context.append({"role": "assistant", "content": reply_str})
+            output_parser_res = output_parser(reply_str)
+            if output_parser_res['state_code'] == 200:
+                previous = normalize_bundles(bundle_dict)
+                bundle_dict = output_parser_res['output']
+                logger.debug(f"Applied feedback for test_id {test_id}, iteration {iteration}")
+                if previous is not None and normalize_bundles(bundle_dict) == previous:
+                    # the same bundles would get the same feedback again
+                    logger.debug(f"Bundles unchanged by feedback for test_id {test_id}, iteration {iteration}")
+                    saved_calls = n_iter - iteration - 1
+                    break
+    convergence_tracker.record('Bundle feedback', saved_calls)
+    return context
+
+
+async def intent_regeneration(chat, prompt_generator, context):
+    """Regenerate intents when bundle feedback changed the conversation."""
+    # Check if feedback was applied by looking for feedback prompts in the context
+    has_feedback = any("error" in msg.get("content", "").lower() or
+                       "feedback" in msg.get("content", "").lower()
+                       for msg in context if msg.get("role") == "user")
+
+    if not has_feedback:  # no feedback was applied
+        return context
+
+    append_intent_context = context.copy()
+    append_intent_context.append({"role": "user", "content": prompt_generator.get_Self_correction(2)})  # Use the intent regeneration prompt
+    intent_str = await chat.acreate_chat_completion(append_intent_context, stop_at_object=True)
+    append_intent_context.append({"role": "assistant", "content": intent_str})
+    return append_intent_context
+
+
+def _lookup_intent(intent_dict, bundle_id):
+    """Find the intent of `bundle_id` under the key spellings models use."""
+    # Try different formats to find the intent
+    if bundle_id in intent_dict:
+        return intent_dict[bundle_id]
+    elif bundle_id.lower() in intent_dict:
+        return intent_dict[bundle_id.lower()]
+    elif f"bundle{bundle_id}" in intent_dict:  # Try 'bundle1', 'bundle2', etc.
+        return intent_dict[f"bundle{bundle_id}"]
+    elif f"Bundle {bundle_id}" in intent_dict:  # Try 'Bundle 1', 'Bundle 2', etc.
+        return intent_dict[f"Bundle {bundle_id}"]
+    # Try fallbacks with just the bundle part
+    elif "bundle" + bundle_id.lstrip("bundle") in intent_dict:
+        return intent_dict["bundle" + bundle_id.lstrip("bundle")]
+    return None
+
+
+def match_related_bundles(topk_session_idx, context, session_items, session_bundles, logger, test_id, index=None):
+    """Pair the generated bundles and intents with matching ground-truth bundles."""
+    # Find the most recent bundle result by looking backwards through messages
+    bundle_content = None
+    intent_content = None
+
+    # Look for the last assistant messages that contain bundle and intent data
+    for i in range(len(context) - 1, -1, -1):
+        if context[i]['role'] == 'assistant':
+            content = context[i]['content']
+            # Check if this looks like an intent result (after bundle feedback)
+            if intent_content is None and ('intent' in content.lower() or
+                                           ('{' in content and any(key in content.lower() for key in ['bundle', '1', '2', '3']))):
+                # Try to parse as intent first
+                intent_test = output_parser(content, type='intent')
+                if intent_test['state_code'] == 200:
+                    intent_content = content
+                    continue
+
+            # Check if this looks like a bundle result
+            if bundle_content is None and ('bundle' in content.lower() and ('{' in content or '[' in content)):
+                bundle_test = output_parser(content)
+                if bundle_test['state_code'] == 200:
+                    bundle_content = content
+
+            # Stop if we found both
+            if bundle_content and intent_content:
+                break
+
+    # Fallback: use the last two assistant messages if we can't find specific content
+    if not bundle_content or not intent_content:
+        assistant_messages = [msg['content'] for msg in context if msg['role'] == 'assistant']
+        if len(assistant_messages) >= 2:
+            if not bundle_content:
+                bundle_content = assistant_messages[-2]  # Second to last
+            if not intent_content:
+                intent_content = assistant_messages[-1]   # Last
+        elif len(assistant_messages) == 1:
+            # Only one message, try to use it for both
+            bundle_content = intent_content = assistant_messages[0]
+
+    if not bundle_content:
+        logger.warning(f'No bundle content found for test_id: {test_id}')
+        return None
+
+    bundle_res = output_parser(bundle_content)
+    intent_res = output_parser(intent_content or bundle_content, type='intent')
+    if index is None:
+        index = BundleIndex({topk_session_idx: session_items[topk_session_idx]},
+                            {topk_session_idx: session_bundles[topk_session_idx]})
+    ground_truth_bundles = session_bundles[topk_session_idx]
+
+    if bundle_res['state_code'] != 200:
+        logger.warning(f'Error when parsing bundle for test_id: {test_id}')
+        return None
+
+    bundle_dict = bundle_res['output']
+    intent_dict = intent_res['output'] if intent_res['state_code'] == 200 else {}
+    related_bundles = []
+    for bundle_id, items in bundle_dict.items():
+        if len(items) < 2:
+            continue
+
+        reidx_items = set()
+        for item in items:
+            if product_number(item) is None:
+                # Log warning for unexpected item format
+                logger.warning(f"Unexpected item format: {item} in test_id: {test_id}")
+                continue
+            item_id = index.product_item(topk_session_idx, item)
+            if item_id is not None:
+                reidx_items.add(item_id)
+
+        if not reidx_items:
+            continue
+
+        pos = index.match(topk_session_idx, reidx_items)
+        if pos is None:
+            continue
+        gdbundle = ground_truth_bundles[pos]
+        intent_text = _lookup_intent(intent_dict, bundle_id)
+        if intent_text is None:
+            # If we can't find a match, log a warning and use a default intent
+            logger.warning(f"Missing intent for bundle_id: {bundle_id} in test_id: {test_id}")
+            intent_text = "No intent provided"
+
+        if 'bundle' in bundle_id and len(bundle_id) < 10:
+            related_bundles.append((','.join(list(reidx_items)), intent_text, gdbundle[-1], gdbundle[0]))
+        else:  # intent:bundle
+            related_bundles.append((','.join(list(reidx_items)), bundle_id, gdbundle[-1], gdbundle[0]))
+
+    return related_bundles or None
+
+
+def _accumulate_scores(intent_res, scores_res, logger):
+    """Add the score vectors of one rating response into `scores_res`."""
+    for idx, (bid, intent) in enumerate(intent_res.items()):
+        if idx not in scores_res:
+            scores_res[idx] = [np.array([0, 0, 0]), np.array([0, 0, 0])]
+
+        # Check if intent is a dictionary before accessing keys
+        if not isinstance(intent, dict):
+            logger.warning(f"Intent for bundle {bid} is not a dictionary: {intent}")
+            # Try to convert list to dict if it's a list of scores
+            if isinstance(intent, list) and all(isinstance(x, (int, float)) for x in intent):
+                # Convert direct score list to proper format
+                logger.warning(f"Converting score list to dict: {intent}")
+                scores_res[idx][0] += np.array(intent)
+                continue
+            elif isinstance(intent, str):
+                # Skip string intents (they're not scores)
+                continue
+
+        try:
+            key_list = list(intent.keys())
+
+            # Process different return formats
+            if len(key_list) >= 2:
+                # Standard case: two intent keys
+                try:
+                    scores_res[idx][0] += np.array([int(i) for i in intent[key_list[0]]])
+                    scores_res[idx][1] += np.array([int(i) for i in intent[key_list[1]]])
+                except (ValueError, TypeError) as e:
+                    logger.warning(f"Error converting scores: {e}, values: {intent[key_list[0]]}, {intent[key_list[1]]}")
+
+            elif len(key_list) == 1:
+                # Only one intent key, assume it's the first intent
+                try:
+                    scores_res[idx][0] += np.array([int(i) for i in intent[key_list[0]]])
+                    # Second intent remains 0
+                except (ValueError, TypeError) as e:
+                    logger.warning(f"Error converting scores: {e}, value: {intent[key_list[0]]}")
+            else:
+                # No intent keys, skip
+                logger.warning(f"No intent keys found for bundle {bid}")
+        except AttributeError:
+            logger.warning(f"Invalid intent object for bundle {bid}: {intent}")
+
+
+def _scores_agree(a, b, tolerance):
+    """True if two rating responses score the same bundles within `tolerance` on every metric."""
+    if a.keys() != b.keys():
+        return False
+    return all(np.abs(a[idx][k] - b[idx][k]).max() <= tolerance for idx in a for k in (0, 1))
+
+
+async def _rate_once(rater, message, logger, test_id, attempt):
+    """One rating call, parsed into {bundle position: [scores of intent1, scores of intent2]}, None on failure."""
+    # every repeat is an independent rating, not a cached or coalesced copy of the first one
+    cache_sample.set(attempt)
+    try:
+        intent_feedback_str = await rater.acreate_chat_completion(message, stop_at_object=True)
+        logger.debug(f"Raw intent feedback for test_id {test_id}: {intent_feedback_str[:100]}...")
+
+        intent_res = output_parser(intent_feedback_str, type='intent')['output']
+
+        # Skip if the result is empty or malformed
+        if not intent_res:
+            logger.warning(f"Empty intent result for test_id: {test_id}")
+            return None
+
+        scores_res = {}
+        _accumulate_scores(intent_res, scores_res, logger)
+        return scores_res or None
+    except Exception as e:
+        logger.error(f"Error during intent rating attempt {attempt}: {str(e)}")
+        return None
+
+
+async def rate_intents(raters, rater_prompt, rating_repeats, logger, test_id, quorum=None, tolerance=0):
+    """Rate the intents of a session with every rater, None if nothing was rated.
+
+    All rater calls (every rater, `rating_repeats` times) run concurrently.
+    With a `quorum`, the first `quorum` calls are sent on their own; once
+    that many responses agree within `tolerance` on every score, the other
+    calls are cancelled or never sent. The scores are averaged over the
+    responses received.
+    """
+    message = [{"role": "user", "content": rater_prompt}]
+    # repeats round-robin over the raters, so a quorum is drawn from different raters first
+    calls = [(rater, attempt) for attempt in range(rating_repeats) for rater in raters]
+    if quorum is None or quorum >= len(calls):
+        waves = [calls]
+    else:
+        waves = [calls[:quorum], calls[quorum:]]
+
+    responses = []
+    agreed = False
+    for wave in waves:
+        tasks = [asyncio.ensure_future(_rate_once(rater, message, logger, test_id, attempt))
+                 for rater, attempt in wave]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                scores_res = await next_done
+                if scores_res is None:
+                    continue
+                responses.append(scores_res)
+                if quorum and sum(_scores_agree(scores_res, other, tolerance) for other in responses) >= quorum:
+                    agreed = True
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+        if agreed:
+            logger.debug(f"Rating quorum reached for test_id {test_id} after {len(responses)} responses")
+            break
+
+    if len(responses) == 0:
+        return None
+
+    # Average across all responses received
+    final_scores = {}
+    for scores_dict in responses:
+        for idx, (score1, score2) in scores_dict.items():
+            if idx not in final_scores:
+                final_scores[idx] = [np.array([0.0, 0.0, 0.0]), np.array([0.0, 0.0, 0.0])]
+            final_scores[idx][0] += score1 / len(responses)
+            final_scores[idx][1] += score2 / len(responses)
+    return final_scores
+
+
+async def generate_test_bundles(chat, prompt_generator, context, test_session):
+    """Ask for rules, then bundles and intents of the test session."""
+    test_context = context.copy()
+    test_context.append({"role": "user", "content": RULES_QUESTION})
+    # the rules are free text, which may quote a {...} before it ends
+    rule_str = await chat.acreate_chat_completion(test_context)
+    test_context.append({"role": "assistant", "content": rule_str})
+
+    test_prompt = prompt_generator.get_test_prompts(test_session)
+    test_context.append({"role": "user", "content": test_prompt})
+    test_str = await chat.acreate_chat_completion(test_context, stop_at_object=True)
+    test_context.append({"role": "assistant", "content": test_str})
+    test_context.append({"role": "user", "content": TEST_INTENT_QUESTION})
+    intent_str = await chat.acreate_chat_completion(test_context, stop_at_object=True)
+    test_context.append({"role": "assistant", "content": intent_str})
+    return test_context
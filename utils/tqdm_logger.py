@@ -1,5 +1,4 @@
 from tqdm import tqdm as original_tqdm
-import sys
 import time
 
 class TqdmLogger(original_tqdm):
@@ -14,14 +13,11 @@ class TqdmLogger(original_tqdm):
             log_interval: How often to log progress (e.g., every 10% or every 100 items)
         """
         self.logger = logger
-        self.log_interval = log_interval or max(1, kwargs.get('total', 100) // 10)  # Default: log every 10%
+        self.log_interval = log_interval or max(1, (kwargs.get('total') or 100) // 10)  # Default: log every 10%
         self.last_logged = 0
         self.step_name = kwargs.pop('desc', 'Progress') if 'desc' in kwargs else 'Progress'
         
-        # Set file parameter to redirect tqdm output to our custom handler
-        if logger:
-            kwargs['file'] = sys.stdout
-            
+        # the bar stays on stderr, apart from the log messages on stdout
         super().__init__(*args, **kwargs)
         
         if self.logger:
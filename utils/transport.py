@@ -0,0 +1,101 @@
+import json
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.scheduler import RequestTimeout, ServerError, error_from_status
+
+
+class HTTPTransport(object):
+    """`HTTPTransport` is the keep-alive HTTP connection pool shared by the API clients.
+
+    Every provider posts its JSON requests through one `requests.Session`,
+    so connections (and their TLS sessions) to a host are reused across
+    calls, clients and worker threads instead of being opened per call.
+    Failures are raised as the typed errors of `utils.scheduler`.
+
+    Args:
+        pool_size (int): connections kept open per host, at least the
+            number of concurrent calls.
+        connect_timeout (float): seconds to establish a connection.
+        read_timeout (float): seconds to wait for the response.
+    """
+
+    def __init__(self, pool_size=8, connect_timeout=10.0, read_timeout=120.0):
+        self.configure(pool_size, connect_timeout, read_timeout)
+
+    def configure(self, pool_size=8, connect_timeout=10.0, read_timeout=120.0):
+        """(Re)create the connection pool with new limits, closing the connections of the previous one."""
+        previous = getattr(self, 'session', None)
+        session = requests.Session()
+        # retries are left to the scheduler
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(1, int(pool_size)), max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self.session = session
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        if previous is not None:
+            # its keep-alive sockets would stay open until the session is garbage collected
+            previous.close()
+
+    def post_json(self, url, headers, payload):
+        """POST `payload` as JSON and return the decoded JSON response.
+
+        Raises:
+            RequestTimeout: the connection failed or the response did not arrive in time.
+            APICallError: the status of the response was not 2xx.
+        """
+        try:
+            response = self.session.post(url, headers=headers, json=payload, timeout=self.timeout)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            raise RequestTimeout(f"{type(e).__name__}: {e}") from e
+        if response.status_code >= 400:
+            raise error_from_status(response.status_code, f"HTTP {response.status_code}: {response.text[:500]}",
+                                    response.headers)
+        try:
+            return response.json()
+        except ValueError as e:
+            # a proxy or load balancer answered instead of the API
+            raise ServerError(f"invalid JSON response: {response.text[:500]}", response.status_code) from e
+
+    def post_stream(self, url, headers, payload):
+        """POST `payload` as JSON and yield the decoded `data:` events of the server-sent event stream.
+
+        Closing the generator closes the response, which ends the stream on
+        the server side as well.
+
+        Raises:
+            RequestTimeout: the connection failed or stalled mid-stream.
+            APICallError: the status of the response was not 2xx.
+        """
+        try:
+            response = self.session.post(url, headers=headers, json=payload, timeout=self.timeout, stream=True)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            raise RequestTimeout(f"{type(e).__name__}: {e}") from e
+        try:
+            if response.status_code >= 400:
+                raise error_from_status(response.status_code, f"HTTP {response.status_code}: {response.text[:500]}",
+                                        response.headers)
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    return
+                try:
+                    yield json.loads(data)
+                except ValueError as e:
+                    raise ServerError(f"invalid stream event: {data[:500]}", response.status_code) from e
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            raise RequestTimeout(f"stream interrupted: {type(e).__name__}: {e}") from e
+        finally:
+            response.close()
+
+    def close(self):
+        self.session.close()
+
+
+# Shared by every client, so concurrent calls to one host reuse the same connections
+http_transport = HTTPTransport()
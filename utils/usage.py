@@ -0,0 +1,118 @@
+import collections
+import contextvars
+import json
+import os
+import threading
+
+import numpy as np
+
+# Stage and session of the call being made; every asyncio task gets its own copy
+current_stage = contextvars.ContextVar('current_stage', default=None)
+current_test_id = contextvars.ContextVar('current_test_id', default=None)
+# Dataset of the experiment making the call, when several run in one process
+current_dataset = contextvars.ContextVar('current_dataset', default=None)
+
+
+def set_usage_context(stage, test_id=None):
+    """Tag the API calls made from now on in this task with `stage` and `test_id`."""
+    current_stage.set(stage)
+    current_test_id.set(test_id)
+
+
+class UsageTracker(object):
+    """`UsageTracker` records token usage, latency and retries of every API call.
+
+    Calls are tagged with the stage and test_id set through
+    `set_usage_context`, so the totals can be broken down per stage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records = []
+
+    def limit(self, max_records):
+        """Keep only the latest `max_records` calls, for long-running processes such as the server."""
+        with self._lock:
+            self.records = collections.deque(self.records, maxlen=max_records)
+
+    def record(self, provider, model, prompt_tokens, completion_tokens, latency, retries, failed=False,
+               time_to_result=None, stopped_early=False):
+        """Record one API call; token counts are None when the API does not report them.
+
+        `time_to_result` is the time until the usable answer was in, which is
+        shorter than `latency` for streamed calls that stop at the first JSON
+        object (`stopped_early`).
+        """
+        with self._lock:
+            self.records.append({
+                'dataset': current_dataset.get(),
+                'stage': current_stage.get(),
+                'test_id': current_test_id.get(),
+                'provider': provider,
+                'model': model,
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'latency': latency,
+                'retries': retries,
+                'failed': failed,
+                'time_to_result': latency if time_to_result is None else time_to_result,
+                'stopped_early': stopped_early,
+            })
+
+    def _records(self, dataset=None):
+        with self._lock:
+            return [rec for rec in self.records if dataset is None or rec['dataset'] == dataset]
+
+    def calls_per_test_id(self, stages, dataset=None, failed=False):
+        """Return the number of calls each test_id made in `stages`, of one dataset if given.
+
+        Counts are keyed by `str(test_id)`, batch calls are tagged with the string id.
+        With `failed`, only the calls that failed are counted.
+        """
+        return collections.Counter(str(rec['test_id']) for rec in self._records(dataset)
+                                   if rec['stage'] in stages and (rec['failed'] or not failed))
+
+    def summary(self, dataset=None):
+        """Return per-stage totals and latency percentiles of the recorded calls, of one dataset if given."""
+        records = self._records(dataset)
+
+        by_stage = {}
+        for rec in records:
+            by_stage.setdefault(rec['stage'] or 'untagged', []).append(rec)
+
+        summary = {}
+        for stage, stage_records in list(by_stage.items()) + [('total', records)]:
+            if not stage_records:
+                continue
+            latencies = np.array([rec['latency'] for rec in stage_records])
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            ttr_p50, ttr_p95 = np.percentile([rec.get('time_to_result', rec['latency']) for rec in stage_records],
+                                             [50, 95])
+            summary[stage] = {
+                'calls': len(stage_records),
+                'failed_calls': sum(rec['failed'] for rec in stage_records),
+                'retries': sum(rec['retries'] for rec in stage_records),
+                'prompt_tokens': sum(rec['prompt_tokens'] or 0 for rec in stage_records),
+                'completion_tokens': sum(rec['completion_tokens'] or 0 for rec in stage_records),
+                'latency_total': round(float(latencies.sum()), 3),
+                'latency_p50': round(float(p50), 3),
+                'latency_p95': round(float(p95), 3),
+                'latency_p99': round(float(p99), 3),
+                'time_to_result_p50': round(float(ttr_p50), 3),
+                'time_to_result_p95': round(float(ttr_p95), 3),
+                'stopped_early': sum(rec.get('stopped_early', False) for rec in stage_records),
+            }
+        return summary
+
+    def save(self, path, dataset=None):
+        """Write the summary and every call record, of one dataset if given, to a JSON file."""
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        records = self._records(dataset)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'summary': self.summary(dataset), 'calls': records}, f, indent=2, default=str)
+
+
+# Shared by every client in `utils.ChatAPI`
+usage_tracker = UsageTracker()